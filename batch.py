@@ -0,0 +1,506 @@
+"""Module used to process many frames with the same parameters
+
+   Frames (fluorescence files with optional phase files) are listed from a
+   directory or a manifest file and processed in a pool of worker processes,
+   each frame going through load, mask, align and overlay. A failure in one
+   frame is recorded in its BatchResult and does not stop the batch.
+
+   Runs are checkpointed: each frame folder has a manifest.json with the
+   hashes of the input files, a fingerprint of the parameters for each stage,
+   the stages finished and their outputs. Stages whose fingerprints did not
+   change are not computed again, so rerunning a batch only processes new or
+   changed frames and resumes frames that were interrupted.
+"""
+
+import os
+import copy
+import time
+import json
+import hashlib
+import traceback
+import multiprocessing
+import numpy as np
+
+from params import Parameters
+from ehooke import EHooke
+from masks import pack_mask, unpack_mask
+
+IMAGE_EXTENSIONS = ['.tif', '.tiff', '.png', '.jpg']
+"""list: extensions (lower case) of the image files listed by frames_from_directory"""
+
+FRAME_MEMORY_FACTOR = 12
+"""int: estimated peak memory of processing a frame, in multiples of its file sizes
+   (float64 images, masks and overlay buffers for 16 bit files)"""
+
+STAGES = ['load', 'mask', 'align', 'overlay']
+"""list: processing stages of each frame, in order"""
+
+MANIFEST = 'manifest.json'
+"""str: name of the manifest file, in the output folder and in each frame folder"""
+
+HASH_BLOCK = 1 << 20
+"""int: bytes read at a time when hashing input files"""
+
+
+class BatchFrame:
+    """A fluorescence file, and optional phase file, to process in a batch"""
+
+    def __init__(self, name, fluor_file, phase_file=None):
+        self.name = name
+        """str: frame name, also the name of the frame output folder"""
+        self.fluor_file = fluor_file
+        """str: fluorescence file, including path"""
+        self.phase_file = phase_file
+        """str: phase file, including path, or None"""
+
+    def memory_estimate(self):
+        """returns the estimated peak memory, in bytes, for processing the frame"""
+
+        size = os.path.getsize(self.fluor_file)
+        if self.phase_file is not None:
+            size += os.path.getsize(self.phase_file)
+        return FRAME_MEMORY_FACTOR * size
+
+
+class BatchResult:
+    """Outcome of processing one frame"""
+
+    def __init__(self, name):
+        self.name = name
+        """str: frame name"""
+        self.status = 'failed'
+        """str: 'done' or 'failed'"""
+        self.stages = []
+        """list: stages completed, in order"""
+        self.reused = []
+        """list: stages taken from a previous run instead of computed"""
+        self.error = None
+        """str: traceback of the failure, None if done"""
+        self.outputs = {}
+        """dict: output file names, by stage"""
+        self.fluor_shift = (0, 0)
+        """tuple: alignment offset of the fluorescence image"""
+        self.elapsed = 0.0
+        """float: processing time in seconds"""
+
+
+def unique_names(frames):
+    """renames frames with repeated names by appending _1, _2, ..., skipping
+       suffixes that are names of other frames (e.g. a frame named a_1)
+    """
+
+    names = set(frame.name for frame in frames)
+    seen = set()
+    for frame in frames:
+        if frame.name in seen:
+            count = 1
+            while '{0}_{1}'.format(frame.name, count) in names:
+                count += 1
+            frame.name = '{0}_{1}'.format(frame.name, count)
+            names.add(frame.name)
+        seen.add(frame.name)
+    return frames
+
+
+def matching_phase(fname, phase_names):
+    """returns the name in phase_names with the longest common prefix with fname,
+       or None if none has a common prefix or several have the longest one
+    """
+
+    best = None
+    best_length = 0
+    for phase_name in phase_names:
+        length = len(os.path.commonprefix([fname, phase_name]))
+        if length > best_length:
+            best, best_length = phase_name, length
+        elif length == best_length:
+            best = None
+    return best
+
+
+def frames_from_directory(folder, fluor_tag=None, phase_tag='Phase'):
+    """returns a list of BatchFrame for the image files in folder
+
+       Files with phase_tag in the name are phase images. Every other image
+       file (or only those with fluor_tag in the name, if given) is a
+       fluorescence image, paired with the phase file having the same name
+       with fluor_tag replaced by phase_tag, if it exists. Without fluor_tag,
+       the phase file is the one with the longest common prefix with the
+       fluorescence file (e.g. a_w1Phase.tif for a_w2GFP.tif), if there is one.
+    """
+
+    files = sorted(f for f in os.listdir(folder)
+                   if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS)
+    phase_names = []
+    if phase_tag is not None:
+        phase_names = [f for f in files if phase_tag in f]
+    frames = []
+    for fname in files:
+        if fname in phase_names:
+            continue
+        if fluor_tag is not None and fluor_tag not in fname:
+            continue
+        phase_name = None
+        if fluor_tag is not None and phase_tag is not None:
+            phase_name = fname.replace(fluor_tag, phase_tag)
+        elif fluor_tag is None:
+            phase_name = matching_phase(fname, phase_names)
+        phase_file = None
+        if phase_name in phase_names:
+            phase_file = os.path.join(folder, phase_name)
+        frames.append(BatchFrame(os.path.splitext(fname)[0], os.path.join(folder, fname), phase_file))
+    return unique_names(frames)
+
+
+def frames_from_manifest(filename):
+    """returns a list of BatchFrame from a manifest file
+
+       Each line has a fluorescence file and, optionally, a phase file,
+       separated by a comma. Relative paths are relative to the manifest
+       folder. Empty lines and lines starting with # are ignored.
+    """
+
+    folder = os.path.dirname(os.path.abspath(filename))
+    frames = []
+    manifest = open(filename)
+    for line in manifest:
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+        files = [os.path.join(folder, f.strip()) for f in line.split(',') if f.strip() != '']
+        phase_file = None
+        if len(files) > 1:
+            phase_file = files[1]
+        name = os.path.splitext(os.path.basename(files[0]))[0]
+        frames.append(BatchFrame(name, files[0], phase_file))
+    manifest.close()
+    return unique_names(frames)
+
+
+def read_json(filename):
+    """returns the dictionary stored in a json file, or {} if missing or unreadable"""
+
+    try:
+        fil = open(filename)
+        try:
+            return json.load(fil)
+        finally:
+            fil.close()
+    except (IOError, ValueError):
+        return {}
+
+
+def write_json(filename, data):
+    """writes a dictionary to a json file, replacing it only when complete"""
+
+    temp = filename + '.tmp'
+    fil = open(temp, 'w')
+    json.dump(data, fil, indent=1, sort_keys=True)
+    fil.close()
+    if os.path.exists(filename) and os.name == 'nt':
+        os.remove(filename)
+    os.rename(temp, filename)
+
+
+def file_record(filename, previous=None):
+    """returns a dictionary with path, size, modification time and sha1 of a file
+
+       The hash of previous (a record of an earlier run) is reused if path,
+       size and modification time did not change.
+    """
+
+    stat = os.stat(filename)
+    record = {'path': os.path.abspath(filename), 'size': stat.st_size, 'mtime': stat.st_mtime}
+    if previous is not None and all(previous.get(k) == record[k] for k in ('path', 'size', 'mtime')):
+        record['sha1'] = str(previous['sha1'])   # unicode from json, which would change the fingerprints
+        return record
+    sha1 = hashlib.sha1()
+    fil = open(filename, 'rb')
+    block = fil.read(HASH_BLOCK)
+    while block:
+        sha1.update(block)
+        block = fil.read(HASH_BLOCK)
+    fil.close()
+    record['sha1'] = sha1.hexdigest()
+    return record
+
+
+def attributes_fingerprint(obj, exclude=()):
+    """returns a string with the sorted attribute values of a parameters object,
+       without lists (the acceptable options) and the excluded attributes
+    """
+
+    items = [(k, v) for k, v in sorted(vars(obj).items())
+             if k not in exclude and type(v) is not list]
+    return repr(items)
+
+
+def stage_fingerprints(params, inputs):
+    """returns a dictionary with the fingerprint of each stage
+
+       Fingerprints are chained: each stage hashes the fingerprint of the
+       previous stage with what it depends on. Loading depends on the input
+       hashes and frame parameters (except file names, covered by the hashes),
+       masks on the mask parameters; align and overlay on nothing else.
+    """
+
+    fingerprints = {}
+    previous = ''
+    for stage in STAGES:
+        if stage == 'load':
+            data = repr(sorted((k, v['sha1']) for k, v in inputs.items()))
+            data += attributes_fingerprint(params.fluor_frame_params, ('fluor_file', 'phase_file'))
+        elif stage == 'mask':
+            data = attributes_fingerprint(params.mask_params)
+        else:
+            data = ''
+        previous = hashlib.sha1(previous + stage + data).hexdigest()
+        fingerprints[stage] = previous
+    return fingerprints
+
+
+def save_masks(filename, fluor_frame):
+    """saves the base and phase masks of a FluorFrame, bit-packed"""
+
+    shape, base = pack_mask(fluor_frame.base_mask.get_mask())
+    shape, phase = pack_mask(fluor_frame.phase_mask.get_mask())
+    np.savez(filename, shape=np.array(shape), base=base, phase=phase)
+
+
+def load_masks(filename, fluor_frame):
+    """loads the base and phase masks saved by save_masks into a FluorFrame"""
+
+    data = np.load(filename)
+    shape = tuple(data['shape'])
+    fluor_frame.base_mask.mask = unpack_mask((shape, data['base']))
+    fluor_frame.phase_mask.mask = unpack_mask((shape, data['phase']))
+    data.close()
+
+
+def process_frame(task):
+    """loads, masks, aligns and saves the overlay of one frame, skipping the
+       stages recorded as done with the same fingerprints in the frame manifest
+
+       task is a tuple (BatchFrame, Parameters, output folder)
+       returns a BatchResult; exceptions are recorded, not raised
+    """
+
+    frame, params, output_folder = task
+    result = BatchResult(frame.name)
+    start = time.time()
+    try:
+        folder = os.path.join(output_folder, frame.name)
+        if not os.path.exists(folder):
+            os.makedirs(folder)
+        manifest_file = os.path.join(folder, MANIFEST)
+        previous = read_json(manifest_file)
+        old_inputs = previous.get('inputs', {})
+        old_stages = previous.get('stages', {})
+
+        inputs = {'fluor': file_record(frame.fluor_file, old_inputs.get('fluor'))}
+        if frame.phase_file is not None:
+            inputs['phase'] = file_record(frame.phase_file, old_inputs.get('phase'))
+        fingerprints = stage_fingerprints(params, inputs)
+        # records of an earlier run are kept until replaced, so a run stopped
+        # partway through still leaves the valid stages for the next one
+        manifest = {'name': frame.name, 'inputs': inputs, 'stages': dict(old_stages)}
+
+        def reusable(stage):
+            record = old_stages.get(stage)
+            return record is not None and record.get('fingerprint') == fingerprints[stage] and \
+                all(os.path.exists(f) for f in record.get('outputs', {}).values())
+
+        def finish(stage, record):
+            record['fingerprint'] = fingerprints[stage]
+            manifest['stages'][stage] = record
+            result.stages.append(stage)
+            result.outputs.update(record.get('outputs', {}))
+            write_json(manifest_file, manifest)
+
+        if all(reusable(stage) for stage in STAGES[1:]):
+            for stage in STAGES:
+                if stage in old_stages:
+                    result.outputs.update(old_stages[stage].get('outputs', {}))
+            result.stages = list(STAGES)
+            result.reused = list(STAGES)
+            result.fluor_shift = tuple(old_stages['align']['fluor_shift'])
+            if manifest != previous:
+                write_json(manifest_file, manifest)
+            result.status = 'done'
+            result.elapsed = time.time() - start
+            return result
+
+        params = copy.deepcopy(params)
+        params.fluor_frame_params.fluor_file = frame.fluor_file
+        params.fluor_frame_params.phase_file = frame.phase_file
+        ehooke = EHooke(params)
+
+        ehooke.load_images()
+        finish('load', {})
+
+        masks_file = os.path.join(folder, 'masks.npz')
+        if reusable('mask'):
+            load_masks(masks_file, ehooke.fluor_frame)
+            result.reused.append('mask')
+        else:
+            ehooke.create_masks()
+            save_masks(masks_file, ehooke.fluor_frame)
+        finish('mask', {'outputs': {'mask': masks_file}})
+
+        if reusable('align'):
+            ehooke.fluor_frame.fluor_shift = tuple(old_stages['align']['fluor_shift'])
+            result.reused.append('align')
+        else:
+            ehooke.align_fluor_to_phase()
+        result.fluor_shift = ehooke.fluor_frame.fluor_shift
+        finish('align', {'fluor_shift': list(result.fluor_shift)})
+
+        overlay = os.path.join(folder, 'overlay.png')
+        if reusable('overlay'):
+            result.reused.append('overlay')
+        else:
+            ehooke.save_mask_overlay(overlay)
+        finish('overlay', {'outputs': {'overlay': overlay}})
+        result.status = 'done'
+    except Exception:
+        result.error = traceback.format_exc()
+    result.elapsed = time.time() - start
+    return result
+
+
+class Batch:
+    """Processes a list of frames with one parameters file in a process pool"""
+
+    def __init__(self, frames, param_file, output_folder, workers=None, memory_budget=None):
+        """frames is a list of BatchFrame (see frames_from_directory and
+           frames_from_manifest), param_file the parameters file for all frames
+
+           workers is the maximum number of worker processes (None for the
+           number of CPUs). memory_budget, in bytes, further limits the workers
+           so that the estimated memory of the largest frames fits the budget.
+        """
+
+        self.frames = frames
+        """list: BatchFrame objects to process"""
+        self.params = Parameters()
+        """Parameters: loaded from param_file, shared by all frames"""
+        self.params.load_parameters(param_file)
+        self.output_folder = output_folder
+        """str: folder for the output files, with one subfolder per frame"""
+        self.workers = workers
+        """int: maximum number of worker processes, None for the number of CPUs"""
+        self.memory_budget = memory_budget
+        """int: memory budget for all workers, in bytes, None for no limit"""
+        self.results = []
+        """list: BatchResult objects of the last run, in completion order"""
+
+    def worker_count(self):
+        """returns the number of worker processes allowed by workers and memory_budget"""
+
+        workers = self.workers
+        if workers is None:
+            workers = multiprocessing.cpu_count()
+        workers = min(workers, max(len(self.frames), 1))
+        if self.memory_budget is not None and len(self.frames) > 0:
+            largest = max(frame.memory_estimate() for frame in self.frames)
+            workers = min(workers, self.memory_budget // max(largest, 1))
+        return max(int(workers), 1)
+
+    def tasks(self):
+        """returns the list of tasks for process_frame"""
+
+        return [(frame, self.params, self.output_folder) for frame in self.frames]
+
+    def run(self, manifest_interval=30.0):
+        """processes all frames and returns the list of BatchResult
+
+           Frames and stages already done with the same inputs and parameters
+           are reused (see process_frame). The run manifest in the output
+           folder is updated at most every manifest_interval seconds and at
+           the end, and a summary.csv is written with one line per frame
+        """
+
+        if not os.path.exists(self.output_folder):
+            os.makedirs(self.output_folder)
+        self.results = []
+        workers = self.worker_count()
+        last_write = time.time()
+        if workers == 1:
+            results = (process_frame(task) for task in self.tasks())
+            pool = None
+        else:
+            # fresh processes after a few frames keep fragmented memory in check
+            pool = multiprocessing.Pool(workers, maxtasksperchild=10)
+            results = pool.imap_unordered(process_frame, self.tasks())
+        try:
+            for result in results:
+                self.results.append(result)
+                if time.time() - last_write > manifest_interval:
+                    self.write_manifest()
+                    last_write = time.time()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+            self.write_manifest()
+        self.write_summary()
+        return self.results
+
+    def write_manifest(self):
+        """writes the run manifest, with the status, stages and outputs of each
+           frame processed so far (the per frame manifests have the details)
+        """
+
+        manifest_file = os.path.join(self.output_folder, MANIFEST)
+        manifest = read_json(manifest_file)
+        frames = manifest.get('frames', {})
+        for result in self.results:
+            frames[result.name] = {'status': result.status,
+                                   'stages': result.stages,
+                                   'reused': result.reused,
+                                   'outputs': result.outputs,
+                                   'error': result.error}
+        manifest['frames'] = frames
+        write_json(manifest_file, manifest)
+
+    def write_summary(self):
+        """writes summary.csv with name, status, last stage and error of each frame"""
+
+        summary = open(os.path.join(self.output_folder, 'summary.csv'), 'w')
+        summary.write('name,status,stage,reused,elapsed,error\n')
+        for result in self.results:
+            stage = ''
+            if len(result.stages) > 0:
+                stage = result.stages[-1]
+            error = ''
+            if result.error is not None:
+                error = result.error.strip().split('\n')[-1].replace('"', "'")
+            summary.write('{0},{1},{2},{3},{4:.3f},"{5}"\n'.format(result.name, result.status, stage,
+                                                                   ' '.join(result.reused),
+                                                                   result.elapsed, error))
+        summary.close()
+
+
+if __name__ == '__main__':
+    import sys
+    if len(sys.argv) < 4:
+        print 'Usage: python batch.py parameters_file input_folder_or_manifest output_folder [workers [fluor_tag]]'
+        sys.exit(1)
+    batch_workers = None
+    if len(sys.argv) > 4:
+        batch_workers = int(sys.argv[4])
+    if os.path.isdir(sys.argv[2]):
+        batch_fluor_tag = None
+        if len(sys.argv) > 5:
+            batch_fluor_tag = sys.argv[5]
+        batch_frames = frames_from_directory(sys.argv[2], batch_fluor_tag)
+    else:
+        batch_frames = frames_from_manifest(sys.argv[2])
+    unpaired = [f.name for f in batch_frames if f.phase_file is None]
+    if len(unpaired) > 0:
+        print 'Warning:', len(unpaired), 'frames without phase file:', ', '.join(unpaired)
+    batch = Batch(batch_frames, sys.argv[1], sys.argv[3], batch_workers)
+    batch_results = batch.run()
+    failed = [r.name for r in batch_results if r.status != 'done']
+    skipped = [r.name for r in batch_results if len(r.reused) == len(STAGES)]
+    print len(batch_frames) - len(failed), 'frames done (', len(skipped), 'unchanged ),', len(failed), 'failed'
@@ -2,28 +2,296 @@
 
 Uses the regions defined by the segments.py and accert if they correspond to cells based on the parameters
 
+Cells are stored by column: ImageCells keeps one array per cell attribute
+and a single label image shared by all cells, and each cell's masks are
+read from its bounding box in the label image. Cell objects are views of
+one row, created when needed.
 """
 
+import numpy as np
+from scipy import ndimage
+from segments import relabel
+
+CELL_COLUMNS = [('area', np.int64), ('x', np.float64), ('y', np.float64),
+                ('eccentricity', np.float64), ('selected', np.bool_)]
+"""list: (name, type) of the columns created from the regions; other modules add their own"""
+
+REGION_VALUES = {'interior': 1, 'perimeter': 2, 'septum': 3}
+"""dict: value of each cell region in ImageCells.region_codes (0 is the background)"""
+
+FLUOR_PERCENTILES = (10, 25, 75, 90)
+"""tuple: percentiles of the fluorescence measured for each cell, besides the median"""
+
+
+def segment_percentiles(values, counts, percentiles):
+    """returns an array (len(percentiles), len(counts)) with the percentiles of each
+       segment of values, interpolated linearly as numpy.percentile
+
+       values must be sorted within each segment, and the segments (of counts
+       values each, none empty) follow each other in order
+    """
+
+    starts = np.cumsum(counts) - counts
+    res = np.empty((len(percentiles), len(counts)))
+    for row, percentile in enumerate(percentiles):
+        position = (counts - 1) * (percentile / 100.0)
+        low = np.floor(position).astype(np.intp)
+        fraction = position - low
+        high = np.minimum(low + 1, counts - 1)
+        res[row] = values[starts + low] * (1 - fraction) + values[starts + high] * fraction
+    return res
+
+
 class Cell:
-    """class used to store the attributes of every cell"""
+    """class used to store the attributes of every cell
 
-    def __init__(self):
+       A view of cell index of an ImageCells object: column values are read as
+       attributes (e.g. cell.area) and masks are computed from the shared label
+       image when requested, as arrays of the size of the cell bounding box
+    """
+
+    def __init__(self, cells, index):
+
+        self.cells = cells
+        """ImageCells: the cells this cell belongs to"""
+        self.index = index
+        """int: row of the cell in the columns of cells"""
+        self.label = index + 1
+        """int: value of the cell in cells.labels"""
 
-        self.cell_mask = None
-        self.perimeter_mask = None
-        self.septum_mask = None
+    def __getattr__(self, name):
+        """returns the value of the column name for this cell, or the mask for
+           cell_mask, perimeter_mask and septum_mask
+        """
+
+        if name in ('cell_mask', 'perimeter_mask', 'septum_mask'):
+            return getattr(self, 'compute_' + name)()
+        columns = self.__dict__['cells'].columns
+        if name in columns:
+            return columns[name][self.__dict__['index']]
+        raise AttributeError(name)
+
+    def box(self):
+        """returns the (x1, y1, x2, y2) bounding box of the cell in the label image"""
+
+        return tuple(self.cells.boxes[self.index])
 
     def compute_cell_mask(self):
-        pass
+        """returns the boolean mask of the cell within its bounding box"""
+
+        return self.cells.cell_mask(self.index)
 
     def compute_perimeter_mask(self):
-        pass
+        """returns the perimeter mask of the cell within its bounding box,
+           None if the cell regions were not computed
+        """
+
+        return self.cells.region_mask(self.index, 'perimeter')
 
     def compute_septum_mask(self):
-        pass
+        """returns the septum mask of the cell within its bounding box,
+           None if the cell regions were not computed
+        """
+
+        return self.cells.region_mask(self.index, 'septum')
+
 
 class ImageCells:
-    """class used to store every cell belonging to the image"""
+    """class used to store every cell belonging to the image
+
+       Columns are arrays with one value per cell, in label order (the cell
+       with label k is row k - 1); labels is the label image shared by all
+       cells and boxes their bounding boxes in it
+    """
 
     def __init__(self):
-        pass
+        self.labels = None
+        """ndarray: int32 image with the label of each cell, 0 for background"""
+        self.count = 0
+        """int: number of cells"""
+        self.boxes = np.zeros((0, 4), np.int32)
+        """ndarray: (count, 4) bounding boxes (x1, y1, x2, y2), x2 and y2 excluded"""
+        self.columns = {}
+        """dict: per cell arrays by column name"""
+        self.region_codes = None
+        """ndarray: uint8 image with the cell region (e.g. perimeter) of each pixel, None if not computed"""
+        self.region_values = {}
+        """dict: value of each cell region in region_codes, by region name"""
+
+    def from_regions(self, regions):
+        """sets the cells from a segments.ImageRegions object, sharing its label image"""
+
+        self.labels = regions.labels
+        self.count = regions.count
+        self.boxes = regions.boxes
+        self.columns = {}
+        for name, dtype in CELL_COLUMNS:
+            self.add_column(name, dtype)
+        self.columns['area'][:] = regions.areas
+        self.columns['x'][:] = regions.centroids[:, 0]
+        self.columns['y'][:] = regions.centroids[:, 1]
+        self.columns['eccentricity'][:] = regions.eccentricities
+        self.columns['selected'][:] = True
+        self.region_codes = None
+
+    def add_column(self, name, dtype=np.float64):
+        """returns the column name, creating it with zeros if it does not exist"""
+
+        if name not in self.columns:
+            self.columns[name] = np.zeros(self.count, dtype)
+        return self.columns[name]
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        """returns a Cell view of the cell index (label index + 1)"""
+
+        if index < 0:
+            index += self.count
+        if not 0 <= index < self.count:
+            raise IndexError(index)
+        return Cell(self, index)
+
+    def box_slices(self, index):
+        """returns the slices of the bounding box of cell index"""
+
+        x1, y1, x2, y2 = self.boxes[index]
+        return (slice(x1, x2), slice(y1, y2))
+
+    def cell_mask(self, index):
+        """returns the boolean mask of cell index within its bounding box"""
+
+        return self.labels[self.box_slices(index)] == index + 1
+
+    def region_mask(self, index, region):
+        """returns the boolean mask of a cell region (see region_values) of cell index
+           within its bounding box, None if the regions were not computed
+        """
+
+        if self.region_codes is None or region not in self.region_values:
+            return None
+        box = self.box_slices(index)
+        return (self.labels[box] == index + 1) & (self.region_codes[box] == self.region_values[region])
+
+    def filter(self, keep):
+        """keeps only the cells with keep True, relabelling the label image
+
+           The label image is replaced, not changed, so other objects sharing
+           the old one are not affected
+        """
+
+        keep = np.asarray(keep, np.bool_)
+        self.labels = relabel(self.labels, np.concatenate(([False], keep)))
+        self.count = np.count_nonzero(keep)
+        self.boxes = self.boxes[keep]
+        for name in self.columns:
+            self.columns[name] = self.columns[name][keep]
+        if self.region_codes is not None:
+            self.region_codes = np.where(self.labels > 0, self.region_codes, 0).astype(np.uint8)
+
+    def compute_regions(self, params):
+        """computes the perimeter and septum of all cells into region_codes, one
+           byte per pixel, and their areas into columns perimeter_area and
+           septum_area, with the orientation of the cells in column orientation
+
+           The perimeter are the pixels less than params.perimeter_width from the
+           edge of the cell (background or another cell), from one distance
+           transform of the pixels inside the cells. The septum are the other
+           pixels of the cell less than params.septum_width / 2 from the line
+           through the centroid across the major axis, found from the second
+           moments of all cells at once. params is an ImageProcessingParameters
+           object.
+        """
+
+        labels = self.labels
+        inside = labels > 0
+        # pixels whose 4 neighbours are in the same cell
+        inner = inside.copy()
+        same = labels[1:, :] == labels[:-1, :]
+        inner[1:, :] &= same
+        inner[:-1, :] &= same
+        same = labels[:, 1:] == labels[:, :-1]
+        inner[:, 1:] &= same
+        inner[:, :-1] &= same
+        same = None
+        distance = ndimage.distance_transform_edt(inner)
+        inner = None
+        codes = inside.astype(np.uint8)
+        codes[inside & (distance < params.perimeter_width)] = REGION_VALUES['perimeter']
+        distance = None
+
+        bins = self.count + 1
+        xs, ys = np.nonzero(inside)
+        cell = labels[xs, ys]
+        safe = np.maximum(np.bincount(cell, minlength=bins), 1)
+        xs = xs.astype(np.float64)
+        ys = ys.astype(np.float64)
+        dxs = xs - (np.bincount(cell, xs, bins) / safe)[cell]
+        dys = ys - (np.bincount(cell, ys, bins) / safe)[cell]
+        mu_xx = np.bincount(cell, dxs * dxs, bins)
+        mu_yy = np.bincount(cell, dys * dys, bins)
+        mu_xy = np.bincount(cell, dxs * dys, bins)
+        orientation = 0.5 * np.arctan2(2 * mu_xy, mu_xx - mu_yy)
+        along = dxs * np.cos(orientation)[cell] + dys * np.sin(orientation)[cell]
+        xs = xs.astype(np.intp)
+        ys = ys.astype(np.intp)
+        septum = (np.abs(along) <= params.septum_width / 2.0) & \
+                 (codes[xs, ys] == REGION_VALUES['interior'])
+        codes[xs[septum], ys[septum]] = REGION_VALUES['septum']
+
+        pixel_codes = codes[xs, ys]
+        self.add_column('orientation')[:] = orientation[1:]
+        self.add_column('perimeter_area', np.int64)[:] = \
+            np.bincount(cell[pixel_codes == REGION_VALUES['perimeter']], minlength=bins)[1:]
+        self.add_column('septum_area', np.int64)[:] = np.bincount(cell[septum], minlength=bins)[1:]
+        self.region_codes = codes
+        self.region_values = REGION_VALUES
+
+    def measure_fluorescence(self, fluor, baseline=0.0, percentiles=FLUOR_PERCENTILES):
+        """measures the fluorescence of every cell, above baseline, into columns
+           fluor_total, fluor_mean, fluor_median and fluor_p<percentile>
+
+           fluor is the fluorescence image aligned with the label image (e.g.
+           FluorFrame.fluor_clip()) and baseline a number or an array with the
+           baseline of each cell. The pixels of all cells are sorted once by
+           label and value, so medians and percentiles are read from each
+           segment of the sorted pixels without a loop over the cells.
+        """
+
+        xs, ys = np.nonzero(self.labels)
+        labels = self.labels[xs, ys]
+        values = fluor[xs, ys].astype(np.float64)
+        xs = ys = None
+        baseline = np.asarray(baseline, np.float64)
+        if baseline.ndim > 0:
+            values -= baseline[labels - 1]
+        else:
+            values -= baseline
+
+        counts = np.bincount(labels, minlength=self.count + 1)[1:]
+        totals = np.bincount(labels, values, self.count + 1)[1:]
+        order = np.lexsort((values, labels))
+        values = values[order]
+        order = labels = None
+
+        measured = counts > 0
+        self.add_column('fluor_total')[:] = totals
+        mean = self.add_column('fluor_mean')
+        mean[:] = np.nan
+        mean[measured] = totals[measured] / counts[measured]
+        names = ['fluor_median'] + ['fluor_p%g' % p for p in percentiles]
+        results = segment_percentiles(values, counts[measured], (50,) + tuple(percentiles))
+        for name, result in zip(names, results):
+            column = self.add_column(name)
+            column[:] = np.nan
+            column[measured] = result
+
+    def nbytes(self):
+        """returns the memory used by the columns and the shared images, in bytes"""
+
+        total = self.boxes.nbytes + sum(column.nbytes for column in self.columns.values())
+        for image in (self.labels, self.region_codes):
+            if image is not None:
+                total += image.nbytes
+        return total
@@ -1 +1,234 @@
-"""placeholder"""
+"""Module used to load images lazily from uncompressed TIFF files
+
+   The pixel data of uncompressed TIFF strips or tiles is memory mapped, so a
+   region of the image can be read without reading (or converting) the rest
+   of the file. Compressed and BigTIFF files are not supported here and
+   should be loaded with skimage.io.imread.
+"""
+
+import struct
+import numpy as np
+from skimage.io import MultiImage
+
+TIFF_TYPES = {1: 'B', 2: 'c', 3: 'H', 4: 'I', 6: 'b', 8: 'h', 9: 'i', 11: 'f', 12: 'd'}
+"""dict: struct format character for each TIFF field type"""
+
+SAMPLE_FORMATS = {1: 'u', 2: 'i', 3: 'f'}
+"""dict: numpy type kind for each TIFF SampleFormat value"""
+
+
+class TiffPage:
+    """One image (IFD) of a TIFF file, with the layout of its pixel data"""
+
+    def __init__(self, data, tags, byteorder):
+        """data is the memory mapped file, tags a dictionary of tag: list of values"""
+
+        self.data = data
+        """ndarray: memory mapped file contents (uint8)"""
+        self.height = tags[257][0]
+        """int: number of rows"""
+        self.width = tags[256][0]
+        """int: number of columns"""
+        self.samples = tags.get(277, [1])[0]
+        """int: samples per pixel (1 for grayscale, 3 for RGB)"""
+        self.bits = tags.get(258, [1])[0]
+        """int: bits per sample"""
+        self.dtype = None
+        """numpy.dtype: type of each sample, with the file byte order (None if not 8 to 64 bits)"""
+        if self.bits in (8, 16, 32, 64):
+            kind = SAMPLE_FORMATS.get(tags.get(339, [1])[0], 'u')
+            self.dtype = np.dtype(byteorder + kind + str(self.bits // 8))
+        self.compression = tags.get(259, [1])[0]
+        """int: TIFF compression, 1 for uncompressed"""
+        self.planar = tags.get(284, [1])[0]
+        """int: TIFF planar configuration, 1 for interleaved samples"""
+        self.shape = (self.height, self.width)
+        """tuple: (rows, columns) or (rows, columns, samples)"""
+        if self.samples > 1:
+            self.shape = (self.height, self.width, self.samples)
+
+        if 322 in tags:
+            self.block_height = tags[323][0]
+            self.block_width = tags[322][0]
+            self.offsets = tags[324]
+        else:
+            self.block_height = min(tags.get(278, [self.height])[0], self.height)
+            self.block_width = self.width
+            self.offsets = tags[273]
+        """int, int, list: rows and columns of each strip or tile, and their offsets"""
+        self.blocks_across = -(-self.width // self.block_width)
+        """int: number of tiles in each row of tiles (1 for strips)"""
+
+    def is_mappable(self):
+        """returns True if the pixel data can be read directly from the file"""
+
+        return self.compression == 1 and self.dtype is not None and \
+            (self.samples == 1 or self.planar == 1)
+
+    def block(self, index):
+        """returns a view of strip or tile index as a (rows, columns, samples) array"""
+
+        size = self.block_height * self.block_width * self.samples * self.dtype.itemsize
+        start = self.offsets[index]
+        raw = self.data[start:start+size]
+        rows = len(raw) // (self.block_width * self.samples * self.dtype.itemsize)
+        count = rows * self.block_width * self.samples * self.dtype.itemsize
+        return raw[:count].view(self.dtype).reshape(rows, self.block_width, self.samples)
+
+    def read_region(self, x1, y1, x2, y2):
+        """returns a copy of rows x1:x2 and columns y1:y2, in native byte order
+
+           Only the strips or tiles overlapping the region are read.
+        """
+
+        x1, x2 = max(x1, 0), min(x2, self.height)
+        y1, y2 = max(y1, 0), min(y2, self.width)
+        res = np.empty((max(x2-x1, 0), max(y2-y1, 0), self.samples), self.dtype.newbyteorder('='))
+        if x2 > x1 and y2 > y1:
+            bh, bw = self.block_height, self.block_width
+            for brow in range(x1 // bh, (x2 - 1) // bh + 1):
+                for bcol in range(y1 // bw, (y2 - 1) // bw + 1):
+                    block = self.block(brow * self.blocks_across + bcol)
+                    r1, c1 = brow * bh, bcol * bw
+                    sx1, sx2 = max(x1, r1), min(x2, r1 + block.shape[0])
+                    sy1, sy2 = max(y1, c1), min(y2, c1 + bw)
+                    res[sx1-x1:sx2-x1, sy1-y1:sy2-y1] = block[sx1-r1:sx2-r1, sy1-c1:sy2-c1]
+        if self.samples == 1:
+            return res[:, :, 0]
+        return res
+
+
+class TiffFile:
+    """Memory mapped TIFF file, with the list of its pages"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        """str: file name, including path"""
+        self.data = np.memmap(filename, dtype=np.uint8, mode='r')
+        """ndarray: memory mapped file contents"""
+        self.pages = []
+        """list: TiffPage objects, in file order"""
+
+        header = self.data[:8].tostring()
+        self.byteorder = '<'
+        """str: '<' for little endian ('II') files, '>' for big endian ('MM')"""
+        if header[:2] == 'MM':
+            self.byteorder = '>'
+        elif header[:2] != 'II':
+            raise ValueError('Not a TIFF file: ' + filename)
+        magic, offset = struct.unpack(self.byteorder + 'HI', header[2:8])
+        if magic != 42:
+            raise ValueError('Not a classic TIFF file: ' + filename)
+
+        visited = set()
+        while offset != 0 and offset not in visited:
+            visited.add(offset)
+            tags, offset = self.read_ifd(offset)
+            self.pages.append(TiffPage(self.data, tags, self.byteorder))
+
+    def read_ifd(self, offset):
+        """returns (tags, next IFD offset) for the IFD at offset"""
+
+        order = self.byteorder
+        count = struct.unpack(order + 'H', self.data[offset:offset+2].tostring())[0]
+        tags = {}
+        for entry in range(count):
+            start = offset + 2 + 12 * entry
+            tag, ftype, n = struct.unpack(order + 'HHI', self.data[start:start+8].tostring())
+            fmt = TIFF_TYPES.get(ftype)
+            if fmt is None:
+                continue
+            size = struct.calcsize(fmt) * n
+            if size <= 4:
+                raw = self.data[start+8:start+8+size].tostring()
+            else:
+                pointer = struct.unpack(order + 'I', self.data[start+8:start+12].tostring())[0]
+                raw = self.data[pointer:pointer+size].tostring()
+            tags[tag] = list(struct.unpack(order + fmt * n, raw))
+        start = offset + 2 + 12 * count
+        next_offset = struct.unpack(order + 'I', self.data[start:start+4].tostring())[0]
+        return (tags, next_offset)
+
+
+def open_mappable(filename, page=0):
+    """returns the TiffPage of filename if it can be read lazily, None otherwise"""
+
+    try:
+        tiff = TiffFile(filename)
+    except (ValueError, IOError, struct.error):
+        return None
+    if page >= len(tiff.pages) or not tiff.pages[page].is_mappable():
+        return None
+    return tiff.pages[page]
+
+
+def iter_pages(filename):
+    """generator of the pages of a (multi page) image file, as arrays, one at a time
+
+       Uncompressed TIFF pages are read from the memory mapped file, other
+       files with skimage.io.MultiImage, which also loads one page at a time
+    """
+
+    try:
+        tiff = TiffFile(filename)
+    except (ValueError, IOError, struct.error):
+        tiff = None
+    if tiff is not None and all(page.is_mappable() for page in tiff.pages):
+        for page in tiff.pages:
+            yield page.read_region(0, 0, page.height, page.width)
+    else:
+        stack = MultiImage(filename)
+        for index in range(len(stack)):
+            yield stack[index]
+
+
+class LazyImage:
+    """A 2D image read from a TiffPage only when regions are requested
+
+    Slicing a LazyImage, e.g. image[x1:x2, y1:y2], reads the strips or tiles
+    of that region and applies convert (e.g. conversion to float and
+    grayscale) to the region only. The last region converted is kept, and
+    slices inside it are served from it; prefetch sets that region.
+    """
+
+    def __init__(self, page, convert=None):
+        self.page = page
+        """TiffPage: source of the pixel data"""
+        self.convert = convert
+        """function: applied to each region read, None for no conversion"""
+        self.shape = page.shape[:2]
+        """tuple: (rows, columns)"""
+        self.ndim = 2
+        """int: number of dimensions, as for ndarray"""
+        self.region = None
+        """tuple: (x1, y1, x2, y2) of the cached region"""
+        self.cache = None
+        """ndarray: the cached region, converted"""
+
+    def prefetch(self, x1, y1, x2, y2):
+        """reads and converts a region, keeping it for the following slices"""
+
+        x1, x2 = max(x1, 0), min(x2, self.shape[0])
+        y1, y2 = max(y1, 0), min(y2, self.shape[1])
+        res = self.page.read_region(x1, y1, x2, y2)
+        if self.convert is not None:
+            res = self.convert(res)
+        self.region = (x1, y1, x2, y2)
+        self.cache = res
+        return res
+
+    def __getitem__(self, key):
+        """returns a converted region for a pair of slices with step 1;
+           any other key is applied to the whole converted image
+        """
+
+        if type(key) is tuple and len(key) == 2 and \
+           all(type(k) is slice and k.step in (None, 1) for k in key):
+            x1, x2, _ = key[0].indices(self.shape[0])
+            y1, y2, _ = key[1].indices(self.shape[1])
+            if self.region is not None:
+                cx1, cy1, cx2, cy2 = self.region
+                if cx1 <= x1 and x2 <= cx2 and cy1 <= y1 and y2 <= cy2:
+                    return self.cache[x1-cx1:x2-cx1, y1-cy1:y2-cy1]
+            return self.prefetch(x1, y1, x2, y2)
+        return self.prefetch(0, 0, self.shape[0], self.shape[1])[key]
@@ -1,8 +1,53 @@
 """Main module of the software, used to run the program"""
 
-from masks import Mask,FluorFrame
+from masks import Mask,FluorFrame,MaskPipeline,mask_statistics,mask_thumbnail
+from masks import contours_json, contours_svg
 from params import Parameters
+from segments import ImageRegions
+from cells import ImageCells
 from skimage.io import imsave, imread
+import multiprocessing
+import os
+import copy
+import numpy as np
+
+
+SWEEP_FIELDS = [('index', np.int32), ('threshold', np.float64), ('coverage', np.float64),
+                ('components', np.int32), ('mean_area', np.float64)]
+"""list: fields of the table returned by EHooke.sweep_mask_parameters"""
+
+sweep_state = {}
+"""dict: image, image key, histogram and mask pipeline of a sweep worker process"""
+
+
+def sweep_init(image, image_key, histogram):
+    """sets up the shared data of a sweep worker process"""
+
+    sweep_state['image'] = image
+    sweep_state['key'] = image_key
+    sweep_state['histogram'] = histogram
+    sweep_state['pipeline'] = MaskPipeline()
+
+
+def sweep_group(task):
+    """computes the masks for a group of MaskParameters with the same threshold stage
+
+       task is a tuple (list of (index, MaskParameters), thumbnail size or 0)
+       returns a list of (index, threshold, statistics, thumbnail or None)
+    """
+
+    group, thumbnail = task
+    pipeline = sweep_state['pipeline']
+    histogram = sweep_state['histogram']
+    res = []
+    for index, mparams in group:
+        mask = pipeline.run(sweep_state['image'], sweep_state['key'], mparams,
+                            'dilation', lambda: histogram)['dilation']
+        thumb = None
+        if thumbnail > 0:
+            thumb = mask_thumbnail(mask, thumbnail)
+        res.append((index, mparams.absolute_threshold, mask_statistics(mask), thumb))
+    return res
 
 class EHooke:
     """Encapsulates all the code for processing a fluorescence frame"""
@@ -28,6 +73,10 @@ class EHooke:
             
         self.fluor_frame = FluorFrame()
         """FluorFrame: manager for the fluor and phase images, plus masks"""
+        self.image_regions = None
+        """ImageRegions: regions of the phase mask, set by compute_regions"""
+        self.image_cells = None
+        """ImageCells: cells of the frame, set by compute_cells"""
 
     def load_images(self):
         """checks which images to load and loads them into the fluor_frame
@@ -40,17 +89,155 @@ class EHooke:
             self.fluor_frame.load_phase(ffparams)
 
     def create_masks(self):
-        """creates masks using the current parameters"""
+        """creates masks using the current parameters
+
+           returns a list of (stage, True if the cached result was reused)
+        """
         
         mparams = self.params.mask_params
         self.fluor_frame.create_masks(mparams)
+        # regions and cells of the previous masks are no longer valid
+        self.image_regions = None
+        self.image_cells = None
+        return self.fluor_frame.mask_pipeline.last_run
+
+    def compute_regions(self):
+        """finds the regions of the phase mask (create_masks must be called first)"""
+
+        self.image_regions = ImageRegions()
+        self.image_regions.find_regions(self.fluor_frame.phase_mask.get_mask(),
+                                        self.params.imageprocessingparams)
+        return self.image_regions
+
+    def compute_cells(self):
+        """creates the cells from the regions, computing the regions if needed, with
+           the perimeter and septum of each cell"""
+
+        if self.image_regions is None:
+            self.compute_regions()
+        self.image_cells = ImageCells()
+        self.image_cells.from_regions(self.image_regions)
+        self.image_cells.compute_regions(self.params.imageprocessingparams)
+        return self.image_cells
+
+    def measure_cells(self):
+        """measures the fluorescence of each cell above its own baseline (column
+           baseline, see FluorFrame.compute_fluor_baseline) into the cell columns
+           (see ImageCells.measure_fluorescence), computing the cells if needed
+        """
+
+        if self.image_cells is None:
+            self.compute_cells()
+        cells = self.image_cells
+        baselines = self.fluor_frame.compute_fluor_baseline(self.params.fluor_frame_params,
+                                                            cells.labels, cells.count)
+        cells.add_column('baseline')[:] = baselines
+        cells.measure_fluorescence(self.fluor_frame.fluor_clip(), baselines)
+        return cells
+
+    def report_cells(self, report, frame=''):
+        """appends the columns of the cells to a reports.Report, with the frame
+           name in column frame, measuring the cells if needed
+        """
+
+        if self.image_cells is None or 'fluor_mean' not in self.image_cells.columns:
+            self.measure_cells()
+        if self.image_cells.count > 0:
+            report.append(self.image_cells.columns, frame=frame)
+
+    def threshold_coverage(self, thresholds):
+        """returns the fraction of the frame in the mask for each absolute threshold
+           (before closing and dilation), computed from the cached image histogram
+        """
+
+        return self.fluor_frame.threshold_coverage(thresholds, self.params.mask_params.invert)
+
+    def sweep_mask_parameters(self, mask_params_list, processes=None, thumbnail=0):
+        """computes the phase mask for each MaskParameters in the list (see
+           params.parameter_grid) on the loaded frame, in a pool of processes
+
+           Parameters with the same threshold stage are grouped and sorted by
+           the later stages, so the thresholded base mask (and any other shared
+           stage) is reused within a group. Groups larger than an even share of
+           the parameters per process are split into sorted chunks, so a grid
+           at a fixed threshold still runs in all processes.
+           processes is the number of worker processes (None for the number
+           of CPUs, 1 to run in this process). The parameters objects are not
+           changed.
+
+           returns (table, thumbnails): table is a numpy record array with the
+           fields in SWEEP_FIELDS, one row per parameters object, in order;
+           thumbnails is a list of uint8 mask images at most thumbnail pixels
+           wide, or None if thumbnail is 0
+        """
+
+        image, image_key = self.fluor_frame.mask_source()
+        histogram = self.fluor_frame.get_histogram()
+
+        pipeline = MaskPipeline()
+        groups = {}
+        for index, mparams in enumerate(mask_params_list):
+            key = pipeline.stage_key('threshold', mparams)
+            order = tuple(pipeline.stage_key(stage, mparams) for stage in pipeline.stages[1:])
+            groups.setdefault(key, []).append((order, index, copy.deepcopy(mparams)))
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        chunk = max(1, -(-len(mask_params_list) // processes))
+        tasks = []
+        for key in groups.keys():
+            group = sorted(groups[key], key=lambda item: item[:2])
+            group = [(index, mparams) for order, index, mparams in group]
+            for start in range(0, len(group), chunk):
+                tasks.append((group[start:start+chunk], thumbnail))
+
+        if processes == 1:
+            sweep_init(image, image_key, histogram)
+            results = map(sweep_group, tasks)
+        else:
+            pool = multiprocessing.Pool(processes, sweep_init, (image, image_key, histogram))
+            try:
+                results = pool.map(sweep_group, tasks)
+            finally:
+                pool.close()
+                pool.join()
+
+        table = np.zeros(len(mask_params_list), dtype=SWEEP_FIELDS)
+        thumbnails = None
+        if thumbnail > 0:
+            thumbnails = [None] * len(mask_params_list)
+        for group in results:
+            for index, threshold, stats, thumb in group:
+                coverage, components, mean_area = stats
+                table[index] = (index, threshold, coverage, components, mean_area)
+                if thumbnails is not None:
+                    thumbnails[index] = thumb
+        return (table.view(np.recarray), thumbnails)
 
     def align_fluor_to_phase(self):
         """aligns the fluorescence image to the phase mask, if a phase file exists"""
-        
+
+        ffparams = self.params.fluor_frame_params
         if ffparams.phase_file is not None:
-            self.fluor_frame.align_fluor(self.params.fluor_frame_params)
+            self.fluor_frame.align_fluor(ffparams)
+
+
+    def process_stack(self):
+        """generator that processes a multi page (time-lapse or z-stack) file one
+           frame at a time, yielding the frame index
 
+           For each frame, fluor_frame holds the images, masks and alignment
+           until the next frame is loaded (see FluorFrame.stream_stack). The
+           alignment of each frame starts from the offset of the previous one.
+        """
+
+        ffparams = self.params.fluor_frame_params
+        seed = None
+        for index in self.fluor_frame.stream_stack(ffparams):
+            self.create_masks()
+            if self.fluor_frame.phase_image is not None:
+                self.fluor_frame.align_fluor(ffparams, seed)
+                seed = self.fluor_frame.fluor_shift
+            yield index
 
     def save_mask_overlay(self, fname, back=(0,0,1), fore=(1,1,0), mask='phase',image='phase'):
         """saves the mask overlay image to a file"""    
@@ -58,10 +245,39 @@ class EHooke:
         img = self.fluor_frame.mask_overlay(back, fore, mask,image)
         imsave(fname,img)
 
-    def save_mask_contour(self, fname, mask='phase',image='phase', color=(1,1,0)):
-        """saves the mask contour image to a file"""    
+    def save_mask_contour(self, fname, mask='phase',image='phase', color=(1,1,0), tolerance=0.5):
+        """saves the mask contour image to a file
 
+           If fname ends in .json or .svg, saves only the contour polylines (see
+           masks.contours_json and masks.contours_svg), to draw over the image
+        """
+
+        extension = os.path.splitext(fname)[1].lower()
+        if extension in ('.json', '.svg'):
+            contours, shape = self.fluor_frame.mask_contours(mask, tolerance)
+            if extension == '.json':
+                text = contours_json(contours, shape)
+            else:
+                text = contours_svg(contours, shape, color)
+            fil = open(fname, 'w')
+            fil.write(text)
+            fil.close()
+            return
         img = self.fluor_frame.contour_overlay(mask,image,color)
         imsave(fname,img)
 
+    def save_image(self, fname, image='phase'):
+        """saves the clip region of the image ('phase' or 'fluor') in 8 bit grayscale,
+           the background for contours saved with save_mask_contour
+        """
+
+        if image == 'phase' and self.fluor_frame.phase_image is not None:
+            x1, y1, x2, y2 = self.fluor_frame.clip
+            img = self.fluor_frame.phase_image[x1:x2, y1:y2]
+        else:
+            img = self.fluor_frame.fluor_clip()
+        low, high = np.min(img), np.max(img)
+        img = (img - low) * (255.0 / max(high - low, 1e-12))
+        imsave(fname, np.round(img).astype(np.uint8))
+
 
@@ -11,21 +11,202 @@ from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
 from SocketServer import ThreadingMixIn
 import urlparse
 import threading
+import Queue
+import collections
 import uuid
 import os
 import string
 import re
+import json
+import time
+import traceback
+import copy
+import functools
 from htmlconstants import *
 from params import Parameters, MaskParameters, FluorFrameParameters
-from ehooke import EHooke
+from ehworker import WorkerPool, open_shared
+from masks import mask_statistics
+import multiprocessing
 from skimage.io import imsave, imread
 
+JOB_WORKERS = multiprocessing.cpu_count()
+"""int: number of threads running session jobs (mask computations etc.), one per worker process"""
+
+MAX_FINISHED_JOBS = 1000
+"""int: number of finished jobs whose status is kept"""
+
+MAX_QUEUED_JOBS = 100
+"""int: number of jobs waiting for a worker; further submissions are rejected"""
+
+SESSION_IDLE_TIME = 3600
+"""int: seconds without requests after which the EHooke of a session is closed, freeing
+   its worker process memory (it is started again by the next computation)"""
+
+
+class Job:
+    """A computation for a session, run by a JobQueue worker"""
+
+    def __init__(self, session_id, function, description='', fingerprint=None):
+        self.id = str(uuid.uuid4())
+        """str: unique identifier of the job"""
+        self.session_id = session_id
+        """str: id of the session the job belongs to"""
+        self.function = function
+        """function: called without arguments, returns (True, '') or (False, error message)"""
+        self.description = description
+        """str: what the job does, for the status; jobs of a session with the same
+                description are coalesced (see JobQueue.submit)"""
+        self.fingerprint = fingerprint
+        """str: identifies the parameters of the job, None if it cannot be shared"""
+        self.status = 'queued'
+        """str: 'queued', 'running', 'done' or 'failed'"""
+        self.message = ''
+        """str: error message if the job failed"""
+        self.created = time.time()
+        """float: time the job was submitted"""
+        self.finished = None
+        """float: time the job finished, None if not finished"""
+
+    def status_dict(self):
+        """returns a dictionary with the job status, to send as JSON"""
+
+        return {'id': self.id, 'status': self.status, 'message': self.message,
+                'description': self.description}
+
+
+class JobQueue:
+    """Runs session jobs in a fixed number of worker threads, so requests
+       return at once with the job id instead of waiting for the computation
+
+       Jobs of a session run one at a time, in order, and jobs of different
+       sessions in parallel: workers take sessions, not jobs, from the queue,
+       and a session is only queued while it has jobs and none is running, so
+       no worker waits for a busy session.
+    """
+
+    def __init__(self, workers=JOB_WORKERS, max_queued=MAX_QUEUED_JOBS):
+        self.ready = Queue.Queue()
+        """Queue: ids of the sessions with queued jobs and no job running"""
+        self.pending = {}
+        """dict: deque of the queued jobs of each session, by session id (no empty deques)"""
+        self.running = {}
+        """dict: job running for each session, by session id"""
+        self.max_queued = max_queued
+        """int: maximum number of queued jobs, for all sessions"""
+        self.queued = 0
+        """int: number of queued jobs"""
+        self.jobs = {}
+        """dict: jobs by id, queued, running and recently finished"""
+        self.lock = threading.Lock()
+        """Lock: protects the job attributes and all the above but ready"""
+        self.workers = []
+        """list: worker threads"""
+        for index in range(workers):
+            worker = threading.Thread(target=self.work, name='job worker %d' % index)
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, session_id, function, description='', fingerprint=None):
+        """queues a job calling function for the session, returns the Job, or None
+           if the queue is full
+
+           Requests are coalesced with the jobs of the session with the same
+           description: a queued job is superseded, taking the new function
+           and fingerprint (so its requesters get the newer result), and if
+           none is queued a running job with the same fingerprint is shared.
+        """
+
+        with self.lock:
+            for job in self.pending.get(session_id, ()):
+                if job.description == description:
+                    job.function = function
+                    job.fingerprint = fingerprint
+                    return job
+            job = self.running.get(session_id)
+            if job is not None and job.description == description and \
+               fingerprint is not None and job.fingerprint == fingerprint:
+                return job
+            if self.queued >= self.max_queued:
+                return None
+            job = Job(session_id, function, description, fingerprint)
+            self.jobs[job.id] = job
+            self.queued += 1
+            self.prune()
+            if session_id not in self.pending:
+                self.pending[session_id] = collections.deque()
+                if session_id not in self.running:
+                    self.ready.put(session_id)
+            self.pending[session_id].append(job)
+        return job
+
+    def prune(self):
+        """forgets the oldest finished jobs beyond MAX_FINISHED_JOBS (call with lock held)"""
+
+        finished = [job for job in self.jobs.values() if job.finished is not None]
+        if len(finished) > MAX_FINISHED_JOBS:
+            finished.sort(key=lambda job: job.finished)
+            for job in finished[:len(finished) - MAX_FINISHED_JOBS]:
+                del self.jobs[job.id]
+
+    def get_job(self, job_id):
+        """returns the Job with job_id, or None"""
+
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def job_status(self, session_id, job_id):
+        """returns the status dictionary of a job of the session (see Job.status_dict),
+           with status 'unknown' if there is no such job or it belongs to another session
+        """
+
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.session_id != session_id:
+                return {'id': None, 'status': 'unknown', 'message': 'No such job', 'description': ''}
+            return job.status_dict()
+
+    def work(self):
+        """worker thread loop: runs the next job of each session taken from the
+           queue, recording its status, and queues the session again if it has
+           more jobs
+        """
+
+        while True:
+            session_id = self.ready.get()
+            with self.lock:
+                # the function cannot be superseded once running
+                pending = self.pending[session_id]
+                job = pending.popleft()
+                if len(pending) == 0:
+                    del self.pending[session_id]
+                self.queued -= 1
+                self.running[session_id] = job
+                job.status = 'running'
+                function = job.function
+            try:
+                res, msg = function()
+            except Exception:
+                res, msg = (False, traceback.format_exc())
+            with self.lock:
+                job.message = msg
+                if res:
+                    job.status = 'done'
+                else:
+                    job.status = 'failed'
+                job.finished = time.time()
+                del self.running[session_id]
+                if session_id in self.pending:
+                    self.ready.put(session_id)
+            self.ready.task_done()
+
     
 class Session:
     """eHooke session
 
        This class manages the folder with data and report files (in the server path)
-       and a EHooke instance for running the computations
+       and a EHooke instance for running the computations, kept in a worker
+       process (see ehworker)
     """
     
     def __init__(self):        
@@ -50,14 +231,24 @@ class Session:
 
         self.mask_image = None
         """str: filename for the current mask image, none if no mask is computed"""
+        self.contours_file = None
+        """str: filename for the current mask contours (JSON), none if no mask is computed"""
+        self.base_image = None
+        """str: filename for the grayscale image under the contours, saved once on start"""
+
+        self.started = False
+        """bool: True once the EHooke of the session was started in its worker process"""
+        self.shared = {}
+        """dict: descriptors of the arrays shared by the worker process ('mask'),
+                 to map with ehworker.open_shared"""
+        self.lock = threading.Lock()
+        """Lock: protects the parameters, started, shared and the file names, changed
+                 by the jobs of the session and read by the http handler threads; held
+                 only briefly, never during a computation (the JobQueue runs the jobs
+                 of a session one at a time)"""
+        self.last_access = time.time()
+        """float: time of the last request for this session (see SessionManager.idle_sessions)"""
 
-        
-        self.ehooke = None
-        """EHooke: to be initialized upon starting the session (only with images and parameters"""
-        #TODO change this to work with multiprocessing
-        #<LK 2015-06-30>
-
-        
 
     def setup(self):
         """creates session folder (add other setup stuff here)"""
@@ -103,36 +294,122 @@ class Session:
             self.params.fluor_frame_params.phase_file = self.phase_file
             self.params.save_parameters(file_name)
     
-    def start_ehooke(self):
+    def parameters_snapshot(self):
+        """returns (copy of the parameters, fingerprint string of their values), so a
+           job uses the parameters at the time of the request
+        """
+
+        with self.lock:
+            params = copy.deepcopy(self.params)
+        parts = []
+        for obj in (params.mask_params, params.fluor_frame_params, params.imageprocessingparams):
+            parts.append(sorted((k, v) for k, v in vars(obj).items() if type(v) is not list))
+        return (params, repr(parts))
+
+    def start_ehooke(self, params=None):
         """Initiates the ehooke process and loads images
 
            if there is no fluorescence image specified, returns false and error message
            otherwise returns true,''
 
-           if ehooke is not none does nothing and returns ok
+           if ehooke is already started does nothing and returns ok
+           Starting also computes the masks and saves the base image and contours
         """
-        if self.ehooke is not None:
-            return (True,'')
+        with self.lock:
+            if self.started:
+                return (True,'')
+            if self.fluor_file is None:
+                return (False,'Cannot start eHooke without a fluorescence image')
+        if params is None:
+            params = self.parameters_snapshot()[0]
+        res,msg,shared = self.call_worker('start', params, self.folder)
+        if res:
+            with self.lock:
+                self.started = True
+                self.shared.update(shared)
+                self.base_image = self.folder+'/base.png'
+                self.contours_file = self.folder+'/contours.json'
+        return (res,msg)
+
 
-        if self.fluor_file is None:
-            return (False,'Cannot start eHooke without a fluorescence image')
-        self.ehooke = EHooke(self.params)
-        self.ehooke.load_images()
-        return (True,'')
+    def call_worker(self, command, *args):
+        """runs a command of the session in its worker process (see ehworker.WorkerPool.call)
 
+           If the worker process stopped, the session is marked as not started,
+           so the next computation starts it again
+        """
+
+        pool = get_worker_pool()
+        res,msg,shared = pool.call(self.id, command, *args)
+        if not res and not pool.has_session(self.id):
+            with self.lock:
+                self.started = False
+                self.shared = {}
+        return (res,msg,shared)
+
+    def close(self):
+        """discards the EHooke of the session in its worker process; the files and
+           parameters are kept and the next computation starts it again
+        """
+
+        with self.lock:
+            if not self.started:
+                return (True,'')
+        res,msg,shared = get_worker_pool().call(self.id, 'close')
+        with self.lock:
+            self.started = False
+            self.shared = {}
+        return (res,msg)
 
     def save_overlay(self, back=(1,1,1), fore=(0,1,1), mask='phase',image='phase'):
         """saves the overlay image to overlay.png"""
         
-        self.ehooke.save_mask_overlay(self.folder+'/overlay.png',back, fore, mask,image)    
-        self.mask_image = self.folder+'/overlay.png'
+        res,msg,shared = self.call_worker('overlay', self.folder+'/overlay.png',
+                                          back, fore, mask, image)
+        if res:
+            with self.lock:
+                self.mask_image = self.folder+'/overlay.png'
+        return (res,msg)
         
-    def recompute_mask(self):
-        res,msg = self.start_ehooke()
+    def recompute_mask(self, params=None):
+        """recomputes the masks with params (the current parameters if None), saves
+           the contours and refreshes the mask overlay
+        """
+
+        if params is None:
+            params = self.parameters_snapshot()[0]
+        with self.lock:
+            started = self.started
+        if not started:
+            return self.start(params)
+        res,msg,shared = self.call_worker('masks', params, self.folder)
+        if res:
+            with self.lock:
+                self.shared.update(shared)
+                self.contours_file = self.folder+'/contours.json'
+            res,msg = self.save_overlay()
+        return (res,msg)
+
+    def start(self, params=None):
+        """starts ehooke and saves the mask overlay, returning (True, '') or (False, message)"""
+
+        res,msg = self.start_ehooke(params)
         if res:
-            self.ehooke.create_masks()
-            self.save_overlay()
+            res,msg = self.save_overlay()
         return (res,msg)
+
+    def mask_statistics(self):
+        """returns a dictionary with coverage, components and mean_area of the phase
+           mask, read from the memory mapped mask shared by the worker; None if
+           there is no mask
+        """
+
+        with self.lock:
+            descriptor = self.shared.get('mask')
+        if descriptor is None:
+            return None
+        coverage, count, mean_area = mask_statistics(open_shared(descriptor))
+        return {'coverage': coverage, 'components': count, 'mean_area': mean_area}
         
         
             
@@ -144,25 +421,38 @@ class SessionManager:
     def __init__(self):
         self.sessions={}        
         """dict: dictionary with each session by session ID"""
+        self.lock = threading.Lock()
+        """Lock: protects sessions, used by all http handler threads"""
 
     def is_valid(self, session_id):
         """Returns True if the session_id is valid, False otherwise"""
         
-        return session_id in self.sessions.keys()
+        with self.lock:
+            return session_id in self.sessions
     
     def new_session(self):
         """Creates a new session, returning the ID string"""
         new_session=Session()
-        self.sessions[new_session.id]=new_session
         new_session.setup()
+        with self.lock:
+            self.sessions[new_session.id]=new_session
         return new_session
 
     def get_session(self,session_id):
         """Returns the session object from id, or None"""
-        if session_id in self.sessions.keys():
-            return self.sessions[session_id]
-        else:
-            return None
+        with self.lock:
+            session = self.sessions.get(session_id)
+            if session is not None:
+                session.last_access = time.time()
+            return session
+
+    def idle_sessions(self, idle_time):
+        """Returns the started sessions without requests for idle_time seconds"""
+
+        limit = time.time() - idle_time
+        with self.lock:
+            return [session for session in self.sessions.values()
+                    if session.started and session.last_access < limit]
 
     def get_session_path(self,session_id):
         """Returns the path to the session folder; includes the path delimiter"""
@@ -188,14 +478,15 @@ class SessionManager:
 
         url can be any of: URL_UPPHASE, URL_UPFLUOR, URL_UPPARAMS
         """
-        if session_id in self.sessions.keys():
-            session = self.sessions[session_id]
-            if url == URL_UPPHASE:
-                session.set_phase(file_name)
-            elif url == URL_UPFLUOR:
-                session.set_fluor(file_name)
-            elif url == URL_UPPARAMS:
-                session.set_parameters_file(file_name)
+        session = self.get_session(session_id)
+        if session is not None:
+            with session.lock:
+                if url == URL_UPPHASE:
+                    session.set_phase(file_name)
+                elif url == URL_UPFLUOR:
+                    session.set_fluor(file_name)
+                elif url == URL_UPPARAMS:
+                    session.set_parameters_file(file_name)
 
 class Handler(BaseHTTPRequestHandler):
 
@@ -233,14 +524,29 @@ class Handler(BaseHTTPRequestHandler):
                                      PHASE_TAG:str(session.phase_file),
                                      PARAMS_TAG:str(session.params_file)})
             elif path == URL_START:
-                session.start_ehooke()
-                session.save_overlay()
+                params, fingerprint = session.parameters_snapshot()
+                job = get_job_queue().submit(session.id, functools.partial(session.start, params),
+                                       'start', fingerprint)
+                if job is None:
+                    html = json.dumps({'id': None, 'status': 'rejected', 'description': 'start',
+                                       'message': 'Server busy, try again later'})
+                else:
+                    html = json.dumps(job.status_dict())
+            elif path == URL_MASK_STATS:
+                html = json.dumps(session.mask_statistics())
+            elif path == URL_JOB_STATUS:
+                job_id = None
+                if JOB_TAG+'=' in parsed_url.query:
+                    job_id = urlparse.parse_qs(parsed_url.query)[JOB_TAG][0]
+                html = json.dumps(get_job_queue().job_status(session_id, job_id))
             elif path == URL_MASK_PAGE:
                 print 'ok'
                 form = attributes_to_form('maskform',URL_MASK_PARAMETERS[1:]+'?ID='+session_id,
                                           session.params.mask_params,
                                           MaskParameters.exported,
-                                          {'algorithm':session.params.mask_params.algorithms})
+                                          {'algorithm':session.params.mask_params.algorithms,
+                                           'auto_method':session.params.mask_params.auto_methods,
+                                           'morphology':session.params.mask_params.morphologies})
                 html = process_html(HTML_MASK,
                                     {SESSION_ID_TAG:session.id,
                                      SESSION_NAME_TAG:session.name,
@@ -251,6 +557,16 @@ class Handler(BaseHTTPRequestHandler):
                     html = open(DEFAULT_MASK,'rb').read()
                 else:
                     html = open(session.mask_image,'rb').read()        
+            elif path == URL_BASE_IMAGE:
+                if session.base_image is None:
+                    html = open(DEFAULT_MASK,'rb').read()
+                else:
+                    html = open(session.base_image,'rb').read()
+            elif path == URL_MASK_CONTOURS:
+                if session.contours_file is None:
+                    html = '{"width":0,"height":0,"contours":[]}'
+                else:
+                    html = open(session.contours_file,'rb').read()
         else:
             #if a miscelaneous file is requested, it is only read from the HTML_FOLDER
             html = open(HTML_FOLDER+path.split('/')[-1],'rb').read()
@@ -356,14 +672,16 @@ class Handler(BaseHTTPRequestHandler):
             session = session_manager.get_session(session_id)
             length = int(self.headers.getheader('content-length'))
             postvars = urlparse.parse_qs(self.rfile.read(length))
-            form_to_attributes(postvars,
-                               MaskParameters.exported,
-                               session.params.mask_params)
-            res,msg = session.recompute_mask()
-            if res:
-                return (True, SERVER_URL+URL_MASK_PAGE+'?ID='+session_id)
-            else:
-                return (False,msg)
+            with session.lock:
+                form_to_attributes(postvars,
+                                   MaskParameters.exported,
+                                   session.params.mask_params)
+            params, fingerprint = session.parameters_snapshot()
+            job = get_job_queue().submit(session_id, functools.partial(session.recompute_mask, params),
+                                   'mask', fingerprint)
+            if job is None:
+                return (False, 'Server busy, try again later')
+            return (True, SERVER_URL+URL_MASK_PAGE+'?ID='+session_id+'&'+JOB_TAG+'='+job.id)
             
         #by default, assume ok and return to session page
         return (True, SERVER_URL+URL_SESSION_PAGE+'?ID='+session_id)
@@ -395,12 +713,62 @@ session_manager=SessionManager()
    access to the session manager.
 """
 
+job_queue=None
+"""Global variable with the queue of session jobs, shared by the http handler threads;
+   created by get_job_queue"""
+
+job_queue_lock=threading.Lock()
+"""Lock for creating job_queue"""
+
+worker_pool=None
+"""Global variable with the WorkerPool running the sessions, created by get_worker_pool"""
+
+worker_pool_lock=threading.Lock()
+"""Lock for creating worker_pool"""
+
+
+def close_idle_sessions():
+    """thread loop closing the EHooke of sessions idle for SESSION_IDLE_TIME; closing
+       is a job of the session, so it never runs during another of its jobs
+    """
+
+    while True:
+        time.sleep(SESSION_IDLE_TIME / 10.0)
+        for session in session_manager.idle_sessions(SESSION_IDLE_TIME):
+            get_job_queue().submit(session.id, session.close, 'close')
+
+
+def get_worker_pool():
+    """returns the WorkerPool, starting the worker processes on first use"""
+
+    global worker_pool
+    with worker_pool_lock:
+        if worker_pool is None:
+            worker_pool = WorkerPool(JOB_WORKERS)
+        return worker_pool
+
+
+def get_job_queue():
+    """returns the JobQueue, starting its threads on first use"""
+
+    global job_queue
+    with job_queue_lock:
+        if job_queue is None:
+            job_queue = JobQueue()
+        return job_queue
+
     
 
 if __name__ == '__main__':
 
     #For safety reasons, server is confined to local host
     #Change 'localhost' to '' to enable remote access
+    # worker processes are started before the job and server threads
+    get_worker_pool()
+    get_job_queue()
+    closer = threading.Thread(target=close_idle_sessions, name='session closer')
+    closer.daemon = True
+    closer.start()
     server = ThreadedHTTPServer(('localhost', 8081), Handler)    
     print 'Starting server, use <Ctrl-C> to stop'
     server.serve_forever()
@@ -0,0 +1,207 @@
+"""eHooke worker processes for the HTTP server
+
+Each worker process keeps the EHooke instances of the sessions assigned to
+it and runs their computations, so sessions use several cores instead of
+sharing the interpreter of the server. Images and masks computed by a worker
+are written to memory mapped files in the session folder (see share_array),
+which the server maps read only to use them without copying.
+"""
+
+import multiprocessing
+import threading
+import traceback
+import os
+import numpy as np
+from ehooke import EHooke
+
+
+def share_array(filename, array):
+    """writes array to a memory mapped file, returns its descriptor (filename, dtype, shape)"""
+
+    array = np.ascontiguousarray(array)
+    shared = np.memmap(filename + '.tmp', dtype=array.dtype, mode='w+', shape=array.shape)
+    shared[...] = array
+    shared.flush()
+    del shared
+    # replaced only when complete, so readers never map a partial file
+    if os.path.exists(filename) and os.name == 'nt':
+        os.remove(filename)
+    os.rename(filename + '.tmp', filename)
+    return (filename, array.dtype.str, array.shape)
+
+
+def open_shared(descriptor):
+    """returns the array of a descriptor from share_array, memory mapped read only"""
+
+    filename, dtype, shape = descriptor
+    return np.memmap(filename, dtype=dtype, mode='r', shape=tuple(shape))
+
+
+def command_start(sessions, session_id, params, folder):
+    """creates the EHooke of a session, loads the images, saves the base image
+       and computes the masks (see command_masks)
+    """
+
+    ehooke = EHooke(params)
+    ehooke.load_images()
+    sessions[session_id] = ehooke
+    ehooke.save_image(folder+'/base.png')
+    return command_masks(sessions, session_id, params, folder)
+
+
+def command_masks(sessions, session_id, params, folder):
+    """computes the masks with params, saves the contours and shares the phase mask"""
+
+    ehooke = sessions[session_id]
+    ehooke.params = params
+    ehooke.create_masks()
+    ehooke.save_mask_contour(folder+'/contours.json')
+    shared = {'mask': share_array(folder+'/mask.dat', ehooke.fluor_frame.phase_mask.get_mask())}
+    ehooke.fluor_frame.pack_masks()
+    return (True, '', shared)
+
+
+def command_overlay(sessions, session_id, filename, back, fore, mask, image):
+    """saves the mask overlay of a session to filename"""
+
+    ehooke = sessions[session_id]
+    ehooke.save_mask_overlay(filename, back, fore, mask, image)
+    ehooke.fluor_frame.pack_masks()
+    return (True, '', {})
+
+
+def command_close(sessions, session_id):
+    """discards the EHooke of a session"""
+
+    sessions.pop(session_id, None)
+    return (True, '', {})
+
+
+COMMANDS = {'start': command_start, 'masks': command_masks,
+            'overlay': command_overlay, 'close': command_close}
+"""dict: functions run by the worker for each command, returning (result, message, shared arrays)"""
+
+
+def worker_main(connection):
+    """worker process loop: runs (command, session id, arguments) requests from the
+       connection, replying with (result, message, shared arrays) until it receives None
+    """
+
+    sessions = {}
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        command, session_id, args = request
+        try:
+            if command != 'start' and command != 'close' and session_id not in sessions:
+                reply = (False, 'Session not started', {})
+            else:
+                reply = COMMANDS[command](sessions, session_id, *args)
+        except Exception:
+            reply = (False, traceback.format_exc(), {})
+        connection.send(reply)
+    connection.close()
+
+
+class WorkerPool:
+    """Worker processes running the EHooke instances of the sessions
+
+       Each session is assigned to one worker (the one with fewest sessions)
+       and all its commands run there. A worker runs one command at a time,
+       so calls to a busy worker wait for it. A worker process that stops is
+       replaced, and the sessions it had must be started again (see has_session).
+    """
+
+    def __init__(self, processes=None):
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.connections = []
+        """list: server end of the pipe of each worker"""
+        self.processes = []
+        """list: worker processes"""
+        self.locks = []
+        """list: one lock per worker, held while a command runs"""
+        self.assigned = {}
+        """dict: worker index of each session id"""
+        self.lock = threading.Lock()
+        """Lock: protects assigned"""
+        for index in range(processes):
+            self.connections.append(None)
+            self.processes.append(None)
+            self.locks.append(threading.Lock())
+            self.start_worker(index)
+
+    def start_worker(self, index):
+        """starts worker process index (call with its lock held, or while creating the pool)"""
+
+        server_end, worker_end = multiprocessing.Pipe()
+        process = multiprocessing.Process(target=worker_main, args=(worker_end,),
+                                          name='ehooke worker %d' % index)
+        process.daemon = True
+        process.start()
+        worker_end.close()
+        self.connections[index] = server_end
+        self.processes[index] = process
+
+    def restart_worker(self, index):
+        """replaces worker process index, which stopped, forgetting its sessions
+           (call with its lock held)
+        """
+
+        self.connections[index].close()
+        if self.processes[index].is_alive():
+            self.processes[index].terminate()
+        self.processes[index].join()
+        with self.lock:
+            for session_id, worker in self.assigned.items():
+                if worker == index:
+                    del self.assigned[session_id]
+        self.start_worker(index)
+
+    def worker_for(self, session_id):
+        """returns the index of the worker of a session, assigning one if needed"""
+
+        with self.lock:
+            if session_id not in self.assigned:
+                loads = [0] * len(self.processes)
+                for index in self.assigned.values():
+                    loads[index] += 1
+                self.assigned[session_id] = loads.index(min(loads))
+            return self.assigned[session_id]
+
+    def has_session(self, session_id):
+        """returns True if the session is assigned to a worker; False after close or
+           if its worker process stopped, so its EHooke must be started again
+        """
+
+        with self.lock:
+            return session_id in self.assigned
+
+    def call(self, session_id, command, *args):
+        """runs a command for a session in its worker and returns (result, message, shared arrays)
+
+           If the worker process stopped, it is restarted and the result is False
+        """
+
+        index = self.worker_for(session_id)
+        with self.locks[index]:
+            try:
+                self.connections[index].send((command, session_id, args))
+                res = self.connections[index].recv()
+            except (EOFError, IOError):
+                self.restart_worker(index)
+                res = (False, 'The worker process of the session stopped, start the session again', {})
+        if command == 'close':
+            with self.lock:
+                self.assigned.pop(session_id, None)
+        return res
+
+    def close(self):
+        """stops the worker processes"""
+
+        for index, connection in enumerate(self.connections):
+            with self.locks[index]:
+                connection.send(None)
+        for process in self.processes:
+            process.join()
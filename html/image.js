@@ -9,6 +9,9 @@
 var canvas = document.getElementById('zoomcanvas');
 var img = document.getElementById('zoomimage')
 canvas.style.cssText="image-rendering: pixelated"
+//contour polylines drawn over the image, if the canvas has a data-contours url
+var contours = [];
+var contourColor = '#ffff00';
 
 window.onload = function(){		
   var ctx = canvas.getContext('2d');
@@ -23,7 +26,63 @@ window.onload = function(){
     var p2 = ctx.transformedPoint(canvas.width,canvas.height);
     ctx.clearRect(p1.x,p1.y,p2.x-p1.x,p2.y-p1.y);
     ctx.drawImage(img,0,0);
+    drawContours();
     }
+
+  //contour vertices are pixel centers, so lines are offset by half a pixel
+  function drawContours(){
+    ctx.save();
+    ctx.strokeStyle = contourColor;
+    ctx.lineWidth = 1/ctx.getTransform().a;
+    ctx.beginPath();
+    for (var i = 0; i < contours.length; i++){
+      var line = contours[i];
+      ctx.moveTo(line[0][0]+0.5,line[0][1]+0.5);
+      for (var j = 1; j < line.length; j++){
+        ctx.lineTo(line[j][0]+0.5,line[j][1]+0.5);
+        }
+      }
+    ctx.stroke();
+    ctx.restore();
+    }
+
+  var contourUrl = canvas.getAttribute('data-contours');
+  function loadContours(){
+    if (!contourUrl) return;
+    var request = new XMLHttpRequest();
+    request.onload = function(){
+      contours = JSON.parse(request.responseText).contours;
+      redraw();
+      };
+    //the time avoids cached responses when the contours change
+    request.open('GET',contourUrl+'&t='+new Date().getTime(),true);
+    request.send();
+    }
+
+  //if the page was opened for a job (e.g. a mask computation), shows its status
+  //and reloads the contours when it finishes
+  var jobMatch = /[?&]JOB=([^&]+)/.exec(window.location.search);
+  var idMatch = /[?&]ID=([^&]+)/.exec(window.location.search);
+  var statusLine = document.getElementById('jobstatus');
+  function pollJob(){
+    var request = new XMLHttpRequest();
+    request.onload = function(){
+      var job = JSON.parse(request.responseText);
+      if (statusLine) statusLine.textContent = 'Job '+job.status+' '+job.message;
+      if (job.status == 'queued' || job.status == 'running'){
+        setTimeout(pollJob,500);
+        }
+      else if (job.status == 'done'){
+        loadContours();
+        }
+      };
+    request.open('GET','jobstatus?ID='+idMatch[1]+'&JOB='+jobMatch[1]+'&t='+new Date().getTime(),true);
+    request.send();
+    }
+  if (jobMatch && idMatch){
+    pollJob();
+    }
+  loadContours();
   redraw();
 
   var lastX=canvas.width/2, lastY=canvas.height/2;
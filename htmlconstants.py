@@ -77,6 +77,16 @@ URL_MASK_PAGE = '/mask'
 """str: url for the mask page"""
 URL_MASK_IMAGE = '/maskimage'
 """str: url for requesting the current mask image (get)"""
+URL_MASK_CONTOURS = '/maskcontours'
+"""str: url for requesting the current mask contours as JSON polylines (get)"""
+URL_BASE_IMAGE = '/baseimage'
+"""str: url for requesting the grayscale image the contours are drawn over (get)"""
+URL_MASK_STATS = '/maskstats'
+"""str: url for requesting the coverage, number of components and mean area of the mask (get), as JSON"""
+URL_JOB_STATUS = '/jobstatus'
+"""str: url for requesting the status of a job (get, with ?ID=id&JOB=job id), as JSON"""
+JOB_TAG = 'JOB'
+"""str: url parameter with the id of a job"""
 
 
 def attributes_to_form(name, action,obj,attributes,
@@ -6,14 +6,734 @@
 """
 
 from skimage.io import imsave, imread
-from skimage.util import img_as_float
-from skimage import exposure, color, morphology, filter
+from skimage import morphology, filter
 import numpy as np
 from scipy import ndimage
-from skimage.segmentation import mark_boundaries
-from skimage.filter import threshold_isodata
+from skimage.measure import find_contours, approximate_polygon
+import copy
+import json
+import multiprocessing
 
 from params import MaskParameters 
+import ehloader
+
+
+PRECISIONS = {'float64': np.float64, 'float32': np.float32, 'uint16': np.uint16}
+"""dict: numpy type of the converted images for each FluorFrameParameters.precision"""
+
+GRAY_WEIGHTS = (0.2125, 0.7154, 0.0721)
+"""tuple: red, green and blue weights of grayscale conversion, as in skimage color.rgb2gray"""
+
+
+def image_scale(image):
+    """returns the value of full intensity in image: the maximum of the type for
+       integer images (e.g. 65535 with precision 'uint16'), as as_float divides
+       them, and 1 for float images, whose intensities are in [0, 1]
+
+       Absolute thresholds and offsets are given for [0, 1] and multiplied by this.
+    """
+
+    if image.dtype.kind in 'ui':
+        return float(np.iinfo(image.dtype).max)
+    return 1.0
+
+
+def as_float(image, dtype=np.float64):
+    """returns image as a float array of dtype; integer types are divided by their
+       maximum, as img_as_float. Float images of dtype are returned without a copy.
+    """
+
+    if image.dtype.kind in 'ui':
+        res = image.astype(dtype)
+        res /= dtype(np.iinfo(image.dtype).max)
+        return res
+    return np.asarray(image, dtype=dtype)
+
+
+def as_gray(image):
+    """returns a float RGB(A) image in grayscale (as color.rgb2gray), a 2D image as it is"""
+
+    if image.ndim == 3:
+        return np.dot(image[..., :3], np.array(GRAY_WEIGHTS, dtype=image.dtype))
+    return image
+
+
+def as_precision(image, dtype):
+    """returns a float image in [0, 1] as dtype, scaled to the full range if dtype is an integer type"""
+
+    if np.dtype(dtype).kind == 'u':
+        scale = np.iinfo(dtype).max
+        return np.rint(np.clip(image, 0, 1) * scale).astype(dtype)
+    return np.asarray(image, dtype=dtype)
+
+
+def float_type(dtype):
+    """returns the float type used in the computations for images of precision dtype"""
+
+    if dtype == np.float64:
+        return np.float64
+    return np.float32
+
+
+def convert_phase(image, in_range=None, invert=False, dtype=np.float64):
+    """returns the phase image (or a region of it) as grayscale of dtype (see PRECISIONS)
+
+       The intensity is rescaled from in_range, or from the image range if
+       in_range is None, to [0, 1] (to the full range of integer types), and
+       inverted if invert is True. Computed in place, in float32 unless dtype
+       is float64, with the same result as img_as_float, rescale_intensity and
+       rgb2gray.
+    """
+
+    image = as_float(image, float_type(dtype))
+    if in_range is None:
+        low, high = np.min(image), np.max(image)
+    else:
+        low, high = in_range
+    image = np.clip(image, low, high)   # a copy, changed in place below
+    image -= low
+    if high > low:
+        image /= image.dtype.type(high - low)
+    image = as_gray(image)
+    if invert:
+        np.subtract(1, image, out=image)
+    return as_precision(image, dtype)
+
+
+def convert_fluor(image, dtype=np.float64):
+    """returns the fluorescence image (or a region of it) in grayscale, as imread with as_grey
+
+       Integer grayscale images are kept as they are; RGB images are converted
+       to grayscale of dtype and float images to the float type of dtype.
+    """
+
+    if image.ndim == 3:
+        return as_precision(as_gray(as_float(image, float_type(dtype))), dtype)
+    if image.dtype.kind == 'f':
+        return np.asarray(image, dtype=float_type(dtype))
+    return image
+
+
+def fft_size(n):
+    """returns the smallest integer >= n with no prime factors other than 2, 3 and 5"""
+
+    best = 2 * n
+    p2 = 1
+    while p2 < best:
+        p3 = p2
+        while p3 < best:
+            p5 = p3
+            while p5 < n:
+                p5 *= 5
+            best = min(best, p5)
+            p3 *= 3
+        p2 *= 2
+    return best
+
+
+def parabolic_offset(values, index):
+    """returns the subpixel offset of the peak at values[index], from a parabola
+       through the peak and its two neighbours (0 at the edges or on flat peaks)
+    """
+
+    if index <= 0 or index >= len(values) - 1:
+        return 0.0
+    left, centre, right = values[index-1], values[index], values[index+1]
+    curvature = left - 2 * centre + right
+    if curvature >= 0:
+        return 0.0
+    return 0.5 * (left - right) / curvature
+
+
+def correlation_peak(scores, width):
+    """returns ((dx, dy), (subpixel dx, subpixel dy), peak) for the best offset
+
+       scores[i, j] is the score of offset (i-width, j-width). Candidates are the
+       offsets in [-width, width); extra rows or columns are only used for the
+       subpixel refinement. If no score is positive the offset is (0, 0)
+    """
+
+    search = scores[:2*width, :2*width]
+    ix, iy = [int(i) for i in np.unravel_index(np.argmax(search), search.shape)]
+    peak = float(search[ix, iy])
+    if peak <= 0:
+        return ((0, 0), (0.0, 0.0), peak)
+    sx = parabolic_offset(scores[:, iy], ix)
+    sy = parabolic_offset(scores[ix, :], iy)
+    return ((ix-width, iy-width), (ix-width+sx, iy-width+sy), peak)
+
+
+def window_scores(mask, window, margin, xs, ys):
+    """returns scores[i, j], the overlap of mask and window at offset (xs[i], ys[j])
+
+       window is the region of the image around the mask, with margin pixels
+       on each side
+    """
+
+    w, h = mask.shape
+    scores = np.zeros((len(xs), len(ys)))
+    for ix, dx in enumerate(xs):
+        for iy, dy in enumerate(ys):
+            scores[ix, iy] = np.sum(np.multiply(mask, window[margin+dx:margin+dx+w, margin+dy:margin+dy+h]))
+    return scores
+
+
+def table_peak(scores, xs, ys):
+    """returns ((dx, dy), (subpixel dx, subpixel dy), peak) for the best offset
+       in a table of scores for offsets xs by ys (see window_scores)
+
+       If no score is positive the offset is (0, 0)
+    """
+
+    ix, iy = [int(i) for i in np.unravel_index(np.argmax(scores), scores.shape)]
+    peak = float(scores[ix, iy])
+    if peak <= 0:
+        return ((0, 0), (0.0, 0.0), peak)
+    best = (xs[ix], ys[iy])
+    subpixel = (best[0] + parabolic_offset(scores[:, iy], ix),
+                best[1] + parabolic_offset(scores[ix, :], iy))
+    return (best, subpixel, peak)
+
+
+def downsample(image):
+    """returns the image reduced to half size by averaging 2x2 blocks
+       (an odd last row or column is dropped)
+    """
+
+    w, h = image.shape[0] // 2, image.shape[1] // 2
+    return image[:2*w, :2*h].reshape(w, 2, h, 2).mean(axis=3).mean(axis=1)
+
+
+def box_sums(image, radius):
+    """returns the sum of image over the (2*radius+1)**2 box centred on each pixel
+
+       Uses a summed-area table, so the cost does not depend on the radius.
+       The image is mirrored at the borders, as in ndimage mode 'reflect'.
+    """
+
+    size = 2 * radius + 1
+    padded = np.pad(image, radius, mode='symmetric')
+    table = np.zeros((padded.shape[0]+1, padded.shape[1]+1))
+    np.cumsum(padded, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    sums = table[size:, size:] - table[:-size, size:]
+    sums -= table[size:, :-size]
+    sums += table[:-size, :-size]
+    return sums
+
+
+def local_threshold(image, blocksize, offset=0.0, k=0.0, r=0.5):
+    """returns the local threshold image for a block of blocksize pixels
+
+       The threshold is mean * (1 + k * (std / r - 1)) - offset, where mean and
+       std are computed on a box of side blocksize (rounded up to odd) with
+       summed-area tables, so each pixel costs the same for any blocksize.
+       With k = 0 this is the local mean minus offset; k > 0 adds the local
+       standard deviation term of Sauvola's method, r being the dynamic range
+       of the standard deviation (0.5 for images in [0, 1]).
+
+       Unlike 'Local Average' (filter.threshold_adaptive), which weights the
+       block with a gaussian of sigma (blocksize - 1) / 6, the mean is uniform
+       over the box, so the two modes give the same masks except within a few
+       pixels of the edges of the regions (see test_masks.test_local_average).
+    """
+
+    radius = blocksize // 2
+    area = float((2 * radius + 1) ** 2)
+    mean = box_sums(image, radius)
+    mean /= area
+    if k != 0:
+        std = box_sums(np.square(image, dtype=mean.dtype), radius)
+        std /= area
+        std -= np.square(mean)
+        np.clip(std, 0, None, out=std)
+        np.sqrt(std, out=std)
+        std /= r
+        std -= 1
+        std *= k
+        std += 1
+        mean *= std
+    mean -= offset
+    return mean
+
+
+def pack_mask(mask):
+    """returns a (shape, bits) tuple with the boolean mask packed 8 pixels per byte"""
+
+    return (mask.shape, np.packbits(mask, axis=None))
+
+
+def unpack_mask(packed):
+    """returns the boolean mask from a (shape, bits) tuple created by pack_mask"""
+
+    shape, bits = packed
+    size = shape[0] * shape[1]
+    return np.unpackbits(bits)[:size].reshape(shape).view(np.bool_)
+
+
+def mask_boundary(mask):
+    """returns the boundary of the mask: mask pixels with a background neighbour
+       (4-connected), computed as the mask XOR its erosion
+
+       The image border does not count as background, so regions touching it
+       are not outlined along it
+    """
+
+    return mask ^ ndimage.binary_erosion(mask, border_value=1)
+
+
+def mask_contours(mask, tolerance=0.5):
+    """returns the contours of the mask regions as a list of (n, 2) arrays of
+       (row, column) vertices, closed (last vertex equal to the first)
+
+       Contours follow the half level between mask and background pixels and are
+       simplified with approximate_polygon, keeping within tolerance pixels of
+       the exact contour; regions touching the image border are closed along it
+    """
+
+    padded = np.zeros((mask.shape[0]+2, mask.shape[1]+2), np.uint8)
+    padded[1:-1, 1:-1] = mask
+    res = []
+    for contour in find_contours(padded, 0.5):
+        contour -= 1
+        np.clip(contour, 0, [mask.shape[0]-1, mask.shape[1]-1], out=contour)
+        if tolerance > 0:
+            contour = approximate_polygon(contour, tolerance)
+        res.append(contour)
+    return res
+
+
+def contours_json(contours, shape):
+    """returns a JSON string with the image size and the contours as lists of
+       [x, y] points, x being the column and y the row (as in the browser canvas)
+    """
+
+    polylines = [np.round(contour[:, ::-1], 1).tolist() for contour in contours]
+    return json.dumps({'width': shape[1], 'height': shape[0], 'contours': polylines},
+                      separators=(',', ':'))
+
+
+def contours_svg(contours, shape, color=(1,1,0)):
+    """returns an SVG document with the contours as polylines of the color (RGB in [0, 1])
+       over a transparent background of the image size
+    """
+
+    stroke = '#%02x%02x%02x' % tuple(int(round(c * 255)) for c in color)
+    lines = ['<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d">' % (shape[1], shape[0]),
+             '<g fill="none" stroke="%s" stroke-width="1">' % stroke]
+    for contour in contours:
+        points = ' '.join('%g,%g' % (round(column, 1), round(row, 1)) for row, column in contour)
+        lines.append('<polyline points="%s"/>' % points)
+    lines.append('</g>')
+    lines.append('</svg>')
+    return '\n'.join(lines)
+
+
+class ImageHistogram:
+    """Intensity histogram of an image, computed once and shared by the global
+       threshold methods and by coverage queries
+
+       Bins span the image range as in skimage.exposure.histogram for float
+       images, so thresholds match the skimage functions with the same nbins.
+    """
+
+    def __init__(self, image, nbins=256, value_range=None):
+        """value_range is the (min, max) spanned by the bins, the image range if None"""
+
+        self.counts, self.edges = np.histogram(image, bins=nbins, range=value_range)
+        """ndarrays: pixel count in each bin and the nbins+1 bin edges"""
+        self.scale = image_scale(image)
+        """float: full intensity of the image (see image_scale); thresholds and edges are
+                  in image values, divide by scale for [0, 1] thresholds"""
+        self.update()
+
+    def update(self):
+        """recomputes the bin centers and cumulative counts from counts and edges"""
+
+        self.centers = (self.edges[:-1] + self.edges[1:]) / 2.0
+        """ndarray: bin centers"""
+        self.cumulative = np.concatenate(([0], np.cumsum(self.counts)))
+        """ndarray: number of pixels below each bin edge"""
+        self.total = self.cumulative[-1]
+        """int: total number of pixels"""
+
+    def add(self, image):
+        """adds the pixels of image (e.g. another tile) to the histogram
+
+           The bins are not changed, so the image values must be in their range
+        """
+
+        value_range = (self.edges[0], self.edges[-1])
+        self.counts += np.histogram(image, bins=len(self.counts), range=value_range)[0]
+        self.update()
+
+    def threshold(self, method='Isodata'):
+        """returns the threshold computed with method ('Isodata' or 'Otsu')
+
+           For a constant image (a single populated bin) returns its value
+        """
+
+        if np.count_nonzero(self.counts) == 1:
+            return self.centers[np.argmax(self.counts)]
+        if method == 'Otsu':
+            return self.otsu()
+        return self.isodata()
+
+    def isodata(self):
+        """returns the isodata threshold (as skimage threshold_isodata)
+
+           The threshold is the first bin center t with (l + h) / 2 within one
+           bin above t, l and h being the means of pixels <= t and > t
+        """
+
+        hist = self.counts.astype(np.float64)
+        # the first and last bins hold the minimum and maximum, so csuml > 0
+        # and csumh > 0 except on the last bin, which cannot be the threshold
+        csuml = np.cumsum(hist)
+        csumh = np.cumsum(hist[::-1])[::-1] - hist
+        intensity_sum = hist * self.centers
+        csumh[-1] = 1
+        low = np.cumsum(intensity_sum) / csuml
+        high = (np.cumsum(intensity_sum[::-1])[::-1] - intensity_sum) / csumh
+        distances = (low + high) / 2.0 - self.centers
+        bin_width = self.centers[1] - self.centers[0]
+        thresholds = self.centers[(distances >= 0) & (distances < bin_width)]
+        if len(thresholds) == 0:
+            return self.centers[np.argmin(np.abs(distances))]
+        return thresholds[0]
+
+    def otsu(self):
+        """returns the Otsu threshold (as skimage threshold_otsu)"""
+
+        hist = self.counts.astype(np.float64)
+        weight1 = np.cumsum(hist)
+        weight2 = np.cumsum(hist[::-1])[::-1]
+        mean1 = np.cumsum(hist * self.centers) / weight1
+        mean2 = (np.cumsum((hist * self.centers)[::-1]) / weight2[::-1])[::-1]
+        variance12 = weight1[:-1] * weight2[1:] * (mean1[:-1] - mean2[1:]) ** 2
+        return self.centers[:-1][np.argmax(variance12)]
+
+    def coverage(self, thresholds):
+        """returns the fraction of pixels <= each of the thresholds (a number or an array,
+           in image values)
+
+           Computed from the cumulative histogram, interpolating linearly
+           within bins, without reading the image again
+        """
+
+        return np.interp(thresholds, self.edges, self.cumulative) / float(self.total)
+
+
+def threshold_image(image, params, histogram=None):
+    """returns the thresholded image as a boolean mask, with dark regions set to True
+
+       If params.auto_threshold is set, params.absolute_threshold is updated
+       with the threshold of the image computed by params.auto_method, using
+       histogram (an ImageHistogram of image) if given
+
+       Thresholds and offsets are for intensities in [0, 1] and are scaled to
+       the image values of integer images (see image_scale)
+    """
+
+    if params.auto_threshold:
+        if histogram is None:
+            histogram = ImageHistogram(image)
+        params.absolute_threshold = histogram.threshold(params.auto_method) / histogram.scale
+
+    scale = image_scale(image)
+    if params.algorithm == "Local Average":
+        #need to invert because threshold_adaptive sets dark parts to 0
+        return ~filter.threshold_adaptive(image, params.blocksize,offset=params.offset * scale)
+    elif params.algorithm == "Local Integral":
+        threshold = local_threshold(image, params.blocksize, params.offset * scale,
+                                    params.local_k, params.local_range * scale)
+        return image <= threshold
+    else:
+        #the convention is that dark is foreground and with mask set to 1            
+        return image <= params.absolute_threshold * scale
+
+
+def inverted(mask):
+    """returns the inverted mask"""
+
+    return ~mask
+
+
+def distance_dilation(mask, radius):
+    """returns the mask dilated by morphology.disk(radius), computed by thresholding
+       the distance transform of the background, at the same cost for any radius
+
+       Pixels outside the image are background, as in ndimage.binary_dilation,
+       so the result is identical to the footprint dilation.
+    """
+
+    if not mask.any():
+        return mask.copy()
+    return ndimage.distance_transform_edt(~mask) <= radius
+
+
+def distance_erosion(mask, radius):
+    """returns the mask eroded by morphology.disk(radius), using distance_dilation
+
+       Pixels outside the image are foreground, as in the grayscale erosion
+       (morphology.erosion ignores them) and in ndimage.binary_erosion with
+       border_value=1.
+    """
+
+    return ~distance_dilation(~mask, radius)
+
+
+def closed(mask, radius, method='Disk'):
+    """returns the mask without dark and light spots smaller than a disk of radius
+       (closing followed by opening); the mask itself if radius is 0
+
+       method 'Disk' uses the disk footprint, 'Distance' uses distance transforms;
+       both give the masks of morphology.closing of the mask and of its inverse
+    """
+
+    if radius <= 0:
+        return mask
+    # removes small dark spots and then small white spots
+    if method == 'Distance':
+        mask = distance_erosion(distance_dilation(mask, radius), radius)
+        return distance_dilation(distance_erosion(mask, radius), radius)
+    # as the grayscale closing of the mask and of its inverse, pixels outside
+    # the image are ignored: background for dilation, foreground for erosion
+    closing_disk = morphology.disk(radius)
+    mask = ndimage.binary_dilation(mask, closing_disk)
+    mask = ndimage.binary_erosion(mask, closing_disk, border_value=1)
+    mask = ndimage.binary_erosion(mask, closing_disk, border_value=1)
+    return ndimage.binary_dilation(mask, closing_disk)
+
+
+def filled(mask):
+    """returns the mask with the holes in enclosed regions filled"""
+
+    return ndimage.binary_fill_holes(mask)
+
+
+def dilated(mask, radius, method='Disk'):
+    """returns the mask dilated by a disk of radius; the mask itself if radius is 0
+
+       method 'Disk' uses the disk footprint, 'Distance' uses distance transforms
+    """
+
+    if radius <= 0:
+        return mask
+    if method == 'Distance':
+        return distance_dilation(mask, radius)
+    return ndimage.binary_dilation(mask, morphology.disk(radius))
+
+
+def mask_statistics(mask):
+    """returns (coverage, number of connected components, mean component area) of a mask"""
+
+    labels, count = ndimage.label(mask)
+    area = np.count_nonzero(mask)
+    mean_area = 0.0
+    if count > 0:
+        mean_area = area / float(count)
+    return (area / float(mask.size), count, mean_area)
+
+
+def mask_thumbnail(mask, size):
+    """returns a uint8 image (0 or 255) of the mask subsampled to at most size pixels per side"""
+
+    step = max(1, -(-max(mask.shape) // size))
+    return mask[::step, ::step].astype(np.uint8) * 255
+
+
+
+def mask_halo(params):
+    """returns the width of the border each tile needs for its core to be computed
+       as in the whole image: the threshold window radius plus the reach of the
+       closing (4 radii) and, if holes are not filled, of the dilation
+    """
+
+    halo = 0
+    if params.algorithm == 'Local Average':
+        # threshold_adaptive gaussian: sigma = (blocksize - 1) / 6, truncated at 4 sigma
+        halo = int(4 * (params.blocksize - 1) / 6.0 + 0.5)
+    elif params.algorithm == 'Local Integral':
+        halo = params.blocksize // 2
+    halo += 4 * max(params.closing, 0)
+    if not params.fill_holes:
+        halo += max(params.dilation, 0)
+    return halo
+
+
+def tile_grid(shape, tile_size, halo):
+    """generator of (outer, core) rectangles (x1, y1, x2, y2) tiling an image of shape
+
+       The cores (tile_size pixels per side, less at the edges) cover the image
+       without overlap; outer is the core plus halo pixels on each side, within
+       the image, and core is given relative to outer
+    """
+
+    rows, columns = shape
+    for x1 in range(0, rows, tile_size):
+        for y1 in range(0, columns, tile_size):
+            x2, y2 = min(x1 + tile_size, rows), min(y1 + tile_size, columns)
+            ox1, oy1 = max(x1 - halo, 0), max(y1 - halo, 0)
+            ox2, oy2 = min(x2 + halo, rows), min(y2 + halo, columns)
+            yield ((ox1, oy1, ox2, oy2), (x1 - ox1, y1 - oy1, x2 - ox1, y2 - oy1))
+
+
+def mask_tile(task):
+    """returns (base, phase) masks of the core of a tile, phase None if not requested
+
+       task is (tile image, core rectangle in the tile, params, create_phase);
+       params must have auto_threshold off, as the threshold must be the same
+       for all tiles. Holes are not filled here, since they can cross tiles.
+    """
+
+    tile, core, params, create_phase = task
+    base = threshold_image(tile, params)
+    if params.invert:
+        base = inverted(base)
+    x1, y1, x2, y2 = core
+    phase = None
+    if create_phase:
+        phase = closed(base, params.closing, params.morphology)
+        if not params.fill_holes:
+            phase = dilated(phase, params.dilation, params.morphology)
+        phase = phase[x1:x2, y1:y2]
+    return (base[x1:x2, y1:y2], phase)
+
+
+class MaskPipeline:
+    """Computes masks as a chain of stages, caching the result of each stage
+
+    Stages are threshold, invert, closing, fill and dilation. Each stage keeps
+    its last result under a key made of the key of the previous stage and the
+    parameters the stage depends on, so changing one parameter only recomputes
+    that stage and the ones after it. Cached arrays are shared, not copied,
+    so they must not be changed in place. If packed is True, results are
+    cached bit-packed (see pack_mask) and unpacked on cache hits.
+    """
+
+    stages = ['threshold', 'invert', 'closing', 'fill', 'dilation']
+    """list: stage names, in order"""
+
+    def __init__(self):
+        self.cache = {}
+        """dict: (key, result) for each stage name"""
+        self.hits = dict((stage, 0) for stage in self.stages)
+        """dict: number of cache hits for each stage name"""
+        self.misses = dict((stage, 0) for stage in self.stages)
+        """dict: number of cache misses for each stage name"""
+        self.last_run = []
+        """list: (stage, True if cache hit) for the stages of the last run"""
+        self.packed = False
+        """bool: if True, cached masks are stored bit-packed"""
+
+    def stage_key(self, stage, params):
+        """returns a tuple with the parameters the stage depends on"""
+
+        if stage == 'threshold':
+            if params.auto_threshold:
+                key = (params.algorithm, params.auto_method)
+            else:
+                key = (params.algorithm, None)
+            if params.algorithm == 'Local Average':
+                return key + (params.blocksize, params.offset)
+            elif params.algorithm == 'Local Integral':
+                return key + (params.blocksize, params.offset, params.local_k, params.local_range)
+            elif params.auto_threshold:
+                return key
+            return key + (params.absolute_threshold,)
+        elif stage == 'invert':
+            return (params.invert,)
+        elif stage == 'closing':
+            if params.closing <= 0:
+                return (0,)
+            return (params.closing, params.morphology)
+        elif stage == 'fill':
+            return (params.fill_holes,)
+        if params.dilation <= 0:
+            return (0,)
+        return (params.dilation, params.morphology)
+
+    def compute_stage(self, stage, mask, params, histogram=None):
+        """returns the result of the stage applied to mask (the image, for threshold)
+           and the automatic threshold, if computed
+
+           histogram is None or a function returning the ImageHistogram of the image
+        """
+
+        if stage == 'threshold':
+            if histogram is not None and params.auto_threshold:
+                histogram = histogram()
+            else:
+                histogram = None
+            return (threshold_image(mask, params, histogram), params.absolute_threshold)
+        elif stage == 'invert':
+            if params.invert:
+                mask = inverted(mask)
+        elif stage == 'closing':
+            mask = closed(mask, params.closing, params.morphology)
+        elif stage == 'fill':
+            if params.fill_holes:
+                mask = filled(mask)
+        else:
+            mask = dilated(mask, params.dilation, params.morphology)
+        return (mask, None)
+
+    def run(self, image, image_key, params, last='dilation', histogram=None):
+        """returns a dictionary with the result of each stage up to last
+
+           image_key identifies the image (e.g. file, version and clip) and is
+           part of every stage key. The automatic threshold is restored into
+           params on cache hits, as if the threshold had been recomputed.
+           histogram is None or a function returning the ImageHistogram of
+           image, called only if the automatic threshold must be computed.
+        """
+
+        results = {}
+        key = image_key
+        mask = image
+        self.last_run = []
+        for stage in self.stages[:self.stages.index(last)+1]:
+            key = (key, self.stage_key(stage, params))
+            cached = self.cache.get(stage)
+            if cached is not None and cached[0] == key:
+                mask, auto_threshold = cached[1]
+                if type(mask) is tuple:
+                    mask = unpack_mask(mask)
+                self.hits[stage] += 1
+                self.last_run.append((stage, True))
+            else:
+                mask, auto_threshold = self.compute_stage(stage, mask, params, histogram)
+                if self.packed:
+                    self.cache[stage] = (key, (pack_mask(mask), auto_threshold))
+                else:
+                    self.cache[stage] = (key, (mask, auto_threshold))
+                self.misses[stage] += 1
+                self.last_run.append((stage, False))
+            if stage == 'threshold' and params.auto_threshold:
+                params.absolute_threshold = auto_threshold
+            results[stage] = mask
+        return results
+
+    def report(self):
+        """returns a list of (stage, hits, misses) for all stages"""
+
+        return [(stage, self.hits[stage], self.misses[stage]) for stage in self.stages]
+
+    def pack(self):
+        """sets packed and packs the results already cached"""
+
+        self.packed = True
+        for stage in self.cache.keys():
+            key, (mask, auto_threshold) = self.cache[stage]
+            if type(mask) is not tuple:
+                self.cache[stage] = (key, (pack_mask(mask), auto_threshold))
+
+    def clear(self):
+        """discards all cached results"""
+
+        self.cache = {}
+
 
 class Mask:
     """Masks are binary images representing regions of interest of a parent image
@@ -21,6 +741,9 @@ class Mask:
     CONVENTIONS: foreground is assumed to be darker than background and set to value 1
                  If otherwise set the invert mask parameter to True.
 
+    Masks are boolean arrays. For long lived storage they can be packed to one
+    bit per pixel with pack(); get_mask() returns the boolean array either way.
+
     This class is responsible for
         Generating the base_mask, which is simply the thresholding of the parent mask
         Generating the phase_mask from a base mask, which is the base_mask plus binary closing            
@@ -34,7 +757,13 @@ class Mask:
         """
         
         self.mask = None    
-        """ndarray: mask matrix, without closing"""
+        """ndarray: boolean mask matrix, None if packed"""
+        self.packed = None
+        """tuple: (shape, bits) with the packed mask, None if not packed"""
+        self.outlines = {}
+        """dict: boundary and contours (by tolerance) computed from outlines_source"""
+        self.outlines_source = None
+        """object: the mask array (or packed tuple) the outlines were computed from"""
         
 
     def compute_base_mask(self,image,params):
@@ -42,56 +771,88 @@ class Mask:
 
            params is a MaskParameters object with the necessary parameters
         """
-        
-        self.mask = np.copy(image)
-
-        if params.auto_threshold:
-            params.absolute_threshold = threshold_isodata(self.mask)
 
-        if params.algorithm == "Local Average":
-            #need to invert because threshold_adaptive sets dark parts to 0
-            self.mask = 1.0-filter.threshold_adaptive(self.mask, params.blocksize,offset=params.offset)
-        else:
-            if params.auto_threshold:
-                params.absolute_threshold = threshold_isodata(self.mask)
-            #the convention is that dark is foreground and with mask set to 1            
-            self.mask = img_as_float(image <= params.absolute_threshold)
-            
+        self.mask = threshold_image(image, params)
         if params.invert:
             self.invert_mask()
 
     def compute_phase_mask(self, base_mask, params):
         """computes the phase mask from precomputed base mask """
 
-        self.mask = np.copy(base_mask)
-        
-        if params.closing > 0:            
-            # removes small dark spots and then small white spots
-            closing_disk = morphology.disk(params.closing)
-            self.mask = img_as_float(morphology.closing(self.mask, closing_disk))
-            self.mask = 1-img_as_float(morphology.closing(1-self.mask, closing_disk))
-
+        self.mask = closed(base_mask, params.closing, params.morphology)
         if params.fill_holes:
-            self.mask = img_as_float(ndimage.binary_fil_holes(self.mask)) 
-
-        if params.dilation > 0:
-            dilation_disk = morphology.disk(params.dilation)
-            self.mask = morphology.dilation(self.mask, dilation_disk)
-
-        #self.mask = img_as_float(phase_mask)
-            #FIXME This is either unnecessary or something is wrong
-            #test it and fix it <LK 2015-06-27>
+            self.mask = filled(self.mask)
+        self.mask = dilated(self.mask, params.dilation, params.morphology)
 
     def invert_mask(self):
         """the mask is 0 on dark regions and 1 on light regions.
            If the background is light and we want to use 1 to set the ROI, then the mask must be inverted           
         """
 
-        self.mask = 1.0 - self.mask
+        self.mask = inverted(self.mask)
+
+    def pack(self):
+        """packs the mask to one bit per pixel and releases the boolean array"""
+
+        if self.mask is not None:
+            self.packed = pack_mask(self.mask)
+            if self.outlines_source is self.mask:
+                self.outlines_source = self.packed
+            self.mask = None
+
+    def unpack(self):
+        """restores the boolean mask from the packed form"""
+
+        if self.packed is not None:
+            self.mask = unpack_mask(self.packed)
+            if self.outlines_source is self.packed:
+                self.outlines_source = self.mask
+            self.packed = None
+
+    def get_mask(self):
+        """returns the boolean mask, unpacking a copy if the mask is packed"""
+
+        if self.packed is not None:
+            return unpack_mask(self.packed)
+        return self.mask
+
+    def get_outlines(self):
+        """returns the dict of outlines of the current mask, emptied if the mask
+           was replaced since they were computed
+        """
+
+        source = self.mask
+        if self.packed is not None:
+            source = self.packed
+        if source is not self.outlines_source:
+            self.outlines = {}
+            self.outlines_source = source
+        return self.outlines
+
+    def get_boundary(self):
+        """returns the boolean boundary of the mask (see mask_boundary), computed once per mask"""
+
+        outlines = self.get_outlines()
+        if 'boundary' not in outlines:
+            outlines['boundary'] = mask_boundary(self.get_mask())
+        return outlines['boundary']
+
+    def get_contours(self, tolerance=0.5):
+        """returns the contour polylines of the mask (see mask_contours), computed once
+           per mask and tolerance
+        """
+
+        outlines = self.get_outlines()
+        if tolerance not in outlines:
+            outlines[tolerance] = mask_contours(self.get_mask(), tolerance)
+        return outlines[tolerance]
     
     def dispose(self):
         """Cleanup objects that this class may create"""
         self.mask = None
+        self.packed = None
+        self.outlines = {}
+        self.outlines_source = None
 
     
 
@@ -114,11 +875,27 @@ class FluorFrame:
         """ndarray: the fluorescence image, mandatory"""        
         self.fluor_baseline = None
         """float: baseline for fluorescence measurements"""
+        self.fluor_shift = (0, 0)
+        """tuple: (dx, dy) offset of the fluorescence image relative to the phase, set by align_fluor"""
+        self.align_subpixel = (0.0, 0.0)
+        """tuple: subpixel refinement of fluor_shift"""
+        self.align_peak = None
+        """float: alignment score (mask and fluorescence correlation) at fluor_shift"""
 
         self.base_mask = Mask()
         """Mask: the base mask, obtained from thresholding the parent image"""        
         self.phase_mask = Mask()
         """Mask: obtained from the base_mask plus binary closing"""   
+        self.mask_pipeline = MaskPipeline()
+        """MaskPipeline: cached mask stages, reused by create_masks"""
+        self.image_version = 0
+        """int: incremented whenever an image is loaded, to invalidate cached masks"""
+        self.histograms = {}
+        """dict: ImageHistogram of the mask source image, by (image key, number of bins)"""
+        self.overlay_buffer = None
+        """ndarray: uint8 RGB image returned by mask_overlay, reused while the clip size is the same"""
+        self.overlay_work = None
+        """ndarray: float32 RGB buffer used by mask_overlay"""
         
 
     def get_clip(self, margin):
@@ -128,57 +905,320 @@ class FluorFrame:
         return (margin, margin, lx-margin, ly-margin)
 
     def load_phase(self, params):
-        """loads phase image and converts it to grayscale as float
+        """loads phase image and converts it to grayscale as float (or as
+        params.precision, see convert_phase)
 
         params is a FluorFrameParameters object with the parameters for loading the phase
+        If params.lazy_loading is set and the file is an uncompressed TIFF, the
+        image is a ehloader.LazyImage, read and converted only for the regions used.
+        Must be called after load_fluor, which sets the clip region.
 
         """
 
-        self.phase_image = img_as_float(imread(params.phase_file))
-        self.phase_image = exposure.rescale_intensity(self.phase_image)  # rescales the intensity of the phase image
-        self.phase_image = color.rgb2gray(self.phase_image)
+        page = None
+        if params.lazy_loading:
+            page = ehloader.open_mappable(params.phase_file)
+        if page is None:
+            self.set_phase(imread(params.phase_file), params)
+            return
 
-        if params.invert_phase:
-            self.phase_image = 1 - self.phase_image        
+        # rescaling uses the range of the clip region, the only region read
+        x1, y1, x2, y2 = self.clip
+        dtype = PRECISIONS[params.precision]
+        clip = as_float(page.read_region(x1, y1, x2, y2), float_type(dtype))
+        in_range = (np.min(clip), np.max(clip))
+        clip = None
+        invert = params.invert_phase
+        self.phase_image = ehloader.LazyImage(page, lambda region: convert_phase(region, in_range, invert, dtype))
+        self.image_version += 1
 
     def load_fluor(self, params):
         """loads the fluorescence image and converts it if == RGB
            sets the clip rectangle
+           If params.lazy_loading is set and the file is an uncompressed TIFF,
+           the image is a ehloader.LazyImage (see load_phase)
         """
     
-        self.fluor_image = imread(params.fluor_file,as_grey=True)        
+        page = None
+        if params.lazy_loading:
+            page = ehloader.open_mappable(params.fluor_file)
+        if page is None:
+            self.set_fluor(imread(params.fluor_file), params)
+            return
+
+        dtype = PRECISIONS[params.precision]
+        self.fluor_image = ehloader.LazyImage(page, lambda region: convert_fluor(region, dtype))
+        self.clip = self.get_clip(params.phase_border)
+        self.fluor_shift = (0, 0)
+        self.image_version += 1
+
+    def set_phase(self, image, params):
+        """sets the phase image from an image array, converting it as load_phase"""
+
+        self.phase_image = convert_phase(image, invert=params.invert_phase,
+                                         dtype=PRECISIONS[params.precision])
+        self.image_version += 1
+
+    def set_fluor(self, image, params):
+        """sets the fluorescence image from an image array, converting it as
+           load_fluor, and sets the clip rectangle
+        """
+
+        self.fluor_image = convert_fluor(image, PRECISIONS[params.precision])
         self.clip = self.get_clip(params.phase_border)
+        self.fluor_shift = (0, 0)
+        self.image_version += 1
+
+    def stream_stack(self, params):
+        """generator that loads each frame of a multi page file into this
+           FluorFrame, yielding the frame index
+
+           The frames are the pages of params.fluor_file, paired with the pages
+           of params.phase_file if it has several pages, or with its only page
+           otherwise. If params.stack_interleaved, the pages of fluor_file
+           alternate phase and fluorescence images (phase first). Only the
+           current pages are kept in memory, so the previous frame is gone
+           when the next one is loaded.
+        """
+
+        # the phase image of a previous stack must not be used for this one
+        self.phase_image = None
+        if params.stack_interleaved:
+            pages = ehloader.iter_pages(params.fluor_file)
+            for index, phase in enumerate(pages):
+                fluor = next(pages, None)
+                if fluor is None:
+                    break
+                self.set_fluor(fluor, params)
+                fluor = None
+                self.set_phase(phase, params)
+                phase = None
+                yield index
+            return
+
+        phase_pages = None
+        if params.phase_file is not None:
+            phase_pages = ehloader.iter_pages(params.phase_file)
+        phase = None
+        for index, fluor in enumerate(ehloader.iter_pages(params.fluor_file)):
+            self.set_fluor(fluor, params)
+            fluor = None
+            if phase_pages is not None:
+                # a single page phase file is used for all frames
+                phase = next(phase_pages, phase)
+            if phase is not None:
+                self.set_phase(phase, params)
+            yield index
+
+    def fluor_clip(self):
+        """returns the clip region of the fluorescence image, shifted by fluor_shift"""
+
+        x1, y1, x2, y2 = self.clip
+        dx, dy = self.fluor_shift
+        return self.fluor_image[x1+dx:x2+dx, y1+dy:y2+dy]
 
-    def align_fluor(self, params):
+    def align_fluor(self, params, seed=None):
         """aligns fluorescence image to phase mask
+
+        params.align_algorithm selects how offsets are scored:
+            'Exhaustive' computes the overlap of mask and image for every offset
+            'FFT' computes all offsets at once with an FFT cross-correlation
+            'Pyramid' searches downsampled images and refines on finer levels
+        If seed, the (dx, dy) offset of a previous frame, is given and
+        params.track_margin is positive, only offsets within track_margin of
+        seed are searched (see tracking_search).
+        The best offset is stored in fluor_shift and applied by fluor_clip, the
+        subpixel refinement in align_subpixel and the score in align_peak
         """
 
-        clip = self.clip
         width = params.align_margin
         #reset clipping if alignment margin is larger
         if params.phase_border<params.align_margin:
             width = params.phase_border
 
-        minscore = 0        
-        best = (0, 0)
-        x1, y1, x2, y2 = clip
-        mask = self.phase_mask.mask
+        self.fluor_shift = (0, 0)
+        self.align_subpixel = (0.0, 0.0)
+        self.align_peak = None
+        if width <= 0:
+            return
+
+        if isinstance(self.fluor_image, ehloader.LazyImage):
+            # every offset reads from the clip plus the alignment margin
+            x1, y1, x2, y2 = self.clip
+            self.fluor_image.prefetch(x1-width, y1-width, x2+width, y2+width)
+
+        mask = self.phase_mask.get_mask()
+        if seed is not None and params.track_margin > 0:
+            best, subpixel, peak = self.tracking_search(mask, width, seed, params.track_margin,
+                                                        params.align_algorithm == 'FFT')
+        elif params.align_algorithm == 'Pyramid':
+            best, subpixel, peak = self.pyramid_search(mask, width)
+        else:
+            if params.align_algorithm == 'FFT':
+                scores = self.fft_scores(mask, width)
+            else:
+                scores = self.exhaustive_scores(mask, width)
+            best, subpixel, peak = correlation_peak(scores, width)
+
+        self.fluor_shift = best
+        self.align_subpixel = subpixel
+        self.align_peak = peak
+
+    def exhaustive_scores(self, mask, width):
+        """returns the matrix of overlap scores of mask and fluorescence image
+           for all offsets in [-width, width), indexed from -width
+        """
+
+        x1, y1, x2, y2 = self.clip
+        scores = np.zeros((2*width, 2*width))
         for dx in range(-width, width):
             for dy in range(-width, width):
-                total = -np.sum(np.multiply(mask, self.fluor_image[x1+dx:x2+dx, y1+dy:y2+dy]))
-                if total < minscore:
-                    minscore = total
-                    best = (dx, dy)
+                scores[dx+width, dy+width] = np.sum(np.multiply(mask, self.fluor_image[x1+dx:x2+dx, y1+dy:y2+dy]))
+        return scores
 
-        dx, dy = best        
+    def fft_scores(self, mask, width):
+        """returns the matrix of overlap scores of mask and fluorescence image
+           for all offsets in [-width, width], indexed from -width
 
-    def compute_fluor_baseline(self, params):
-        """computes the baseline for fluorescence"""
-        
-        dilated_mask = morphology.dilation(mask,morphology.disc(params.baseline_margin))
-        self.fluor_baseline = np.average(np.multiply(dilated_mask, self.fluor_image))
+           The fluorescence window is the clip plus width on each side. Both
+           arrays are zero padded, so the circular correlation does not wrap
+           for any of these offsets.
+        """
+
+        x1, y1, x2, y2 = self.clip
+        window = self.fluor_image[x1-width:x2+width, y1-width:y2+width]
+        shape = (fft_size(window.shape[0]), fft_size(window.shape[1]))
+        fwindow = np.fft.rfft2(window, shape)
+        fmask = np.fft.rfft2(mask, shape)
+        corr = np.fft.irfft2(fwindow * np.conj(fmask), shape)
+        return corr[:2*width+1, :2*width+1]
+
+    def pyramid_search(self, mask, width, refine=2, top_width=4, min_size=16):
+        """returns (best offset, subpixel offset, peak) searching offsets in
+           [-width, width) coarse to fine
+
+           Mask and fluorescence window are halved until the search width is at
+           most top_width (or the mask would be smaller than min_size). The top
+           level is searched exhaustively, then each finer level only searches
+           refine pixels around the doubled best offset of the level above.
+           The window is zero padded so that its margin is a multiple of the
+           downsampling factor of the top level.
+        """
+
+        x1, y1, x2, y2 = self.clip
+        levels = 0
+        while (width >> levels) > top_width and min(mask.shape) >> (levels+1) >= min_size:
+            levels += 1
+        factor = 2 ** levels
+        margin = -(-width // factor) * factor
+        pad = margin - width
+        window = np.zeros((x2-x1+2*margin, y2-y1+2*margin))
+        window[pad:window.shape[0]-pad, pad:window.shape[1]-pad] = \
+            self.fluor_image[x1-width:x2+width, y1-width:y2+width]
+
+        masks = [mask]
+        windows = [window]
+        for level in range(levels):
+            masks.append(downsample(masks[-1]))
+            windows.append(downsample(windows[-1]))
+
+        center = (0, 0)
+        radius = margin // factor
+        for level in range(levels, -1, -1):
+            m = margin // 2 ** level
+            low, high = -m, m
+            if level == 0:
+                low, high = -width, width - 1
+            xs = range(max(center[0]-radius, low), min(center[0]+radius, high)+1)
+            ys = range(max(center[1]-radius, low), min(center[1]+radius, high)+1)
+            scores = window_scores(masks[level], windows[level], m, xs, ys)
+            ix, iy = [int(i) for i in np.unravel_index(np.argmax(scores), scores.shape)]
+            center = (2 * xs[ix], 2 * ys[iy])
+            radius = refine
+
+        return table_peak(scores, xs, ys)
+
+    def tracking_search(self, mask, width, seed, radius, use_fft=False):
+        """returns (best offset, subpixel offset, peak) searching only the offsets
+           within radius of seed (and in [-width, width))
+
+           Used for stacks, where the offset of the previous frame is a good
+           estimate. With use_fft the scores are taken from the FFT
+           cross-correlation, otherwise computed directly for each offset.
+        """
+
+        xs = range(max(seed[0]-radius, -width), min(seed[0]+radius, width-1)+1)
+        ys = range(max(seed[1]-radius, -width), min(seed[1]+radius, width-1)+1)
+        if len(xs) == 0 or len(ys) == 0:
+            xs = ys = range(-width, width)
+        if use_fft:
+            scores = self.fft_scores(mask, width)
+            scores = scores[xs[0]+width:xs[-1]+width+1, ys[0]+width:ys[-1]+width+1]
+        else:
+            x1, y1, x2, y2 = self.clip
+            window = self.fluor_image[x1-width:x2+width, y1-width:y2+width]
+            scores = window_scores(mask, window, width, xs, ys)
+        return table_peak(scores, xs, ys)
+
+    def compute_fluor_baseline(self, params, labels=None, count=None):
+        """computes fluor_baseline, the mean fluorescence of the clip farther than
+           params.baseline_margin pixels from the phase mask
+
+           If labels (a label image of the cells in the clip, as ImageCells.labels)
+           is given, also returns an array with the baseline of each cell: the
+           mean fluorescence of its ring, the pixels between baseline_margin and
+           baseline_margin + baseline_width from the mask whose nearest mask pixel
+           is in the cell. Both come from a single distance transform with the
+           indices of the nearest mask pixels, and the rings are averaged with
+           bincount; cells with an empty ring get fluor_baseline.
+           count is the number of cells (e.g. ImageCells.count), the baseline
+           of cell k being element k - 1; labels.max() if None.
+        """
+
+        fluor = self.fluor_clip()
+        mask = self.phase_mask.get_mask()
+        if labels is not None and count is None:
+            count = labels.max()
+        if mask is None or not mask.any():
+            self.fluor_baseline = np.mean(fluor)
+            if labels is None:
+                return None
+            return np.zeros(count) + self.fluor_baseline
+
+        if labels is None:
+            distance = ndimage.distance_transform_edt(~mask)
+        else:
+            distance, indices = ndimage.distance_transform_edt(~mask, return_indices=True)
+        background = distance > params.baseline_margin
+        if background.any():
+            self.fluor_baseline = np.mean(fluor[background])
+        else:
+            self.fluor_baseline = np.mean(fluor)
+        if labels is None:
+            return None
+
+        ring = background & (distance <= params.baseline_margin + params.baseline_width)
+        distance = background = None
+        xs, ys = np.nonzero(ring)
+        nearest = labels[indices[0][xs, ys], indices[1][xs, ys]]
+        indices = None
+        counts = np.bincount(nearest, minlength=count + 1)[1:count+1]
+        sums = np.bincount(nearest, fluor[xs, ys].astype(np.float64), count + 1)[1:count+1]
+        res = np.zeros(count) + self.fluor_baseline
+        measured = counts > 0
+        res[measured] = sums[measured] / counts[measured]
+        return res
+
+    def pack_masks(self):
+        """packs the masks and the cached mask stages to one bit per pixel
+           (for frames kept in memory between requests)
+        """
+
+        for mask in (self.base_mask, self.phase_mask):
+            if mask is not None:
+                mask.pack()
+        self.mask_pipeline.pack()
 
-        
     def clear_masks(self):
         """Disposes of masks and sets them to None """
         if self.base_mask is not None:
@@ -189,22 +1229,166 @@ class FluorFrame:
         self.phase_mask = None
         
 
+    def mask_source(self):
+        """returns (image, key) with the clip region of the image used for masks
+           (phase if loaded, fluorescence otherwise) and a key identifying it
+        """
+
+        x1, y1, x2, y2 = self.clip
+        if self.phase_image is None:
+            return (self.fluor_image[x1:x2,y1:y2], ('fluor', self.image_version, self.clip))
+        return (self.phase_image[x1:x2,y1:y2], ('phase', self.image_version, self.clip))
+
+    def get_histogram(self, nbins=256):
+        """returns the ImageHistogram of the mask source image, computed once per image"""
+
+        image, image_key = self.mask_source()
+        key = (image_key, nbins)
+        if key not in self.histograms:
+            self.histograms = dict((k, v) for k, v in self.histograms.items() if k[0] == image_key)
+            self.histograms[key] = ImageHistogram(image, nbins)
+        return self.histograms[key]
+
+    def threshold_coverage(self, thresholds, invert=False, nbins=256):
+        """returns the fraction of the mask source image that is foreground for each
+           absolute threshold, from the cached histogram (see ImageHistogram.coverage)
+
+           Foreground are the pixels <= threshold, or > threshold if invert;
+           thresholds are for intensities in [0, 1], as absolute_threshold
+        """
+
+        histogram = self.get_histogram(nbins)
+        coverage = histogram.coverage(np.asarray(thresholds) * histogram.scale)
+        if invert:
+            return 1 - coverage
+        return coverage
+
     def create_masks(self,mask_parameters,create_phase=True):
         """creates the base mask and the phase mask
             base_mask has no hole filling or closing
-            phase mask background is white, cells are black"""
+            phase mask background is white, cells are black
+
+            Stages whose parameters did not change since the last call are
+            taken from mask_pipeline; mask_pipeline.last_run reports which"""
 
         self.clear_masks()        
-        x1, y1, x2, y2 = self.clip
+        if mask_parameters.tile_size > 0 and max(self.clip[2] - self.clip[0],
+                                                 self.clip[3] - self.clip[1]) > mask_parameters.tile_size:
+            self.tiled_masks(mask_parameters, create_phase)
+            return
+        image, image_key = self.mask_source()
+        last = 'invert'
+        if create_phase:
+            last = 'dilation'
+        results = self.mask_pipeline.run(image, image_key, mask_parameters, last,
+                                         self.get_histogram)
+
         self.base_mask = Mask()
-        if self.phase_image is None:
-            self.base_mask.compute_base_mask(self.fluor_image[x1:x2,y1:y2],mask_parameters)            
-        else:
-            self.base_mask.compute_base_mask(self.phase_image[x1:x2,y1:y2],mask_parameters)
-            
+        self.base_mask.mask = results['invert']
         if create_phase:
             self.phase_mask = Mask()
-            self.phase_mask.compute_phase_mask(self.base_mask.mask,mask_parameters)
+            self.phase_mask.mask = results['dilation']
+
+    def tiled_histogram(self, tiles, nbins=256):
+        """returns the ImageHistogram of the mask source image computed tile by tile,
+           for images too large to convert at once (see tiled_masks)
+
+           tiles is a list of (x1, y1, x2, y2) regions covering the image once
+        """
+
+        image, x1, y1 = self.tile_source()
+        low, high = None, None
+        for tx1, ty1, tx2, ty2 in tiles:
+            region = image[x1+tx1:x1+tx2, y1+ty1:y1+ty2]
+            if low is None:
+                low, high = np.min(region), np.max(region)
+            else:
+                low, high = min(low, np.min(region)), max(high, np.max(region))
+        histogram = None
+        for tx1, ty1, tx2, ty2 in tiles:
+            region = image[x1+tx1:x1+tx2, y1+ty1:y1+ty2]
+            if histogram is None:
+                histogram = ImageHistogram(region, nbins, (low, high))
+            else:
+                histogram.add(region)
+        return histogram
+
+    def tile_source(self):
+        """returns (image, x1, y1), the unclipped mask source image and the clip origin"""
+
+        image = self.phase_image
+        if image is None:
+            image = self.fluor_image
+        return (image, self.clip[0], self.clip[1])
+
+    def tiled_masks(self, mask_parameters, create_phase=True):
+        """creates the base and phase masks tile by tile, for images too large to
+           process at once
+
+           Tiles of mask_parameters.tile_size pixels are read with a halo (see
+           mask_halo) and processed by mask_parameters.tile_workers processes,
+           a few tiles at a time, so only those tiles are converted to float.
+           The cores are stitched without seams: the masks are the same as from
+           the whole image except for threshold rounding in the summed-area
+           tables. The automatic threshold is computed once, from a histogram
+           of all tiles, and hole filling (with the dilation after it) is done
+           on the stitched mask. Tiled masks are not cached in mask_pipeline.
+        """
+
+        image, x1, y1 = self.tile_source()
+        shape = (self.clip[2] - self.clip[0], self.clip[3] - self.clip[1])
+        tile_size = mask_parameters.tile_size
+        params = copy.copy(mask_parameters)
+        if mask_parameters.auto_threshold:
+            cores = [core for core, _ in tile_grid(shape, tile_size, 0)]
+            histogram = self.tiled_histogram(cores)
+            mask_parameters.absolute_threshold = histogram.threshold(mask_parameters.auto_method) / histogram.scale
+            params.absolute_threshold = mask_parameters.absolute_threshold
+            params.auto_threshold = False
+
+        base = np.zeros(shape, np.bool_)
+        phase = None
+        if create_phase:
+            phase = np.zeros(shape, np.bool_)
+
+        def tasks(grid):
+            for outer, core in grid:
+                ox1, oy1, ox2, oy2 = outer
+                yield (image[x1+ox1:x1+ox2, y1+oy1:y1+oy2], core, params, create_phase)
+
+        grid = list(tile_grid(shape, tile_size, mask_halo(params)))
+        workers = max(1, mask_parameters.tile_workers)
+        pool = None
+        if workers > 1:
+            pool = multiprocessing.Pool(workers)
+        try:
+            # a few tiles per worker at a time, to bound the tiles held in memory
+            step = 2 * workers
+            for start in range(0, len(grid), step):
+                chunk = grid[start:start+step]
+                if pool is None:
+                    results = map(mask_tile, tasks(chunk))
+                else:
+                    results = pool.map(mask_tile, list(tasks(chunk)))
+                for (outer, core), (base_tile, phase_tile) in zip(chunk, results):
+                    tx1, ty1 = outer[0] + core[0], outer[1] + core[1]
+                    tx2, ty2 = tx1 + base_tile.shape[0], ty1 + base_tile.shape[1]
+                    base[tx1:tx2, ty1:ty2] = base_tile
+                    if create_phase:
+                        phase[tx1:tx2, ty1:ty2] = phase_tile
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        self.mask_pipeline.last_run = []
+        self.base_mask = Mask()
+        self.base_mask.mask = base
+        if create_phase:
+            if params.fill_holes:
+                phase = dilated(filled(phase), params.dilation, params.morphology)
+            self.phase_mask = Mask()
+            self.phase_mask.mask = phase
 
     def mask_image_pair(self,mask='base',image='phase'):
         """returns a tuple of ndmatrices, (mask, image), with the selected combination"""
@@ -212,14 +1396,14 @@ class FluorFrame:
         x1, y1, x2, y2 = self.clip
         
         if mask=='base':
-            amask=self.base_mask.mask
+            amask=self.base_mask.get_mask()
         else:
-            amask=self.phase_mask.mask
+            amask=self.phase_mask.get_mask()
 
         if image=='phase':
             aimage=self.phase_image[x1:x2,y1:y2]
         else:
-            aimage=self.fluor_image[x1:x2,y1:y2]
+            aimage=self.fluor_clip()
         return (amask,aimage)
 
     def mask_overlay(self, back, fore, mask='base',image='phase'):        
@@ -227,15 +1411,27 @@ class FluorFrame:
            and by fore inside the mask.
 
            back and fore are triples with color intensities e.g (1,0,0) (1,1,0) for red and yellow
+           The result is a uint8 array, ready for imsave, in overlay_buffer: it is
+           overwritten by the next call, so copy it to keep it. The colors are
+           taken from a two entry table indexed by the mask and multiplied by the
+           image in one pass over a float32 buffer, also kept for the next call.
         """
         amask,aimage = self.mask_image_pair(mask,image)
         res = None
         if amask is not None and aimage is not None:            
             w, h = amask.shape
-            res = np.empty((w, h, 3), dtype=np.float)
-            res[:,:,0] = (1-amask) * back[0] * aimage + amask * fore[0] * aimage
-            res[:,:,1] = (1-amask) * back[1] * aimage + amask * fore[1] * aimage
-            res[:,:,2] = (1-amask) * back[2] * aimage + amask * fore[2] * aimage
+            if self.overlay_buffer is None or self.overlay_buffer.shape != (w, h, 3):
+                self.overlay_buffer = np.empty((w, h, 3), dtype=np.uint8)
+                self.overlay_work = np.empty((w, h, 3), dtype=np.float32)
+            work = self.overlay_work
+            # colors scaled so that full intensity of the image is 255
+            colors = np.array([back, fore], dtype=np.float32) * np.float32(255 / image_scale(aimage))
+            np.take(colors, amask.view(np.uint8), axis=0, out=work, mode='clip')
+            np.multiply(work, aimage[:, :, np.newaxis], out=work, casting='unsafe')
+            np.clip(work, 0, 255, out=work)
+            work += 0.5
+            res = self.overlay_buffer
+            np.copyto(res, work, casting='unsafe')
             
         return res
         
@@ -244,10 +1440,32 @@ class FluorFrame:
         """overlays a mask with an image
            The mask can be 'base' or 'phase'
            The image can be 'flur' or 'phase'
+
+           Returns the image in gray with the mask boundary (cached in the Mask,
+           see Mask.get_boundary) in color, as uint8 RGB in overlay_buffer like
+           mask_overlay
         """
         amask,aimage = self.mask_image_pair(mask,image)
 
         res = None
         if amask is not None and aimage is not None:            
-            res = mark_boundaries(aimage,amask,color = color, outline_color=None)
+            if mask == 'base':
+                boundary = self.base_mask.get_boundary()
+            else:
+                boundary = self.phase_mask.get_boundary()
+            res = self.mask_overlay((1,1,1), (1,1,1), mask, image)
+            res[boundary] = np.round(np.array(color) * 255).astype(np.uint8)
         return res
+
+    def mask_contours(self, mask='base', tolerance=0.5):
+        """returns the contour polylines of the mask ('base' or 'phase') in clip
+           coordinates, cached in the Mask (see Mask.get_contours), and the clip shape
+        """
+
+        amask = self.base_mask
+        if mask != 'base':
+            amask = self.phase_mask
+        if amask is None or (amask.mask is None and amask.packed is None):
+            return ([], (0, 0))
+        shape = (self.clip[2] - self.clip[0], self.clip[3] - self.clip[1])
+        return (amask.get_contours(tolerance), shape)
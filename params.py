@@ -2,6 +2,8 @@
 
 import numpy as np
 import ConfigParser as cp
+import copy
+import itertools
 
 
 class MaskParameters:
@@ -11,18 +13,22 @@ class MaskParameters:
     exported = [('algorithm','Mask algorithm'),
                 ('blocksize','Block size (local)'),
                 ('offset','Offset (local)'),
+                ('local_k','Deviation weight (local integral)'),
+                ('local_range','Deviation range (local integral)'),
                 ('absolute_threshold','Threshold (absolute)'),
                 ('auto_threshold','Automatic threshold'),
+                ('auto_method','Automatic threshold method'),
                 ('fill_holes','Fill mask holes'),
                 ('closing','Radius of closing'),
                 ('dilation','Radius of dilation'),
+                ('morphology','Closing and dilation method'),
                 ('invert','Invert mask')]
     """List of tuples with names and labels of attributes that are to be
        exported to the user"""
 
     
     def __init__(self):
-        self.algorithms = ['Local Average', 'Absolute']
+        self.algorithms = ['Local Average', 'Absolute', 'Local Integral']
         """list of acceptable algorithms for mask generation"""
         #FIXME: perhaps this should be a class attribute <LK 2015-2-7>
         
@@ -32,9 +38,16 @@ class MaskParameters:
         self.blocksize = 100           # block size for moving average
         self.offset = 0.0              # offset for moving average
 
+        # local integral: moving average from summed-area tables, cost independent of blocksize
+        self.local_k = 0.0             # weight of the local standard deviation (Sauvola), 0 for mean only
+        self.local_range = 0.5         # dynamic range of the standard deviation (Sauvola R)
+
         # absolute
         self.absolute_threshold = 0.2  # cutoff value for background
-        self.auto_threshold = True     # compute threshold with isodata
+        self.auto_threshold = True     # compute threshold with auto_method
+        self.auto_methods = ['Isodata', 'Otsu']
+        """list of acceptable methods for the automatic threshold"""
+        self.auto_method = 'Isodata'   # global threshold method, computed from the image histogram
 
         #postprocessing
         self.fill_holes = False        # fill holes in enclosed regions, useful if cells are not uniform dark blobs
@@ -42,6 +55,15 @@ class MaskParameters:
         self.dilation = 0              # mask dilation iterations
         self.invert = False            # False for default of black shapes on white background
 
+        self.morphologies = ['Disk', 'Distance']
+        """list of acceptable methods for closing and dilation"""
+        self.morphology = 'Disk'       # 'Disk' scans the disk footprint, 'Distance' thresholds distance transforms
+                                       # (same masks, cost independent of the radius)
+
+        # tiled processing, for images too large to process at once
+        self.tile_size = 0             # side of the tiles in pixels, 0 to process the whole image
+        self.tile_workers = 1          # number of processes computing tiles in parallel
+
     def load_from_parser(self,parser,section):
         """Loads mask parameters from a ConfigParser object of the configuration file
            The section parameters specifies the configuration file section
@@ -59,6 +81,22 @@ class MaskParameters:
             self.algorithm = self.algorithms[0]              
         self.closing = parser.getint(section, 'mask_closing')
         self.invert = parser.getboolean(section, 'mask_invert')
+        if parser.has_option(section, 'mask_local_k'):
+            self.local_k = parser.getfloat(section, 'mask_local_k')
+        if parser.has_option(section, 'mask_local_range'):
+            self.local_range = parser.getfloat(section, 'mask_local_range')
+        if parser.has_option(section, 'mask_auto_method'):
+            tmp = parser.get(section, 'mask_auto_method')
+            if tmp in self.auto_methods:
+                self.auto_method = tmp
+        if parser.has_option(section, 'mask_morphology'):
+            tmp = parser.get(section, 'mask_morphology')
+            if tmp in self.morphologies:
+                self.morphology = tmp
+        if parser.has_option(section, 'mask_tile_size'):
+            self.tile_size = parser.getint(section, 'mask_tile_size')
+        if parser.has_option(section, 'mask_tile_workers'):
+            self.tile_workers = parser.getint(section, 'mask_tile_workers')
 
     def save_to_parser(self,parser,section):
         """Saves mask parameters to a ConfigParser object of the configuration file
@@ -75,11 +113,35 @@ class MaskParameters:
         parser.set(section, 'mask_closing', self.closing)
         parser.set(section, 'mask_dilation', self.dilation)
         parser.set(section, 'mask_invert', self.invert)
+        parser.set(section, 'mask_local_k', self.local_k)
+        parser.set(section, 'mask_local_range', self.local_range)
+        parser.set(section, 'mask_morphology', self.morphology)
+        parser.set(section, 'mask_auto_method', self.auto_method)
+        parser.set(section, 'mask_tile_size', self.tile_size)
+        parser.set(section, 'mask_tile_workers', self.tile_workers)
+
 
 
 
 
 
+def parameter_grid(base, values):
+    """returns a list of copies of the base parameters object, one for each
+       combination of values
+
+       values is a dictionary of attribute name: list of values, for example
+       parameter_grid(MaskParameters(), {'closing': [1, 2, 3], 'dilation': [0, 1]})
+    """
+
+    names = sorted(values.keys())
+    grid = []
+    for combination in itertools.product(*[values[name] for name in names]):
+        params = copy.deepcopy(base)
+        for name, value in zip(names, combination):
+            setattr(params, name, value)
+        grid.append(params)
+    return grid
+
 
 class FluorFrameParameters:
     """Stores parameters for the fluorescence microscropy frame
@@ -113,6 +175,36 @@ class FluorFrameParameters:
         """
         self.baseline_margin = 20
         """int: number of pixels away from mask where fluorescence baseline is computed"""
+        self.baseline_width = 5
+        """int: width in pixels of the ring around each cell, beyond baseline_margin, used for its own baseline"""
+
+        self.track_margin = 3
+        """int: when aligning the frames of a stack, search only this margin around the
+                offset of the previous frame (0 to search all offsets in every frame)
+        """
+        self.stack_interleaved = False
+        """bool: if true, the pages of a multi page fluor_file alternate phase and fluorescence images"""
+
+        self.lazy_loading = False
+        """bool: if true, uncompressed TIFF files are memory mapped and only the regions used
+                 (clip plus alignment margin) are read and converted to float. The phase
+                 intensity is then rescaled to the range of the clip region, not the whole image
+        """
+
+        self.precisions = ['float64', 'float32', 'uint16']
+        """list of acceptable precisions for the converted images"""
+        self.precision = 'float64'
+        """str: type of the phase image and of converted fluorescence images. 'float32' halves
+                memory and bandwidth, 'uint16' keeps the 16 bits of microscopy data at a quarter of
+                float64 (thresholds are then scaled to the integer range)
+        """
+
+        self.align_algorithms = ['FFT', 'Exhaustive', 'Pyramid']
+        """list of acceptable algorithms for aligning fluorescence and phase"""
+        self.align_algorithm = 'FFT'
+        """str: 'FFT' scores all offsets with one cross-correlation, 'Exhaustive' scores each offset separately,
+                'Pyramid' searches coarse to fine on downsampled images (for large align_margin)
+        """
 
     def load_from_parser(self,parser,section):
         """Loads frame parameters from a ConfigParser object of the configuration file
@@ -125,6 +217,22 @@ class FluorFrameParameters:
         self.fluor_file = parser.get(section, 'fluor_file')
         self.align_margin = parser.getint(section, 'align_margin')
         self.baseline_margin = parser.getint(section, 'baseline_margin')
+        if parser.has_option(section, 'baseline_width'):
+            self.baseline_width = parser.getint(section, 'baseline_width')
+        if parser.has_option(section, 'track_margin'):
+            self.track_margin = parser.getint(section, 'track_margin')
+        if parser.has_option(section, 'stack_interleaved'):
+            self.stack_interleaved = parser.getboolean(section, 'stack_interleaved')
+        if parser.has_option(section, 'lazy_loading'):
+            self.lazy_loading = parser.getboolean(section, 'lazy_loading')
+        if parser.has_option(section, 'align_algorithm'):
+            tmp = parser.get(section, 'align_algorithm')
+            if tmp in self.align_algorithms:
+                self.align_algorithm = tmp
+        if parser.has_option(section, 'precision'):
+            tmp = parser.get(section, 'precision')
+            if tmp in self.precisions:
+                self.precision = tmp
         
     def save_to_parser(self,parser,section):
         """Saves mask parameters to a ConfigParser object of the configuration file
@@ -138,6 +246,12 @@ class FluorFrameParameters:
         parser.set(section, 'fluor_file', self.fluor_file)
         parser.set(section, 'align_margin', self.align_margin)
         parser.set(section, 'baseline_margin', self.baseline_margin)
+        parser.set(section, 'baseline_width', self.baseline_width)
+        parser.set(section, 'align_algorithm', self.align_algorithm)
+        parser.set(section, 'lazy_loading', self.lazy_loading)
+        parser.set(section, 'track_margin', self.track_margin)
+        parser.set(section, 'stack_interleaved', self.stack_interleaved)
+        parser.set(section, 'precision', self.precision)
       
     
 class Parameters:
@@ -145,9 +259,9 @@ class Parameters:
     def __init__(self):
         self.mask_params = MaskParameters()
         self.fluor_frame_params = FluorFrameParameters()
+        self.imageprocessingparams = ImageProcessingParameters()
         # TODO implement the other parameters
         # <LK 2015-06-27>        
-        #self.imageprocessingparams = ImageProcessingParameters()
         #self.generatereportparams = GenerateReportParameters()
 
     def load_parameters(self,filename):
@@ -157,6 +271,7 @@ class Parameters:
         parser.read(filename)
         self.mask_params.load_from_parser(parser,'Mask')
         self.fluor_frame_params.load_from_parser(parser,'Frame')
+        self.imageprocessingparams.load_from_parser(parser,'ImageProcessing')
         # TODO implement loading for the other parameters
         # <LK 2015-06-27>
         
@@ -167,6 +282,7 @@ class Parameters:
         parser = cp.ConfigParser()
         self.mask_params.save_to_parser(parser,'Mask')
         self.fluor_frame_params.save_to_parser(parser,'Frame')
+        self.imageprocessingparams.save_to_parser(parser,'ImageProcessing')
         # TODO implement loading for the other parameters
         # <LK 2015-06-27>
         cfgfile = open(filename,'w')
@@ -175,9 +291,59 @@ class Parameters:
         
       
 class ImageProcessingParameters:
+    """Stores, loads and saves parameters for finding the regions (cells) in the phase mask
+       and the regions (perimeter and septum) of each cell"""
+
+    exported = [('watershed','Split touching regions'),
+                ('peak_min_distance','Minimum distance between region centres'),
+                ('min_area','Minimum region area'),
+                ('max_area','Maximum region area (0 for no limit)'),
+                ('perimeter_width','Perimeter width'),
+                ('septum_width','Septum width')]
+    """List of tuples with names and labels of attributes that are to be
+       exported to the user"""
 
     def __init__(self):
-        pass
+        self.watershed = True          # split touching regions with a watershed of the distance transform
+        self.peak_min_distance = 5     # minimum distance, in pixels, between the centres of split regions
+        self.min_area = 20             # regions with fewer pixels are discarded
+        self.max_area = 0              # regions with more pixels are discarded, 0 for no limit
+        self.perimeter_width = 3       # pixels from the cell edge in the perimeter of the cell
+        self.septum_width = 3          # width of the septum, across the major axis through the cell centre
+
+    def load_from_parser(self,parser,section):
+        """Loads region parameters from a ConfigParser object of the configuration file
+           The section parameters specifies the configuration file section
+           Files without the section keep the default values
+        """
+
+        if not parser.has_section(section):
+            return
+        if parser.has_option(section, 'watershed'):
+            self.watershed = parser.getboolean(section, 'watershed')
+        if parser.has_option(section, 'peak_min_distance'):
+            self.peak_min_distance = parser.getint(section, 'peak_min_distance')
+        if parser.has_option(section, 'min_area'):
+            self.min_area = parser.getint(section, 'min_area')
+        if parser.has_option(section, 'max_area'):
+            self.max_area = parser.getint(section, 'max_area')
+        if parser.has_option(section, 'perimeter_width'):
+            self.perimeter_width = parser.getint(section, 'perimeter_width')
+        if parser.has_option(section, 'septum_width'):
+            self.septum_width = parser.getint(section, 'septum_width')
+
+    def save_to_parser(self,parser,section):
+        """Saves region parameters to a ConfigParser object of the configuration file
+           It creates the section if it does not exist.
+        """
+        if section not in parser.sections():
+            parser.add_section(section)
+        parser.set(section, 'watershed', self.watershed)
+        parser.set(section, 'peak_min_distance', self.peak_min_distance)
+        parser.set(section, 'min_area', self.min_area)
+        parser.set(section, 'max_area', self.max_area)
+        parser.set(section, 'perimeter_width', self.perimeter_width)
+        parser.set(section, 'septum_width', self.septum_width)
 
 class GenerateReportParameters:
 
@@ -1,6 +1,262 @@
-"""Module used to store and process the information used to generate the report"""
+"""Module used to store and process the information used to generate the report
+
+   A report is a table written in chunks, so it never needs to fit in memory:
+   rows are appended to a CSV file and each column to a raw binary file
+   (<name>.<column>.bin) that can be memory mapped with read_report. The
+   column names and types and the number of rows are kept in
+   <name>.schema.json. Reports written by parallel workers are joined with
+   merge_reports.
+
+   String columns widen to their longest value: when a longer value is
+   appended, the rows already written to the column file are rewritten with
+   the new width.
+"""
+
+import os
+import json
+import shutil
+import numpy as np
+
+COPY_ROWS = 100000
+"""int: rows converted at a time when a column file is copied to a wider type"""
+
+
+def read_schema(folder, name):
+    """returns the schema of a report: dict with columns, a list of [name, dtype], and rows"""
+
+    fil = open(os.path.join(folder, name + '.schema.json'))
+    schema = json.load(fil)
+    fil.close()
+    return schema
+
+
+def write_schema(folder, name, schema):
+    """writes the schema of a report, replacing the file only when complete"""
+
+    filename = os.path.join(folder, name + '.schema.json')
+    temp = filename + '.tmp'
+    fil = open(temp, 'w')
+    json.dump(schema, fil, indent=1)
+    fil.close()
+    if os.path.exists(filename) and os.name == 'nt':
+        os.remove(filename)
+    os.rename(temp, filename)
+
+
+def column_file(folder, name, column):
+    """returns the file name of the raw data of a report column"""
+
+    return os.path.join(folder, '%s.%s.bin' % (name, column))
+
+
+def copy_column(filename, dtype, out, out_dtype):
+    """appends the column file filename, of dtype, to the open file out converted
+       to out_dtype, COPY_ROWS rows at a time (a plain copy if the types are equal)
+    """
+
+    fil = open(filename, 'rb')
+    if np.dtype(dtype) == np.dtype(out_dtype):
+        shutil.copyfileobj(fil, out)
+    else:
+        block = np.fromfile(fil, dtype, COPY_ROWS)
+        while len(block) > 0:
+            block.astype(out_dtype).tofile(out)
+            block = np.fromfile(fil, dtype, COPY_ROWS)
+    fil.close()
+
+
+def csv_strings(values):
+    """returns string values as an object array, quoted as CSV fields where they
+       contain commas, quotes or line breaks
+    """
+
+    res = values.astype(object)
+    for index, value in enumerate(res):
+        if ',' in value or '"' in value or '\n' in value or '\r' in value:
+            res[index] = '"%s"' % value.replace('"', '""')
+    return res
+
+
+def csv_format(dtype):
+    """returns the printf format of a column type in the CSV file"""
+
+    if dtype.kind == 'f':
+        return '%.10g'
+    if dtype.kind in 'iub':
+        return '%d'
+    return '%s'
+
+
+def read_report(folder, name):
+    """returns a dictionary of the columns of a report as read only memory mapped
+       arrays, so large reports are read only where used
+    """
+
+    schema = read_schema(folder, name)
+    res = {}
+    for column, dtype in schema['columns']:
+        if schema['rows'] == 0:
+            res[column] = np.zeros(0, dtype)
+        else:
+            res[column] = np.memmap(column_file(folder, name, column), dtype=dtype, mode='r',
+                                    shape=(schema['rows'],))
+    return res
+
+
+def merge_reports(parts, folder, name):
+    """joins the reports (folder, name) in parts into a new report, copying the
+       files in blocks; all parts must have the same columns
+    """
+
+    schemas = [read_schema(part_folder, part_name) for part_folder, part_name in parts]
+    kinds = [[(column, np.dtype(dtype).kind) for column, dtype in schema['columns']]
+             for schema in schemas]
+    for schema_kinds in kinds[1:]:
+        if schema_kinds != kinds[0]:
+            raise ValueError('Reports with different columns cannot be merged')
+    # parts may differ in width (e.g. the longest frame name of each part)
+    columns = []
+    for position, (column, dtype) in enumerate(schemas[0]['columns']):
+        dtypes = [np.dtype(schema['columns'][position][1]) for schema in schemas]
+        columns.append([column, reduce(np.promote_types, dtypes).str])
+    for position, (column, dtype) in enumerate(columns):
+        out = open(column_file(folder, name, column), 'wb')
+        for (part_folder, part_name), schema in zip(parts, schemas):
+            copy_column(column_file(part_folder, part_name, column),
+                        schema['columns'][position][1], out, dtype)
+        out.close()
+    out = open(os.path.join(folder, name + '.csv'), 'w')
+    for index, (part_folder, part_name) in enumerate(parts):
+        fil = open(os.path.join(part_folder, part_name + '.csv'))
+        header = fil.readline()
+        if index == 0:
+            out.write(header)
+        shutil.copyfileobj(fil, out)
+        fil.close()
+    out.close()
+    write_schema(folder, name, {'columns': columns,
+                                'rows': sum(schema['rows'] for schema in schemas)})
+
 
 class Report:
+    """Table written incrementally to CSV and to raw column files
+
+       Rows are appended as columns of arrays (e.g. ImageCells.columns) and
+       kept until chunk_rows rows are buffered, then written to the files.
+       The columns are set by the first append; string columns are widened
+       when longer values are appended (see widen). Call close to write the
+       last rows.
+    """
+
+    def __init__(self, folder, name='cells', chunk_rows=10000):
+        self.folder = folder
+        """str: folder of the report files"""
+        self.name = name
+        """str: report name, the prefix of its files"""
+        self.chunk_rows = chunk_rows
+        """int: number of rows buffered before writing"""
+        self.columns = None
+        """list: (name, numpy.dtype) of the columns, in file order"""
+        self.buffers = []
+        """list: dictionaries of arrays appended and not yet written"""
+        self.buffered = 0
+        """int: number of rows in buffers"""
+        self.rows = 0
+        """int: number of rows written"""
+
+    def start(self, values):
+        """sets the columns from the first rows and creates the files"""
+
+        self.columns = []
+        for column in sorted(values):
+            self.columns.append((column, np.asarray(values[column]).dtype))
+        for column, dtype in self.columns:
+            open(column_file(self.folder, self.name, column), 'wb').close()
+        fil = open(os.path.join(self.folder, self.name + '.csv'), 'w')
+        fil.write(','.join(column for column, dtype in self.columns) + '\n')
+        fil.close()
+        self.write_schema()
+
+    def append(self, values, **constants):
+        """appends rows given as a dictionary of arrays, one per column, of the
+           same length; constants are columns with the same value in every row
+           (e.g. frame='frame_01')
+        """
+
+        values = dict(values)
+        length = len(values.values()[0])
+        for column, value in constants.items():
+            values[column] = np.repeat(np.asarray(value), length)
+        if self.columns is None:
+            self.start(values)
+        if sorted(values) != [column for column, dtype in self.columns]:
+            raise ValueError('Rows must have the columns of the report')
+        self.widen(values)
+        self.buffers.append(values)
+        self.buffered += length
+        if self.buffered >= self.chunk_rows:
+            self.flush()
+
+    def widen(self, values):
+        """widens the string columns to fit values, rewriting the rows already
+           written to their column files
+        """
+
+        widened = False
+        for position, (column, dtype) in enumerate(self.columns):
+            value_dtype = np.asarray(values[column]).dtype
+            if dtype.kind not in 'SU' or value_dtype.kind != dtype.kind or \
+               value_dtype.itemsize <= dtype.itemsize:
+                continue
+            filename = column_file(self.folder, self.name, column)
+            out = open(filename + '.tmp', 'wb')
+            copy_column(filename, dtype, out, value_dtype)
+            out.close()
+            if os.name == 'nt':
+                os.remove(filename)
+            os.rename(filename + '.tmp', filename)
+            self.columns[position] = (column, value_dtype)
+            widened = True
+        if widened:
+            self.write_schema()
+
+    def flush(self):
+        """writes the buffered rows to the files"""
+
+        if self.buffered == 0:
+            return
+        table = np.empty(self.buffered, dtype=[(column, dtype) for column, dtype in self.columns])
+        for column, dtype in self.columns:
+            table[column] = np.concatenate([values[column] for values in self.buffers])
+            fil = open(column_file(self.folder, self.name, column), 'ab')
+            table[column].tofile(fil)
+            fil.close()
+        self.buffers = []
+        text = np.empty(self.buffered, dtype=[(column, object if dtype.kind in 'SU' else dtype)
+                                              for column, dtype in self.columns])
+        for column, dtype in self.columns:
+            if dtype.kind in 'SU':
+                text[column] = csv_strings(table[column])
+            else:
+                text[column] = table[column]
+        table = None
+        fil = open(os.path.join(self.folder, self.name + '.csv'), 'a')
+        np.savetxt(fil, text, fmt=[csv_format(dtype) for column, dtype in self.columns],
+                   delimiter=',')
+        fil.close()
+        self.rows += self.buffered
+        self.buffered = 0
+        self.write_schema()
+
+    def write_schema(self):
+        """writes the columns and the number of rows written"""
+
+        write_schema(self.folder, self.name,
+                     {'columns': [[column, dtype.str] for column, dtype in self.columns],
+                      'rows': self.rows})
+
+    def close(self):
+        """writes the remaining rows"""
 
-    def __init__(self):
-        pass
+        if self.columns is not None:
+            self.flush()
@@ -1,14 +1,172 @@
-"""Module used to find and process the regions of the image"""
+"""Module used to find and process the regions of the image
+
+   Regions are the connected components of the phase mask, optionally split
+   by a watershed of the distance transform. All regions share one label
+   image, and their properties are computed for all regions at once with
+   bincount reductions over the foreground pixels.
+"""
+
+import numpy as np
+from scipy import ndimage
+from skimage.morphology import watershed
+
+
+def split_regions(mask, labels, min_distance):
+    """returns the labels of the mask split by a watershed of the distance transform
+
+       Markers are the maxima of the distance to the background within
+       min_distance pixels; plateaus give a single marker and every connected
+       component of labels gets at least one, so no region is lost
+    """
+
+    distance = ndimage.distance_transform_edt(mask)
+    size = 2 * min_distance + 1
+    peaks = (distance == ndimage.maximum_filter(distance, size=size)) & mask
+    markers, count = ndimage.label(peaks)
+
+    components = labels.max()
+    marked = np.zeros(components + 1, np.bool_)
+    marked[labels[peaks]] = True
+    missing = np.nonzero(~marked[1:])[0] + 1
+    if len(missing) > 0:
+        positions = ndimage.maximum_position(distance, labels, missing)
+        rows, columns = np.array(positions, dtype=np.intp).reshape(-1, 2).T
+        markers[rows, columns] = np.arange(count + 1, count + 1 + len(missing))
+    distance = -distance
+    return watershed(distance, markers, mask=mask)
+
+
+def relabel(labels, keep):
+    """returns labels renumbered 1..n for the labels with keep True (keep[0] is the
+       background), the others set to 0, in one pass through a lookup table
+    """
+
+    lookup = np.zeros(len(keep), np.int32)
+    lookup[keep] = np.arange(1, np.count_nonzero(keep) + 1)
+    return lookup[labels]
+
 
 class Region:
-    """class used to store the attributes of each individual region"""
+    """class used to store the attributes of each individual region
 
-    def __init__(self):
-        pass
+       A view of one region of an ImageRegions object; the attributes are
+       read from its arrays when the Region is created
+    """
+
+    def __init__(self, regions, index):
+        self.regions = regions
+        """ImageRegions: the regions this region belongs to"""
+        self.label = index + 1
+        """int: value of the region in regions.labels"""
+        self.area = regions.areas[index]
+        """int: number of pixels"""
+        self.centroid = tuple(regions.centroids[index])
+        """tuple: (x, y) mean pixel position"""
+        self.box = tuple(regions.boxes[index])
+        """tuple: (x1, y1, x2, y2) bounding box, x2 and y2 excluded as in the clip"""
+        self.eccentricity = regions.eccentricities[index]
+        """float: eccentricity of the ellipse with the same second moments (0 for a disk)"""
+
+    def get_mask(self):
+        """returns the boolean mask of the region within its bounding box"""
+
+        x1, y1, x2, y2 = self.box
+        return self.regions.labels[x1:x2, y1:y2] == self.label
 
 
 class ImageRegions:
-    """class used to store all the regions belonging to the image"""
+    """class used to store all the regions belonging to the image
+
+       Per region properties are arrays indexed by label - 1
+    """
 
     def __init__(self):
-        pass
+        self.labels = None
+        """ndarray: int32 image with the label of each region, 0 for background"""
+        self.count = 0
+        """int: number of regions"""
+        self.areas = np.zeros(0, np.int64)
+        """ndarray: number of pixels of each region"""
+        self.centroids = np.zeros((0, 2))
+        """ndarray: (count, 2) mean (x, y) of each region"""
+        self.boxes = np.zeros((0, 4), np.int32)
+        """ndarray: (count, 4) bounding boxes (x1, y1, x2, y2), x2 and y2 excluded"""
+        self.eccentricities = np.zeros(0)
+        """ndarray: eccentricity of each region"""
+
+    def compute_labels(self, mask, params):
+        """labels the connected components of the mask, split with a watershed
+           if params.watershed, without the regions outside the area limits
+
+           params is an ImageProcessingParameters object
+        """
+
+        labels, count = ndimage.label(mask)
+        if params.watershed and count > 0:
+            labels = split_regions(mask, labels, params.peak_min_distance)
+        areas = np.bincount(labels.ravel())
+        keep = areas >= params.min_area
+        if params.max_area > 0:
+            keep &= areas <= params.max_area
+        keep[0] = False
+        self.labels = relabel(labels, keep)
+        self.count = np.count_nonzero(keep)
+
+    def compute_properties(self):
+        """computes area, centroid, bounding box and eccentricity of all regions
+
+           Sums over the pixels of each region use bincount on the foreground
+           pixels, so the cost does not depend on the number of regions
+        """
+
+        bins = self.count + 1
+        xs, ys = np.nonzero(self.labels)
+        labels = self.labels[xs, ys]
+        areas = np.bincount(labels, minlength=bins)
+        xs = xs.astype(np.float64)
+        ys = ys.astype(np.float64)
+        safe = np.maximum(areas, 1)
+        mean_x = np.bincount(labels, xs, bins) / safe
+        mean_y = np.bincount(labels, ys, bins) / safe
+        xs -= mean_x[labels]
+        ys -= mean_y[labels]
+        mu_xx = np.bincount(labels, xs * xs, bins) / safe
+        mu_yy = np.bincount(labels, ys * ys, bins) / safe
+        mu_xy = np.bincount(labels, xs * ys, bins) / safe
+
+        # eigenvalues of the covariance matrix, largest first
+        half_sum = (mu_xx + mu_yy) / 2
+        root = np.sqrt(((mu_xx - mu_yy) / 2) ** 2 + mu_xy ** 2)
+        major = half_sum + root
+        minor = half_sum - root
+        eccentricities = np.zeros(bins)
+        valid = major > 0
+        eccentricities[valid] = np.sqrt(1 - np.clip(minor[valid] / major[valid], 0, 1))
+
+        self.areas = areas[1:]
+        self.centroids = np.column_stack((mean_x[1:], mean_y[1:]))
+        self.eccentricities = eccentricities[1:]
+        self.boxes = np.zeros((self.count, 4), np.int32)
+        for index, box in enumerate(ndimage.find_objects(self.labels, self.count)):
+            if box is not None:
+                self.boxes[index] = (box[0].start, box[1].start, box[0].stop, box[1].stop)
+
+    def find_regions(self, mask, params):
+        """labels the regions of a boolean mask (e.g. FluorFrame.phase_mask) and
+           computes their properties
+
+           params is an ImageProcessingParameters object
+        """
+
+        self.compute_labels(mask, params)
+        self.compute_properties()
+
+    def region(self, index):
+        """returns a Region view of region index (label index + 1)"""
+
+        return Region(self, index)
+
+    def regions(self):
+        """returns a list of Region views of all regions"""
+
+        return [Region(self, index) for index in range(self.count)]
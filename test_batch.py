@@ -0,0 +1,104 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from scipy import ndimage
+from skimage.io import imsave
+import batch
+import params
+
+
+class BatchTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.output = os.path.join(self.folder, 'out')
+        self.param_file = os.path.join(self.folder, 'params.cfg')
+        params.Parameters().save_parameters(self.param_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_image(self, name, seed=0):
+        """writes a blurred noise PNG image to the test folder, returns its file name"""
+        noise = ndimage.gaussian_filter(np.random.RandomState(seed).rand(60, 60), 3)
+        noise -= noise.min()
+        image = (255 * noise / noise.max()).astype(np.uint8)
+        filename = os.path.join(self.folder, name)
+        imsave(filename, image)
+        return filename
+
+    def test_directory(self):
+        """Tests listing a directory with and without the fluorescence tag"""
+        for name in ['a_w1Phase.png', 'a_w2GFP.png', 'b_w1Phase.png', 'b_w2GFP.png']:
+            self.write_image(name)
+        open(os.path.join(self.folder, 'notes.txt'), 'w').close()
+        for frames in [batch.frames_from_directory(self.folder),
+                       batch.frames_from_directory(self.folder, 'w2GFP', 'w1Phase')]:
+            self.assertEqual([f.name for f in frames], ['a_w2GFP', 'b_w2GFP'])
+            self.assertEqual([os.path.basename(f.phase_file) for f in frames],
+                             ['a_w1Phase.png', 'b_w1Phase.png'])
+
+    def test_manifest(self):
+        """Tests reading a manifest with comments, relative paths and repeated names"""
+        manifest = os.path.join(self.folder, 'frames.txt')
+        fil = open(manifest, 'w')
+        fil.write('# fluorescence, phase\n\na.png, a_phase.png\nsub/a.png\na_1.png\n')
+        fil.close()
+        frames = batch.frames_from_manifest(manifest)
+        self.assertEqual([f.name for f in frames], ['a', 'a_2', 'a_1'])
+        self.assertEqual(frames[0].phase_file, os.path.join(self.folder, 'a_phase.png'))
+        self.assertEqual(frames[1].fluor_file, os.path.join(self.folder, 'sub', 'a.png'))
+        self.assertTrue(frames[2].phase_file is None)
+
+    def test_failures(self):
+        """Tests that a failed frame is recorded without stopping the batch"""
+        frames = [batch.BatchFrame('good', self.write_image('good.png'), self.write_image('good_phase.png', 1)),
+                  batch.BatchFrame('missing', os.path.join(self.folder, 'missing.png'))]
+        results = batch.Batch(frames, self.param_file, self.output, workers=1).run()
+        status = dict((r.name, r) for r in results)
+        self.assertEqual(status['good'].status, 'done')
+        self.assertEqual(status['good'].stages, batch.STAGES)
+        self.assertEqual(status['missing'].status, 'failed')
+        self.assertTrue(status['missing'].error is not None)
+        manifest = batch.read_json(os.path.join(self.output, batch.MANIFEST))
+        self.assertTrue(manifest['frames']['missing']['error'] is not None)
+        lines = open(os.path.join(self.output, 'summary.csv')).read().splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(any(line.startswith('missing,failed,') for line in lines))
+
+    def test_checkpoint(self):
+        """Tests that finished stages are skipped, also after an interrupted run,
+           and that changed mask parameters force the later stages"""
+        frame = batch.BatchFrame('frame', self.write_image('frame.png'), self.write_image('phase.png', 1))
+        mparams = params.Parameters()
+        first = batch.process_frame((frame, mparams, self.output))
+        self.assertEqual(first.status, 'done')
+        self.assertEqual(first.reused, [])
+        second = batch.process_frame((frame, mparams, self.output))
+        self.assertEqual(second.reused, batch.STAGES)
+
+        # a run stopped before the overlay keeps the mask and align records
+        manifest_file = os.path.join(self.output, 'frame', batch.MANIFEST)
+        manifest = batch.read_json(manifest_file)
+        del manifest['stages']['overlay']
+        batch.write_json(manifest_file, manifest)
+        resumed = batch.process_frame((frame, mparams, self.output))
+        self.assertEqual(resumed.reused, ['mask', 'align'])
+        self.assertEqual(resumed.stages, batch.STAGES)
+
+        mparams.mask_params.closing += 1
+        changed = batch.process_frame((frame, mparams, self.output))
+        self.assertEqual(changed.status, 'done')
+        self.assertEqual(changed.reused, [])
+        again = batch.process_frame((frame, mparams, self.output))
+        self.assertEqual(again.reused, batch.STAGES)
+
+
+def suite():
+    "Test suite"
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(BatchTestCase)
+    # add other suites here
+    return unittest.TestSuite([suite1])  #and add them to this list too
+
+unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,83 @@
+import unittest
+import numpy as np
+import segments
+import cells
+import params
+
+
+class CellsTestCase(unittest.TestCase):
+    def setUp(self):
+        mask = np.zeros((60, 80), np.bool_)
+        mask[5:15, 10:30] = True
+        mask[40:50, 50:60] = True
+        mask[20:30, 60:75] = True
+        rparams = params.ImageProcessingParameters()
+        rparams.watershed = False
+        regions = segments.ImageRegions()
+        regions.find_regions(mask, rparams)
+        self.cells = cells.ImageCells()
+        self.cells.from_regions(regions)
+
+    def tearDown(self):
+        self.cells = None
+
+    def test_views(self):
+        """Tests that cells are views of the columns and of the shared label image"""
+        self.assertEqual(len(self.cells), 3)
+        cell = self.cells[1]
+        self.assertEqual(cell.area, 150)
+        self.assertEqual(cell.box(), (20, 60, 30, 75))
+        self.assertEqual(cell.cell_mask.shape, (10, 15))
+        self.assertTrue(np.all(cell.cell_mask))
+        self.assertTrue(cell.perimeter_mask is None)
+        self.cells.columns['area'][1] = 7
+        self.assertEqual(cell.area, 7)
+        self.assertRaises(AttributeError, getattr, cell, 'missing')
+
+    def test_filter(self):
+        """Tests that filtering cells relabels the label image and the columns"""
+        labels = self.cells.labels
+        self.cells.filter([True, False, True])
+        self.assertEqual(len(self.cells), 2)
+        self.assertEqual(list(self.cells.columns['area']), [200, 100])
+        self.assertEqual(np.count_nonzero(self.cells.labels == 2), 100)
+        self.assertEqual(np.count_nonzero(labels == 2), 150)
+        self.assertTrue(np.all(self.cells[1].cell_mask))
+
+    def test_fluorescence(self):
+        """Tests the per cell fluorescence statistics against numpy on each cell"""
+        fluor = np.random.RandomState(2).rand(60, 80) * 100
+        baseline = np.array([1.0, 2.0, 3.0])
+        self.cells.measure_fluorescence(fluor, baseline)
+        for index in range(len(self.cells)):
+            values = fluor[self.cells.labels == index + 1] - baseline[index]
+            cell = self.cells[index]
+            self.assertAlmostEqual(cell.fluor_total, np.sum(values))
+            self.assertAlmostEqual(cell.fluor_mean, np.mean(values))
+            self.assertAlmostEqual(cell.fluor_median, np.median(values))
+            for percentile in cells.FLUOR_PERCENTILES:
+                self.assertAlmostEqual(getattr(cell, 'fluor_p%g' % percentile),
+                                       np.percentile(values, percentile))
+
+    def test_regions(self):
+        """Tests the perimeter and septum of a rectangular cell"""
+        rparams = params.ImageProcessingParameters()
+        self.cells.compute_regions(rparams)
+        cell = self.cells[0]
+        self.assertEqual(cell.perimeter_area, 200 - 4 * 14)
+        self.assertEqual(cell.septum_area, 4 * 4)
+        septum = cell.septum_mask
+        self.assertEqual(septum.shape, (10, 20))
+        self.assertTrue(np.all(septum[3:7, 8:12]))
+        self.assertEqual(np.count_nonzero(cell.perimeter_mask), cell.perimeter_area)
+        self.cells.filter([False, True, True])
+        self.assertEqual(np.count_nonzero(self.cells.region_codes[5:15, 10:30]), 0)
+
+
+def suite():
+    "Test suite"
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(CellsTestCase)
+    # add other suites here
+    return unittest.TestSuite([suite1])  #and add them to this list too
+
+unittest.TextTestRunner(verbosity=2).run(suite())
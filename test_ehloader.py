@@ -0,0 +1,205 @@
+import unittest
+import os
+import struct
+import tempfile
+import numpy as np
+import ehloader
+import masks
+import ehooke
+import params
+
+
+def tiff_page(image, ifd_offset, rows_per_strip=None, tile=None, last=True):
+    """returns the IFD, tag values and pixel data of one uint16 page starting at ifd_offset"""
+
+    height, width = image.shape
+    if tile is None:
+        rows = rows_per_strip or height
+        blocks = [image[r:r+rows] for r in range(0, height, rows)]
+    else:
+        blocks = []
+        for r in range(0, height, tile):
+            for c in range(0, width, tile):
+                block = np.zeros((tile, tile), np.uint16)
+                part = image[r:r+tile, c:c+tile]
+                block[:part.shape[0], :part.shape[1]] = part
+                blocks.append(block)
+    data = [b.astype('<u2').tostring() for b in blocks]
+
+    if tile is None:
+        layout = [(278, 4, [rows]), (273, 4, None), (279, 4, [len(d) for d in data])]
+    else:
+        layout = [(322, 4, [tile]), (323, 4, [tile]), (324, 4, None), (325, 4, [len(d) for d in data])]
+    entries = [(256, 4, [width]), (257, 4, [height]), (258, 3, [16]), (259, 3, [1]),
+               (262, 3, [1]), (277, 3, [1])] + layout
+    ifd_size = 2 + 12 * len(entries) + 4
+    extra_start = ifd_offset + ifd_size
+    extra_size = sum(4 * len(v or data) for t, f, v in entries if len(v or data) > 1)
+    offset = extra_start + extra_size
+    offsets = []
+    for d in data:
+        offsets.append(offset)
+        offset += len(d)
+
+    ifd = struct.pack('<H', len(entries))
+    extra = ''
+    for tag, ftype, values in sorted(entries):
+        if values is None:
+            values = offsets
+        fmt = {3: 'H', 4: 'I'}[ftype]
+        if len(values) == 1:
+            field = struct.pack('<' + fmt, values[0]).ljust(4, '\0')
+        else:
+            field = struct.pack('<I', extra_start + len(extra))
+            extra += struct.pack('<' + fmt * len(values), *values)
+        ifd += struct.pack('<HHI', tag, ftype, len(values)) + field
+    if last:
+        ifd += struct.pack('<I', 0)
+    else:
+        ifd += struct.pack('<I', offset)
+    return ifd + extra + ''.join(data)
+
+
+def write_tiff(filename, image, rows_per_strip=None, tile=None):
+    """writes an uncompressed little endian uint16 TIFF, in strips or square tiles;
+       image is a 2D array or a list of them, written as pages
+    """
+
+    pages = image
+    if not isinstance(image, list):
+        pages = [image]
+    contents = ''
+    for index, page in enumerate(pages):
+        contents += tiff_page(page, 8 + len(contents), rows_per_strip, tile, index == len(pages) - 1)
+    fil = open(filename, 'wb')
+    fil.write('II' + struct.pack('<HI', 42, 8) + contents)
+    fil.close()
+
+
+class LoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        self.image = np.random.RandomState(0).randint(0, 65535, (37, 29)).astype(np.uint16)
+        handle, self.filename = tempfile.mkstemp(suffix='.tif')
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.filename)
+
+    def check_regions(self):
+        """checks reading and slicing regions against the original image"""
+        page = ehloader.open_mappable(self.filename)
+        self.assertTrue(page is not None)
+        self.assertEqual(page.shape, self.image.shape)
+        for region in [(0, 0, 37, 29), (3, 4, 20, 17), (17, 15, 37, 29), (36, 0, 37, 1)]:
+            x1, y1, x2, y2 = region
+            self.assertTrue(np.all(page.read_region(*region) == self.image[x1:x2, y1:y2]))
+        lazy = ehloader.LazyImage(page, lambda region: region / 65535.0)
+        self.assertTrue(np.allclose(lazy[5:30, 2:20], self.image[5:30, 2:20] / 65535.0))
+        self.assertTrue(np.allclose(lazy[6:10, 3:7], self.image[6:10, 3:7] / 65535.0))
+
+    def test_strips(self):
+        """Tests reading regions of a TIFF file stored in strips"""
+        write_tiff(self.filename, self.image, rows_per_strip=5)
+        self.check_regions()
+
+    def test_tiles(self):
+        """Tests reading regions of a TIFF file stored in tiles"""
+        write_tiff(self.filename, self.image, tile=16)
+        self.check_regions()
+
+
+class StackTestCase(unittest.TestCase):
+    def setUp(self):
+        state = np.random.RandomState(1)
+        self.fluor = [state.randint(0, 65535, (40, 36)).astype(np.uint16) for page in range(3)]
+        self.phase = [state.randint(0, 65535, (40, 36)).astype(np.uint16) for page in range(3)]
+        self.files = []
+        self.params = params.FluorFrameParameters()
+        self.params.fluor_file = self.temp_file()
+        write_tiff(self.params.fluor_file, self.fluor, rows_per_strip=7)
+
+    def tearDown(self):
+        for filename in self.files:
+            os.remove(filename)
+
+    def temp_file(self):
+        """returns the name of a new temporary TIFF file, removed by tearDown"""
+        handle, filename = tempfile.mkstemp(suffix='.tif')
+        os.close(handle)
+        self.files.append(filename)
+        return filename
+
+    def check_stack(self, frame, phase_pages):
+        """checks that the frames streamed have the fluorescence pages and the phase pages given"""
+        count = 0
+        for index in frame.stream_stack(self.params):
+            self.assertEqual(index, count)
+            self.assertTrue(np.all(frame.fluor_image == self.fluor[index]))
+            if phase_pages is None:
+                self.assertTrue(frame.phase_image is None)
+            else:
+                expected = masks.convert_phase(phase_pages[index], invert=self.params.invert_phase)
+                self.assertTrue(np.allclose(frame.phase_image, expected))
+            count += 1
+        self.assertEqual(count, len(self.fluor))
+
+    def test_pages(self):
+        """Tests reading the pages of a multi page file one at a time"""
+        pages = list(ehloader.iter_pages(self.params.fluor_file))
+        self.assertEqual(len(pages), 3)
+        for page, image in zip(pages, self.fluor):
+            self.assertTrue(np.all(page == image))
+
+    def test_stream_stack(self):
+        """Tests streaming with a phase stack, a single phase page, interleaved pages and no phase"""
+        frame = masks.FluorFrame()
+        self.params.phase_file = self.temp_file()
+        write_tiff(self.params.phase_file, self.phase)
+        self.check_stack(frame, self.phase)
+
+        self.params.phase_file = self.temp_file()
+        write_tiff(self.params.phase_file, self.phase[0])
+        self.check_stack(frame, [self.phase[0]] * 3)
+
+        self.params.phase_file = None
+        self.check_stack(frame, None)
+
+        self.params.stack_interleaved = True
+        interleaved = []
+        for phase, fluor in zip(self.phase, self.fluor):
+            interleaved += [phase, fluor]
+        self.params.fluor_file = self.temp_file()
+        write_tiff(self.params.fluor_file, interleaved)
+        self.check_stack(frame, self.phase)
+
+    def test_process_stack(self):
+        """Tests that the alignment of each frame is seeded with the offset of the previous one"""
+        self.params.phase_file = self.temp_file()
+        write_tiff(self.params.phase_file, self.phase)
+        parameters = params.Parameters()
+        parameters.fluor_frame_params = self.params
+        eh = ehooke.EHooke(parameters)
+        align = eh.fluor_frame.align_fluor
+        seeds = []
+
+        def recording_align(ffparams, seed=None):
+            seeds.append(seed)
+            align(ffparams, seed)
+
+        eh.fluor_frame.align_fluor = recording_align
+        shifts = []
+        for index in eh.process_stack():
+            self.assertTrue(eh.fluor_frame.phase_mask is not None)
+            shifts.append(eh.fluor_frame.fluor_shift)
+        self.assertEqual(len(shifts), 3)
+        self.assertEqual(seeds, [None] + shifts[:-1])
+
+
+def suite():
+    "Test suite"
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(LoaderTestCase)
+    suite2 = unittest.TestLoader().loadTestsFromTestCase(StackTestCase)
+    # add other suites here
+    return unittest.TestSuite([suite1, suite2])  #and add them to this list too
+
+unittest.TextTestRunner(verbosity=2).run(suite())
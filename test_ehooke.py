@@ -1,5 +1,9 @@
 import unittest
+import copy
+import numpy as np
+from scipy import ndimage
 import ehooke
+import masks
 import params
 
 class MaskTestCase(unittest.TestCase):
@@ -20,11 +24,43 @@ class MaskTestCase(unittest.TestCase):
         self.ehooke.save_mask_overlay('Images/overlay.png', back=(0,0,1), fore=(1,1,0), mask='phase',image='phase')
         self.ehooke.save_mask_contour('Images/contour.png', mask='phase',image='phase')
 
+class SweepTestCase(unittest.TestCase):
+    def setUp(self):
+        self.params = params.Parameters()
+        self.ehooke = ehooke.EHooke(self.params)
+        frame = self.ehooke.fluor_frame
+        noise = np.random.RandomState(5).rand(80, 80)
+        frame.fluor_image = ndimage.gaussian_filter(noise, 2)
+        frame.clip = frame.get_clip(self.params.fluor_frame_params.phase_border)
+
+    def tearDown(self):
+        self.ehooke = None
+        self.params = None
+
+    def test_sweep(self):
+        """Tests that a sweep at a fixed threshold, split across processes, gives
+           the masks of create_masks for each parameters object"""
+        grid = params.parameter_grid(self.params.mask_params,
+                                     {'closing': [0, 1, 2, 3], 'dilation': [0, 1]})
+        for processes in (1, 3):
+            table, thumbnails = self.ehooke.sweep_mask_parameters(grid, processes)
+            self.assertEqual(list(table.index), range(len(grid)))
+            for index, mparams in enumerate(grid):
+                self.params.mask_params = copy.deepcopy(mparams)
+                self.ehooke.create_masks()
+                coverage, components, mean_area = \
+                    masks.mask_statistics(self.ehooke.fluor_frame.phase_mask.get_mask())
+                self.assertAlmostEqual(table.coverage[index], coverage)
+                self.assertEqual(table.components[index], components)
+                self.assertAlmostEqual(table.mean_area[index], mean_area)
+
+
 def suite():
     "Test suite"
     suite1 = unittest.TestLoader().loadTestsFromTestCase(MaskTestCase)
+    suite2 = unittest.TestLoader().loadTestsFromTestCase(SweepTestCase)
     # add other suites here
-    return unittest.TestSuite([suite1])  #and add them to this list too
+    return unittest.TestSuite([suite1, suite2])  #and add them to this list too
 
 unittest.TextTestRunner(verbosity=2).run(suite())
     
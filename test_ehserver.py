@@ -0,0 +1,129 @@
+import unittest
+import threading
+import time
+import ehserver
+
+
+def wait_for(job, timeout=10):
+    """waits until the job finished or timeout seconds passed"""
+    limit = time.time() + timeout
+    while job.finished is None and time.time() < limit:
+        time.sleep(0.01)
+
+
+class JobQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.queue = ehserver.JobQueue(workers=1, max_queued=3)
+        self.release = threading.Event()
+        self.started = threading.Event()
+
+    def tearDown(self):
+        self.release.set()
+        self.queue = None
+
+    def blocking(self):
+        """job function that runs until release is set"""
+        self.started.set()
+        self.release.wait(10)
+        return (True, '')
+
+    def test_transitions(self):
+        """Tests the queued, running, done and failed states of jobs"""
+        first = self.queue.submit('s1', self.blocking, 'first')
+        second = self.queue.submit('s1', lambda: (False, 'bad'), 'second')
+        third = self.queue.submit('s2', lambda: 1 / 0, 'third')
+        self.assertTrue(self.started.wait(10))
+        self.assertEqual(first.status, 'running')
+        self.assertEqual(second.status, 'queued')
+        self.assertTrue(second.finished is None)
+        self.release.set()
+        for job in (first, second, third):
+            wait_for(job)
+        self.assertEqual(first.status, 'done')
+        self.assertEqual(second.status, 'failed')
+        self.assertEqual(second.message, 'bad')
+        self.assertEqual(third.status, 'failed')
+        self.assertTrue('ZeroDivisionError' in third.message)
+        self.assertTrue(third.finished >= third.created)
+
+    def test_queue_limit(self):
+        """Tests that submissions are rejected while max_queued jobs are waiting"""
+        self.queue.submit('s1', self.blocking, 'running')
+        self.assertTrue(self.started.wait(10))
+        waiting = [self.queue.submit('s%d' % index, lambda: (True, ''), 'waiting')
+                   for index in range(3)]
+        self.assertTrue(all(job is not None for job in waiting))
+        self.assertTrue(self.queue.submit('s4', lambda: (True, ''), 'waiting') is None)
+        self.release.set()
+        for job in waiting:
+            wait_for(job)
+        self.assertTrue(self.queue.submit('s4', lambda: (True, ''), 'waiting') is not None)
+
+    def test_prune(self):
+        """Tests that only the latest MAX_FINISHED_JOBS finished jobs are kept"""
+        saved = ehserver.MAX_FINISHED_JOBS
+        ehserver.MAX_FINISHED_JOBS = 2
+        try:
+            jobs = []
+            for index in range(5):
+                jobs.append(self.queue.submit('s1', lambda: (True, ''), 'job %d' % index))
+                wait_for(jobs[-1])
+        finally:
+            ehserver.MAX_FINISHED_JOBS = saved
+        self.assertTrue(self.queue.get_job(jobs[0].id) is None)
+        self.assertTrue(self.queue.get_job(jobs[1].id) is None)
+        for job in jobs[2:]:
+            self.assertTrue(self.queue.get_job(job.id) is job)
+
+    def test_job_status(self):
+        """Tests the job status for the session, for another session and for unknown ids"""
+        job = self.queue.submit('s1', lambda: (True, ''), 'mask')
+        wait_for(job)
+        self.assertEqual(self.queue.job_status('s1', job.id)['status'], 'done')
+        self.assertEqual(self.queue.job_status('s1', job.id)['id'], job.id)
+        for session_id, job_id in (('s2', job.id), ('s1', 'no such id'), ('s1', None)):
+            status = self.queue.job_status(session_id, job_id)
+            self.assertEqual(status['status'], 'unknown')
+            self.assertTrue(status['id'] is None)
+
+    def test_coalescing(self):
+        """Tests that a running job with the same parameters is shared and that a
+           queued job is superseded by newer parameters"""
+        results = []
+        running = self.queue.submit('s1', self.blocking, 'mask', 'params 1')
+        self.assertTrue(self.started.wait(10))
+        self.assertTrue(self.queue.submit('s1', lambda: (True, ''), 'mask', 'params 1') is running)
+        queued = self.queue.submit('s1', lambda: results.append(2) or (True, ''), 'mask', 'params 2')
+        self.assertTrue(queued is not running)
+        self.assertEqual(queued.status, 'queued')
+        newer = self.queue.submit('s1', lambda: results.append(3) or (True, ''), 'mask', 'params 3')
+        self.assertTrue(newer is queued)
+        self.release.set()
+        wait_for(queued)
+        self.assertEqual(results, [3])
+        self.assertEqual(queued.fingerprint, 'params 3')
+        self.assertEqual(running.status, 'done')
+
+    def test_parallel_sessions(self):
+        """Tests that queued jobs of a busy session do not hold back other sessions"""
+        self.queue = ehserver.JobQueue(workers=2)
+        first = self.queue.submit('s1', self.blocking, 'first')
+        second = self.queue.submit('s1', self.blocking, 'second')
+        self.assertTrue(self.started.wait(10))
+        other = self.queue.submit('s2', lambda: (True, ''), 'other')
+        wait_for(other, 5)
+        self.assertEqual(other.status, 'done')
+        self.assertEqual(first.status, 'running')
+        self.assertEqual(second.status, 'queued')
+        self.release.set()
+        wait_for(second)
+        self.assertEqual(second.status, 'done')
+
+
+def suite():
+    "Test suite"
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(JobQueueTestCase)
+    # add other suites here
+    return unittest.TestSuite([suite1])  #and add them to this list too
+
+unittest.TextTestRunner(verbosity=2).run(suite())
@@ -0,0 +1,92 @@
+import unittest
+import os
+import shutil
+import tempfile
+import numpy as np
+from scipy import ndimage
+from skimage.io import imread, imsave
+import ehworker
+import params
+
+
+class SharedArrayTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_share(self):
+        """Tests that shared arrays are mapped back with their type and shape"""
+        for array in (np.arange(12, dtype=np.float32).reshape(3, 4), np.eye(5, dtype=np.bool_)):
+            filename = os.path.join(self.folder, 'array.dat')
+            descriptor = ehworker.share_array(filename, array)
+            self.assertEqual(descriptor[0], filename)
+            shared = ehworker.open_shared(descriptor)
+            self.assertEqual(shared.dtype, array.dtype)
+            self.assertTrue(np.all(shared == array))
+            self.assertFalse(os.path.exists(filename + '.tmp'))
+            shared = None
+
+
+class WorkerPoolTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.pool = ehworker.WorkerPool(1)
+
+    def tearDown(self):
+        self.pool.close()
+        self.pool = None
+        shutil.rmtree(self.folder)
+
+    def start_session(self, session_id):
+        """starts a session in the pool with a blurred noise image, returns the call result"""
+        noise = ndimage.gaussian_filter(np.random.RandomState(0).rand(60, 60), 3)
+        noise -= noise.min()
+        fluor_file = os.path.join(self.folder, 'fluor.png')
+        imsave(fluor_file, (255 * noise / noise.max()).astype(np.uint8))
+        parameters = params.Parameters()
+        parameters.fluor_frame_params.fluor_file = fluor_file
+        return self.pool.call(session_id, 'start', parameters, self.folder)
+
+    def test_commands(self):
+        """Tests starting a session, sharing its mask and closing it"""
+        res, msg, shared = self.start_session('s1')
+        self.assertTrue(res, msg)
+        self.assertTrue(self.pool.has_session('s1'))
+        self.assertEqual(list(shared.keys()), ['mask'])
+        mask = ehworker.open_shared(shared['mask'])
+        self.assertEqual(mask.shape, imread(os.path.join(self.folder, 'base.png')).shape[:2])
+        self.assertEqual(mask.dtype, np.bool_)
+        self.assertTrue(os.path.exists(os.path.join(self.folder, 'contours.json')))
+
+        self.assertEqual(self.pool.call('s1', 'close'), (True, '', {}))
+        self.assertFalse(self.pool.has_session('s1'))
+        res, msg, shared = self.pool.call('s1', 'overlay', os.path.join(self.folder, 'o.png'),
+                                          (0, 0, 1), (1, 1, 0), 'phase', 'fluor')
+        self.assertFalse(res)
+        self.assertEqual(msg, 'Session not started')
+
+    def test_restart(self):
+        """Tests that a worker process that stopped is replaced"""
+        res, msg, shared = self.start_session('s1')
+        self.assertTrue(res, msg)
+        self.pool.processes[0].terminate()
+        self.pool.processes[0].join()
+        res, msg, shared = self.pool.call('s1', 'overlay', os.path.join(self.folder, 'o.png'),
+                                          (0, 0, 1), (1, 1, 0), 'phase', 'fluor')
+        self.assertFalse(res)
+        self.assertFalse(self.pool.has_session('s1'))
+        self.assertTrue(self.pool.processes[0].is_alive())
+        res, msg, shared = self.start_session('s1')
+        self.assertTrue(res, msg)
+
+
+def suite():
+    "Test suite"
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(SharedArrayTestCase)
+    suite2 = unittest.TestLoader().loadTestsFromTestCase(WorkerPoolTestCase)
+    # add other suites here
+    return unittest.TestSuite([suite1, suite2])  #and add them to this list too
+
+unittest.TextTestRunner(verbosity=2).run(suite())
@@ -1,4 +1,7 @@
 import unittest
+import numpy as np
+from scipy import ndimage
+from skimage import morphology
 import masks
 import params
 
@@ -23,12 +26,279 @@ class MaskTestCase(unittest.TestCase):
         # check if the mask has the right number of pixels set to 1
         # <LK 2015-06-27>
 
+    def test_local_integral(self):
+        """Tests the summed-area local threshold against direct filtering"""
+        image = np.random.RandomState(1).rand(60, 50)
+        threshold = masks.local_threshold(image, 10, offset=0.05)
+        expected = ndimage.uniform_filter(image, 11, mode='reflect') - 0.05
+        self.assertTrue(np.allclose(threshold, expected))
+
+        threshold = masks.local_threshold(image, 10, k=0.2, r=0.5)
+        mean = ndimage.uniform_filter(image, 11, mode='reflect')
+        std = np.sqrt(ndimage.uniform_filter(image**2, 11, mode='reflect') - mean**2)
+        self.assertTrue(np.allclose(threshold, mean * (1 + 0.2 * (std / 0.5 - 1))))
+
+    def test_local_average(self):
+        """Tests that 'Local Integral' (k = 0) gives the masks of 'Local Average'
+           except within 2 pixels of the edges of the cells
+
+           'Local Average' weights the block with a gaussian and 'Local Integral'
+           uniformly, so their thresholds differ; the tolerance is the band of
+           blurred pixels at the cell edges, where both thresholds fall.
+        """
+        centres = np.arange(15, 120, 30)
+        x, y = np.mgrid[0:120, 0:120]
+        distance = np.full(x.shape, np.inf)
+        for cx in centres:
+            for cy in centres:
+                distance = np.minimum(distance, np.hypot(x - cx, y - cy))
+        image = np.where(distance < 6, 0.3, 0.8)
+        image = ndimage.gaussian_filter(image, 1)
+        image += np.random.RandomState(4).normal(0, 0.01, image.shape)
+        mparams = params.MaskParameters()
+        mparams.blocksize = 31
+        mparams.offset = 0.1
+        mparams.auto_threshold = False
+        mparams.algorithm = 'Local Average'
+        average = masks.threshold_image(image, mparams)
+        mparams.algorithm = 'Local Integral'
+        integral = masks.threshold_image(image, mparams)
+        outside = np.abs(distance - 6) > 2
+        self.assertTrue(np.all(average[outside] == integral[outside]))
+        self.assertTrue(np.all(integral[outside] == (distance[outside] < 6)))
+
+    def test_mask_pipeline(self):
+        """Tests that only the stages after a changed parameter are recomputed"""
+        image = ndimage.gaussian_filter(np.random.RandomState(2).rand(60, 60), 2)
+        mparams = params.MaskParameters()
+        pipeline = masks.MaskPipeline()
+        first = pipeline.run(image, 'image', mparams)
+        self.assertEqual([hit for stage, hit in pipeline.last_run], [False] * 5)
+
+        mparams.dilation = 2
+        second = pipeline.run(image, 'image', mparams)
+        self.assertEqual([hit for stage, hit in pipeline.last_run], [True] * 4 + [False])
+        self.assertTrue(second['closing'] is first['closing'])
+
+        self.mask.compute_base_mask(image, mparams)
+        self.mask.compute_phase_mask(self.mask.mask, mparams)
+        self.assertTrue(np.all(self.mask.mask == second['dilation']))
+        self.assertEqual(self.mask.mask.dtype, np.bool_)
+
+    def test_distance_morphology(self):
+        """Tests that distance transform morphology matches the disk footprints"""
+        mask = ndimage.gaussian_filter(np.random.RandomState(4).rand(80, 70), 2) > 0.5
+        # regions touch every border, where the two methods must also agree
+        self.assertTrue(mask[0].any() and mask[-1].any() and mask[:, 0].any() and mask[:, -1].any())
+        for radius in range(1, 6):
+            disk = morphology.disk(radius)
+            self.assertTrue(np.all(masks.distance_erosion(mask, radius) ==
+                                   ndimage.binary_erosion(mask, disk, border_value=1)))
+            self.assertTrue(np.all(masks.closed(mask, radius, 'Distance') == masks.closed(mask, radius, 'Disk')))
+            self.assertTrue(np.all(masks.dilated(mask, radius, 'Distance') == masks.dilated(mask, radius, 'Disk')))
+
+    def test_closing_baseline(self):
+        """Tests that closing and opening match the grayscale closings of the
+           original phase mask computation, also at the image borders"""
+        mask = ndimage.gaussian_filter(np.random.RandomState(6).rand(80, 70), 2) > 0.5
+        for radius in range(1, 6):
+            closing_disk = morphology.disk(radius)
+            expected = morphology.closing(mask.astype(np.uint8), closing_disk)
+            expected = 1 - morphology.closing(1 - expected, closing_disk)
+            self.assertTrue(np.all(masks.closed(mask, radius, 'Disk') == (expected > 0)))
+            expected = morphology.dilation(mask.astype(np.uint8), closing_disk)
+            self.assertTrue(np.all(masks.dilated(mask, radius, 'Disk') == (expected > 0)))
+
+    def test_histogram(self):
+        """Tests histogram thresholds against skimage and coverage against counting"""
+        from skimage.filter import threshold_isodata, threshold_otsu
+        image = ndimage.gaussian_filter(np.random.RandomState(5).rand(90, 80), 2)
+        histogram = masks.ImageHistogram(image)
+        self.assertAlmostEqual(histogram.threshold('Isodata'), threshold_isodata(image))
+        self.assertAlmostEqual(histogram.threshold('Otsu'), threshold_otsu(image))
+        for threshold in histogram.edges:
+            self.assertAlmostEqual(histogram.coverage(threshold), np.mean(image <= threshold), 2)
+
+    def test_packed_mask(self):
+        """Tests that packing and unpacking masks preserves them"""
+        self.mask.mask = np.random.RandomState(3).rand(37, 23) > 0.5
+        original = self.mask.mask
+        self.mask.pack()
+        self.assertTrue(self.mask.mask is None)
+        self.assertTrue(np.all(self.mask.get_mask() == original))
+        self.mask.unpack()
+        self.assertTrue(np.all(self.mask.mask == original))
+
+    def test_outlines(self):
+        """Tests the cached boundary and the contours of a mask"""
+        self.mask.mask = np.zeros((30, 40), np.bool_)
+        self.mask.mask[5:15, 10:30] = True
+        boundary = self.mask.get_boundary()
+        self.assertEqual(np.count_nonzero(boundary), 2 * (10 + 20) - 4)
+        self.assertTrue(self.mask.get_boundary() is boundary)
+        self.mask.pack()
+        self.assertTrue(self.mask.get_boundary() is boundary)
+        exact = self.mask.get_contours(0)
+        self.assertEqual(len(exact), 1)
+        self.assertTrue(np.all(exact[0].min(axis=0) == [4.5, 9.5]))
+        self.assertTrue(np.all(exact[0].max(axis=0) == [14.5, 29.5]))
+        # the simplified contour keeps within tolerance of the exact one
+        contours = self.mask.get_contours()
+        self.assertEqual(len(contours), 1)
+        self.assertTrue(np.allclose(contours[0].min(axis=0), [4.5, 9.5], atol=0.5))
+        self.assertTrue(np.allclose(contours[0].max(axis=0), [14.5, 29.5], atol=0.5))
+        self.assertTrue(len(contours[0]) <= 9)
+        self.assertTrue(self.mask.get_contours(0) is exact)
+        self.mask.mask = np.zeros((30, 40), np.bool_)
+        self.mask.packed = None
+        self.assertEqual(np.count_nonzero(self.mask.get_boundary()), 0)
+
+
+class FluorFrameTestCase(unittest.TestCase):
+    def setUp(self):
+        self.params = params.FluorFrameParameters()
+        self.frame = masks.FluorFrame()
+        noise = np.random.RandomState(0).rand(100, 100)
+        self.frame.fluor_image = ndimage.gaussian_filter(noise, 3)
+        self.frame.clip = self.frame.get_clip(self.params.phase_border)
+
+    def tearDown(self):
+        self.frame.clear_masks()
+        self.frame = None
+        self.params = None
+
+    def bright(self, image):
+        """returns the pixels brighter than the average of the fluorescence image"""
+        return image > np.mean(self.frame.fluor_image)
+
+    def set_shifted_mask(self, dx, dy):
+        """sets the phase mask to the bright pixels of the fluorescence image shifted by (dx, dy)"""
+        x1, y1, x2, y2 = self.frame.clip
+        self.frame.phase_mask.mask = self.bright(self.frame.fluor_image[x1+dx:x2+dx, y1+dy:y2+dy])
+
+    def test_align_algorithms(self):
+        """Tests that every alignment algorithm finds and applies a known shift"""
+        self.set_shifted_mask(3, -2)
+        for algorithm in self.params.align_algorithms:
+            self.params.align_algorithm = algorithm
+            self.frame.align_fluor(self.params)
+            self.assertEqual(self.frame.fluor_shift, (3, -2))
+            self.assertTrue(np.all(self.bright(self.frame.fluor_clip()) == self.frame.phase_mask.mask))
+
+    def test_align_tracking(self):
+        """Tests that alignment seeded with a previous offset searches around it"""
+        self.set_shifted_mask(3, -2)
+        self.params.track_margin = 2
+        for algorithm in self.params.align_algorithms:
+            self.params.align_algorithm = algorithm
+            self.frame.align_fluor(self.params, seed=(2, -1))
+            self.assertEqual(self.frame.fluor_shift, (3, -2))
+            self.frame.align_fluor(self.params, seed=(-5, 5))
+            self.assertNotEqual(self.frame.fluor_shift, (3, -2))
+
+    def test_align_large_margin(self):
+        """Tests that the pyramid search finds the exhaustive result for large drifts"""
+        # sharp 4 pixel blocks, so that the overlap score peaks at the shift also
+        # in the small clip and still shows it in the downsampled images
+        blocks = np.random.RandomState(0).rand(25, 25)
+        self.frame.fluor_image = np.kron(blocks, np.ones((4, 4)))
+        self.params.phase_border = 30
+        self.params.align_margin = 30
+        self.frame.clip = self.frame.get_clip(self.params.phase_border)
+        self.set_shifted_mask(-21, 17)
+        shifts = []
+        for algorithm in ('Exhaustive', 'Pyramid'):
+            self.params.align_algorithm = algorithm
+            self.frame.align_fluor(self.params)
+            shifts.append(self.frame.fluor_shift)
+        self.assertEqual(shifts, [(-21, 17), (-21, 17)])
+
+    def test_tiled_masks(self):
+        """Tests that tiled masks match the masks computed from the whole image"""
+        mparams = params.MaskParameters()
+        mparams.closing = 2
+        mparams.dilation = 1
+        for fill_holes in (False, True):
+            mparams.fill_holes = fill_holes
+            mparams.tile_size = 0
+            self.frame.create_masks(mparams)
+            whole = (self.frame.base_mask.mask, self.frame.phase_mask.mask)
+            mparams.tile_size = 23
+            self.frame.create_masks(mparams)
+            self.assertTrue(np.all(self.frame.base_mask.mask == whole[0]))
+            self.assertTrue(np.all(self.frame.phase_mask.mask == whole[1]))
+
+    def test_precision(self):
+        """Tests that float32 and uint16 images give the same masks as float64"""
+        noise = ndimage.gaussian_filter(np.random.RandomState(1).rand(100, 100), 3)
+        noise -= noise.min()
+        phase = np.rint(noise / noise.max() * 65535).astype(np.uint16)
+        mparams = params.MaskParameters()
+        results = {}
+        for precision in self.params.precisions:
+            self.params.precision = precision
+            self.frame.set_phase(phase, self.params)
+            self.assertEqual(self.frame.phase_image.dtype, masks.PRECISIONS[precision])
+            for algorithm in ('Absolute', 'Local Average', 'Local Integral'):
+                mparams.algorithm = algorithm
+                mparams.blocksize = 15
+                self.frame.create_masks(mparams)
+                results.setdefault(algorithm, []).append(self.frame.phase_mask.mask)
+        for algorithm, computed in results.items():
+            for mask in computed[1:]:
+                self.assertTrue(np.all(mask == computed[0]))
+
+    def test_image_scale(self):
+        """Tests that image_scale is the divisor of as_float for every image type"""
+        for dtype in (np.uint8, np.uint16, np.int16, np.int32, np.float32, np.float64):
+            image = np.array([[0, 1], [2, 3]], dtype)
+            self.assertTrue(np.allclose(masks.as_float(image) * masks.image_scale(image), image))
+
+    def test_mask_overlay(self):
+        """Tests the uint8 overlay against the color products and the buffer reuse"""
+        self.set_shifted_mask(0, 0)
+        back, fore = (0, 0, 1), (1, 0.5, 0)
+        image = self.frame.fluor_clip()
+        overlay = self.frame.mask_overlay(back, fore, 'phase', 'fluor')
+        self.assertEqual(overlay.dtype, np.uint8)
+        mask = self.frame.phase_mask.mask
+        for channel in range(3):
+            expected = np.where(mask, fore[channel], back[channel]) * image * 255
+            self.assertTrue(np.all(np.abs(overlay[:, :, channel] - expected) <= 0.5 + 1e-3))
+        self.assertTrue(self.frame.mask_overlay(back, fore, 'phase', 'fluor') is overlay)
+
+    def test_fluor_baseline(self):
+        """Tests the frame baseline and the ring baseline of each cell"""
+        x1, y1, x2, y2 = self.frame.clip
+        fluor = np.zeros((x2 - x1, y2 - y1))
+        labels = np.zeros(fluor.shape, np.int32)
+        labels[10:20, 10:20] = 1
+        labels[50:60, 60:70] = 2
+        # bright where cell 2 is the nearest cell, so each ring is uniform
+        indices = ndimage.distance_transform_edt(labels == 0, return_indices=True)[1]
+        fluor[labels[indices[0], indices[1]] == 2] = 4.0
+        self.frame.fluor_image = np.zeros(self.frame.fluor_image.shape)
+        self.frame.fluor_image[x1:x2, y1:y2] = fluor
+        self.frame.phase_mask.mask = labels > 0
+        baselines = self.frame.compute_fluor_baseline(self.params, labels)
+        background = ndimage.distance_transform_edt(labels == 0) > self.params.baseline_margin
+        self.assertAlmostEqual(self.frame.fluor_baseline, np.mean(fluor[background]))
+        self.assertEqual(list(baselines), [0.0, 4.0])
+
+        # cell 2 of 3 has no pixels (e.g. removed), cells keep their positions
+        labels[labels == 2] = 3
+        baselines = self.frame.compute_fluor_baseline(self.params, labels, 3)
+        self.assertEqual(list(baselines), [0.0, self.frame.fluor_baseline, 4.0])
+        baselines = self.frame.compute_fluor_baseline(self.params, labels, 4)
+        self.assertEqual(len(baselines), 4)
+
 
 def suite():
     "Test suite"
     suite1 = unittest.TestLoader().loadTestsFromTestCase(MaskTestCase)
+    suite2 = unittest.TestLoader().loadTestsFromTestCase(FluorFrameTestCase)
     # add other suites here
-    return unittest.TestSuite([suite1])  #and add them to this list too
+    return unittest.TestSuite([suite1, suite2])  #and add them to this list too
 
 unittest.TextTestRunner(verbosity=2).run(suite())
     
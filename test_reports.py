@@ -0,0 +1,93 @@
+import unittest
+import os
+import csv
+import shutil
+import tempfile
+import numpy as np
+import reports
+
+
+class ReportTestCase(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write_part(self, name, frames):
+        """writes a report with 5 rows for each frame, in chunks of 7 rows"""
+        report = reports.Report(self.folder, name, chunk_rows=7)
+        for frame in frames:
+            report.append({'area': np.arange(5), 'mean': np.arange(5) / 4.0}, frame=frame)
+        report.close()
+        return report
+
+    def test_chunks(self):
+        """Tests that rows written in chunks are read back from CSV and column files"""
+        report = self.write_part('cells', ['f1', 'f2', 'f3'])
+        self.assertEqual(report.rows, 15)
+        columns = reports.read_report(self.folder, 'cells')
+        self.assertEqual(sorted(columns), ['area', 'frame', 'mean'])
+        self.assertEqual(list(columns['area']), range(5) * 3)
+        self.assertEqual(list(columns['frame'][4:6]), ['f1', 'f2'])
+        lines = open(os.path.join(self.folder, 'cells.csv')).read().splitlines()
+        self.assertEqual(lines[0], 'area,frame,mean')
+        self.assertEqual(lines[2], '1,f1,0.25')
+        self.assertEqual(len(lines), 16)
+
+    def test_merge(self):
+        """Tests merging reports written separately"""
+        self.write_part('part1', ['f1'])
+        self.write_part('part2', ['f2', 'f3'])
+        reports.merge_reports([(self.folder, 'part1'), (self.folder, 'part2')], self.folder, 'all')
+        columns = reports.read_report(self.folder, 'all')
+        self.assertEqual(len(columns['mean']), 15)
+        self.assertEqual(list(columns['frame'][::5]), ['f1', 'f2', 'f3'])
+        lines = open(os.path.join(self.folder, 'all.csv')).read().splitlines()
+        self.assertEqual(len(lines), 16)
+
+    def test_widen(self):
+        """Tests that longer strings appended later, written or buffered, are not cut"""
+        frames = ['frame_9', 'frame_10', 'f', 'frame_100']
+        for chunk_rows in (5, 1000):
+            report = reports.Report(self.folder, 'wide', chunk_rows)
+            for frame in frames:
+                report.append({'area': np.arange(5)}, frame=frame)
+            report.close()
+            columns = reports.read_report(self.folder, 'wide')
+            self.assertEqual(list(columns['frame'][::5]), frames)
+            self.assertEqual(list(columns['area']), range(5) * 4)
+            lines = open(os.path.join(self.folder, 'wide.csv')).read().splitlines()
+            self.assertEqual(lines[-1], '4,frame_100')
+
+    def test_merge_widths(self):
+        """Tests merging parts whose string columns have different widths"""
+        self.write_part('part1', ['f1'])
+        self.write_part('part2', ['frame_22'])
+        reports.merge_reports([(self.folder, 'part1'), (self.folder, 'part2')], self.folder, 'all')
+        columns = reports.read_report(self.folder, 'all')
+        self.assertEqual(list(columns['frame'][::5]), ['f1', 'frame_22'])
+        self.assertEqual(list(columns['mean'][:5]), list(np.arange(5) / 4.0))
+
+        report = reports.Report(self.folder, 'other')
+        report.append({'area': np.arange(5)}, frame='f3')
+        report.close()
+        self.assertRaises(ValueError, reports.merge_reports,
+                          [(self.folder, 'part1'), (self.folder, 'other')], self.folder, 'bad')
+
+    def test_csv_quoting(self):
+        """Tests that strings with commas and quotes are quoted in the CSV file"""
+        report = reports.Report(self.folder, 'quoted')
+        report.append({'area': np.arange(2), 'label': np.array(['a,b', 'say "hi"'])}, frame='f1')
+        report.close()
+        rows = list(csv.reader(open(os.path.join(self.folder, 'quoted.csv'))))
+        self.assertEqual(rows, [['area', 'frame', 'label'], ['0', 'f1', 'a,b'], ['1', 'f1', 'say "hi"']])
+
+
+def suite():
+    "Test suite"
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(ReportTestCase)
+    # add other suites here
+    return unittest.TestSuite([suite1])  #and add them to this list too
+
+unittest.TextTestRunner(verbosity=2).run(suite())
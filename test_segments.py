@@ -0,0 +1,53 @@
+import unittest
+import numpy as np
+import segments
+import params
+
+
+class RegionsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.params = params.ImageProcessingParameters()
+        self.regions = segments.ImageRegions()
+
+    def tearDown(self):
+        self.regions = None
+        self.params = None
+
+    def test_properties(self):
+        """Tests area, centroid, bounding box and eccentricity of separate regions"""
+        mask = np.zeros((60, 80), np.bool_)
+        mask[5:15, 10:30] = True
+        mask[40:50, 50:60] = True
+        mask[2:4, 70:72] = True
+        self.params.watershed = False
+        self.params.min_area = 5
+        self.regions.find_regions(mask, self.params)
+        self.assertEqual(self.regions.count, 2)
+        self.assertEqual(list(self.regions.areas), [200, 100])
+        self.assertTrue(np.allclose(self.regions.centroids, [[9.5, 19.5], [44.5, 54.5]]))
+        self.assertEqual(self.regions.boxes.tolist(), [[5, 10, 15, 30], [40, 50, 50, 60]])
+        self.assertTrue(self.regions.eccentricities[0] > 0.8)
+        self.assertTrue(abs(self.regions.eccentricities[1]) < 1e-6)
+        region = self.regions.region(1)
+        self.assertTrue(np.all(region.get_mask()))
+
+    def test_watershed(self):
+        """Tests that the watershed splits two touching disks"""
+        x, y = np.mgrid[0:40, 0:70]
+        mask = ((x - 20) ** 2 + (y - 20) ** 2 < 150) | ((x - 20) ** 2 + (y - 40) ** 2 < 150)
+        self.params.watershed = False
+        self.regions.find_regions(mask, self.params)
+        self.assertEqual(self.regions.count, 1)
+        self.params.watershed = True
+        self.regions.find_regions(mask, self.params)
+        self.assertEqual(self.regions.count, 2)
+        self.assertEqual(self.regions.areas.sum(), np.count_nonzero(mask))
+
+
+def suite():
+    "Test suite"
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(RegionsTestCase)
+    # add other suites here
+    return unittest.TestSuite([suite1])  #and add them to this list too
+
+unittest.TextTestRunner(verbosity=2).run(suite())